@@ -0,0 +1,152 @@
+###############################################################################################################################################################
+'''
+
+Full name of script: File name parser and index for EVOS M7000 images [Version 01]
+
+Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-), it also works with Python 3
+
+Description: The EVOS M7000 saves every plane as a separate .TIFF and all the information of the plane is in the file name. This module is shared by the
+             scripts that read those images (Images_to_Hyperstacks_merger.py and the automated PLA processing scripts), so the names are parsed in one place
+             with a single regular expression instead of splitting the names in each script. It makes a sorted index of all the images of a "Raw Images" folder,
+             checks for planes missing (or repeated) and keeps the index as a JSON file next to the folder, so the next scripts or runs don't scan it again.
+
+             To use it from Fiji, keep it in this folder of the repository (the scripts look for it here) or copy it to Fiji.app/jars/Lib.
+
+Made by: Eduardo Reyes Alvarez
+
+Contact: eduardo_reyes09@hotmail.com
+
+Last update: Oct 17, 2026
+
+Version History:
+V01 (Oct 17, 2026): First version, replaces the name splitting of Images_to_Hyperstacks_merger.py, 04-Image_Processing_SYTTMZ_automated_PLA.py and
+		    01-Image_Processing_PLA_SYEVE4_16Nov2022.py.
+
+'''
+
+###############################################################################################################################################################
+
+import os
+import re
+import json
+
+#The EVOS M700 saves the images in this format: ExperimentName_Bottom Slide_R_p00_z00_0_A00f00d0.tif
+	#The R means Raw (could be M for Merged or something else)
+	#The p00 is the timepoint of time lapses
+	#The z00 is the slice number, usually two numbers from 00 to 20 or 30 (could be 3 numbers)
+	#The _0_ is not used
+	#The A00 is the area imaged. For a channel slide could vary from 00-05 (6 channels)
+	#The f00 is the number of field of view imaged, and could be 2 or 3 numbers (depending on settings 00-999)
+	#The d0 is the number of channel, which can be 0-4 given the capabilities of the equipment
+#Everything is read from the end of the name, so the experiment name can have any character (including d, f, z or _p00_)
+EVOS_NAME_PATTERN = re.compile(r"^(?P<experiment>.*)_(?P<kind>[A-Za-z]+)_p(?P<timepoint>\d+)_z(?P<slice>\d+)_(?P<extra>\d+)_(?P<area>[A-Za-z]+\d+)"
+							   r"f(?P<FOV>\d+)d(?P<channel>\d+)\.tiff?$", re.IGNORECASE)
+
+#Version of the index saved as JSON, an index saved by a different version is made again
+EVOS_INDEX_VERSION = 1
+
+#Get the area, FOV, channel, slice and timepoint from the name of one image (None if the name doesn't follow the EVOS format)
+def parse_EVOS_name(image_name):
+	name_match = EVOS_NAME_PATTERN.match(image_name)
+	if name_match == None:
+		return None
+	return {"area": name_match.group("area").upper(), "FOV": int(name_match.group("FOV")), "channel": int(name_match.group("channel")),
+			"slice": int(name_match.group("slice")), "timepoint": int(name_match.group("timepoint"))}
+
+#Order of the images in the index: by area, FOV, timepoint, channel and then slice (all the planes of one hyperstack are together)
+def EVOS_sort_key(image_info):
+	return (image_info["area"], image_info["FOV"], image_info["timepoint"], image_info["channel"], image_info["slice"])
+
+#Check that every area+FOV+timepoint has all the channels and slices found in the folder, and that no plane is there twice
+def validate_EVOS_index(images):
+	channels = sorted(set(image_info["channel"] for image_info in images))
+	slices = sorted(set(image_info["slice"] for image_info in images))
+	planes_found = {}
+	duplicated = []
+	for image_info in images:
+		plane_key = (image_info["area"], image_info["FOV"], image_info["timepoint"], image_info["channel"], image_info["slice"])
+		if plane_key in planes_found:
+			duplicated.append(image_info["path"])
+		planes_found[plane_key] = image_info["path"]
+	missing = []
+	for area, FOV, timepoint in sorted(set(plane_key[:3] for plane_key in planes_found)):
+		for channel in channels:
+			for zslice in slices:
+				if (area, FOV, timepoint, channel, zslice) not in planes_found:
+					missing.append({"area": area, "FOV": FOV, "timepoint": timepoint, "channel": channel, "slice": zslice})
+	return missing, duplicated
+
+#The index is valid while none of the folders scanned changed (adding, removing or renaming a file changes the modification time of its folder)
+def read_EVOS_index_cache(index_path, raw_image_directory):
+	if not os.path.isfile(index_path):
+		return None
+	try:
+		with open(index_path) as index_file:
+			index = json.load(index_file)
+	except ValueError:
+		return None
+	if index.get("version") != EVOS_INDEX_VERSION:
+		return None
+	for folder, folder_time in index["folders"].items():
+		folder_path = os.path.join(raw_image_directory, folder)
+		if (not os.path.isdir(folder_path)) or (os.path.getmtime(folder_path) != folder_time):
+			return None
+	for image_info in index["images"]:
+		image_info["path"] = os.path.join(raw_image_directory, image_info["path"])
+	return index
+
+#Make the index of all the EVOS images in a folder (and subfolders), or read it from "<folder>_index.json" if the folder didn't change since it was made.
+#Returns a dictionary with the "images" sorted (each with its path, area, FOV, channel, slice and timepoint), the planes "missing", the files "duplicated"
+#and the files that are not EVOS images ("not_parsed")
+def build_EVOS_index(raw_image_directory, use_cache=True):
+	raw_image_directory = os.path.abspath(raw_image_directory)
+	index_path = raw_image_directory + "_index.json"
+	index = read_EVOS_index_cache(index_path, raw_image_directory) if use_cache else None
+	if index != None:
+		print("EVOS index read from " + index_path + " (" + str(len(index["images"])) + " images)")
+		return index
+
+	#Walk through all the images in the folder and parse their names
+	images = []
+	not_parsed = []
+	folders = {}
+	for directory, subfolders, image_names in os.walk(raw_image_directory):
+		folders[os.path.relpath(directory, raw_image_directory)] = os.path.getmtime(directory)
+		for image_name in image_names:
+			image_info = parse_EVOS_name(image_name)
+			if image_info == None:
+				not_parsed.append(os.path.join(directory, image_name))
+				continue
+			image_info["path"] = os.path.join(directory, image_name)
+			images.append(image_info)
+	images.sort(key = EVOS_sort_key)
+	missing, duplicated = validate_EVOS_index(images)
+	index = {"version": EVOS_INDEX_VERSION, "folders": folders, "images": images, "missing": missing, "duplicated": duplicated, "not_parsed": not_parsed}
+
+	#Save the index with the paths relative to the folder, so it is still valid if the experiment folder is moved or opened from another PC
+	index_to_save = dict(index)
+	index_to_save["images"] = [dict(image_info, path=os.path.relpath(image_info["path"], raw_image_directory)) for image_info in images]
+	try:
+		with open(index_path + ".tmp", "w") as index_file:
+			json.dump(index_to_save, index_file)
+		if os.path.exists(index_path):
+			os.remove(index_path)
+		os.rename(index_path + ".tmp", index_path)
+	except (IOError, OSError):
+		print("The EVOS index could not be saved in " + index_path)
+
+	#Print a summary as a control in case there is an error or mismatch
+	print("EVOS index: " + str(len(images)) + " images, " + str(len(missing)) + " planes missing, " + str(len(duplicated)) + " duplicated, "
+		  + str(len(not_parsed)) + " files not recognized")
+	for missing_plane in missing[:20]:
+		print("Missing plane:", missing_plane)
+	return index
+
+#The scripts that only work with one area and timepoint at a time use the images as a list of [path, FOV, channel, slice], sorted by FOV, channel and slice
+def EVOS_images_data(index):
+	areas_and_timepoints = set((image_info["area"], image_info["timepoint"]) for image_info in index["images"])
+	if len(areas_and_timepoints) > 1:
+		raise ValueError("The folder has images from " + str(len(areas_and_timepoints)) + " areas/timepoints, this script needs one area and timepoint at a time")
+	if index["missing"]:
+		raise ValueError(str(len(index["missing"])) + " planes are missing, first one: " + str(index["missing"][0]))
+	return [[image_info["path"], image_info["FOV"], image_info["channel"], image_info["slice"]] for image_info in index["images"]]
@@ -0,0 +1,148 @@
+###############################################################################################################################################################
+'''
+
+Full name of script: Tile layout of EVOS M7000 scans for stitching [Version 01]
+
+Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-), it also works with Python 3
+
+Description: The EVOS M7000 numbers the fields of view (f00, f01...) in the order they were acquired, which is not the order of the grid. For example, with
+             "serpentine vertical" the first column is scanned going down, the second going up and so on. Before, the automated PLA processing scripts had a
+             hand-typed list to rename every merged FOV to its position in the grid (different for each slide size) and then used the Grid stitching of ImageJ.
+             This module computes the column and row of each FOV from the size of the grid and the acquisition order, and writes the TileConfiguration.txt
+             files read by the Grid/Collection stitching plug-in ("Positions from file"), so the merged images keep their names.
+
+             Big grids are stitched in blocks that use all the columns of a band of columns (grid_size_x of the scripts) and some of its rows. When the grid is
+             wider than one band, the bands are placed one below the other in the "stitching grid" (the rows of the second band continue after the last row of
+             the first one), same as the renamed images used before. A last band narrower than the others is not stitched. The rows of each block can be
+             given by the user or planned from the memory of ImageJ: the blocks are as tall as the memory allows (never across two bands), with the rows
+             shared evenly so no block is left with only one or two rows (the blocks differ by one row at most).
+
+             To use it from Fiji, keep it in this folder of the repository (the scripts look for it here) or copy it to Fiji.app/jars/Lib.
+
+Made by: Eduardo Reyes Alvarez
+
+Contact: eduardo_reyes09@hotmail.com
+
+Last update: Oct 17, 2026
+
+Version History:
+V01 (Oct 17, 2026): First version, replaces the lists of new names of 04-Image_Processing_SYTTMZ_automated_PLA.py and
+		    01-Image_Processing_PLA_SYEVE4_16Nov2022.py. It also gives the size, memory needed and name (from its rows) of each block stitched,
+			    and plans the blocks from the memory available. The positions saved can be read back, so the blocks are cut from the saved layout.
+
+'''
+
+###############################################################################################################################################################
+
+import os
+
+#Acquisition orders of the EVOS software, all of them start in the top left corner of the area (snake by columns is the "serpentine vertical" used in the lab)
+TILE_ORDERS = ["Snake by columns", "Snake by rows", "Raster by rows", "Raster by columns"]
+
+#The fused image of a block is counted twice for its memory, since the tiles being fused and the planes converted while saving take about the same again
+STITCHING_MEMORY_FACTOR = 2
+
+#Get the column and row in the grid of the FOV acquired in the position given (0 is the first FOV acquired)
+def tile_grid_position(acquisition_index, grid_width, grid_height, order="Snake by columns"):
+	if (acquisition_index < 0) or (acquisition_index >= grid_width*grid_height):
+		raise ValueError("FOV " + str(acquisition_index) + " is outside of a grid of " + str(grid_width) + "x" + str(grid_height))
+	if order in ("Snake by columns", "Raster by columns"):
+		column, row = divmod(acquisition_index, grid_height)
+		if (order == "Snake by columns") and (column % 2 == 1):
+			row = grid_height - 1 - row
+	elif order in ("Snake by rows", "Raster by rows"):
+		row, column = divmod(acquisition_index, grid_width)
+		if (order == "Snake by rows") and (row % 2 == 1):
+			column = grid_width - 1 - column
+	else:
+		raise ValueError("Unknown acquisition order: " + str(order) + " (options: " + ", ".join(TILE_ORDERS) + ")")
+	return column, row
+
+#Get the position of each FOV in the stitching grid as a dictionary {FOV: (column, row)}, where the grid is cut in bands of columns of the width to stitch
+#and the bands are placed one below the other. The FOVs of a last band narrower than the others are left out
+def stitching_grid_positions(number_of_FOVs, grid_width, grid_height, order="Snake by columns", band_width=None):
+	if number_of_FOVs != grid_width*grid_height:
+		raise ValueError(str(number_of_FOVs) + " FOVs were found, but a grid of " + str(grid_width) + "x" + str(grid_height) + " has " + str(grid_width*grid_height))
+	band_width = grid_width if band_width == None else min(band_width, grid_width)
+	positions = {}
+	for FOV in range(number_of_FOVs):
+		column, row = tile_grid_position(FOV, grid_width, grid_height, order)
+		band, band_column = divmod(column, band_width)
+		if (band+1)*band_width > grid_width:
+			continue
+		positions[FOV] = (band_column, band*grid_height + row)
+	return positions
+
+#Save a TileConfiguration.txt for the Grid/Collection stitching with the FOVs given as a list of (file name, column, row), placed in the grid with the
+#overlap given (in %) like the Grid stitching does. The positions start at the first column and row of the tiles given. Returns the path of the file saved
+def write_tile_configuration(save_path, tiles, tile_width, tile_height, tile_overlap, dimensions=2):
+	first_column = min(tile[1] for tile in tiles)
+	first_row = min(tile[2] for tile in tiles)
+	step_x = tile_width * (1 - tile_overlap/100.0)
+	step_y = tile_height * (1 - tile_overlap/100.0)
+	with open(save_path + ".tmp", "w") as configuration_file:
+		configuration_file.write("# Define the number of dimensions we are working on\n")
+		configuration_file.write("dim = " + str(dimensions) + "\n\n")
+		configuration_file.write("# Define the image coordinates\n")
+		for file_name, column, row in tiles:
+			coordinates = [(column - first_column)*step_x, (row - first_row)*step_y] + [0.0]*(dimensions - 2)
+			configuration_file.write(file_name + "; ; (" + ", ".join(str(round(coordinate, 3)) for coordinate in coordinates) + ")\n")
+	if os.path.exists(save_path):
+		os.remove(save_path)
+	os.rename(save_path + ".tmp", save_path)
+	return save_path
+
+#Read a TileConfiguration.txt saved by write_tile_configuration, with the same size of tiles and overlap. Returns the tiles as a list of (file name, column,
+#row), in the order of the file, and the number of dimensions
+def read_tile_configuration(configuration_path, tile_width, tile_height, tile_overlap):
+	step_x = tile_width * (1 - tile_overlap/100.0)
+	step_y = tile_height * (1 - tile_overlap/100.0)
+	tiles = []
+	dimensions = 2
+	with open(configuration_path) as configuration_file:
+		for line in configuration_file:
+			line = line.strip()
+			if line.startswith("dim"):
+				dimensions = int(line.split("=")[1])
+			elif line and not line.startswith("#"):
+				file_name, _, coordinates = [field.strip() for field in line.split(";")]
+				coordinates = [float(coordinate) for coordinate in coordinates.strip("()").split(",")]
+				tiles.append((file_name, int(round(coordinates[0]/step_x)), int(round(coordinates[1]/step_y))))
+	return tiles, dimensions
+
+#Size in pixels of the image stitched from the tiles given (from the first to the last column and row, plus the size of one tile)
+def stitched_size(tiles, tile_width, tile_height, tile_overlap):
+	columns = max(tile[1] for tile in tiles) - min(tile[1] for tile in tiles)
+	rows = max(tile[2] for tile in tiles) - min(tile[2] for tile in tiles)
+	return (int(round(columns * tile_width * (1 - tile_overlap/100.0))) + tile_width, int(round(rows * tile_height * (1 - tile_overlap/100.0))) + tile_height)
+
+#Memory in bytes needed to stitch the tiles given, with all their planes (channels x slices) fused into one image
+def stitching_memory(tiles, tile_width, tile_height, tile_overlap, bytes_per_pixel, planes):
+	width, height = stitched_size(tiles, tile_width, tile_height, tile_overlap)
+	return STITCHING_MEMORY_FACTOR * width * height * bytes_per_pixel * planes
+
+#Name of a stitched image from the rows of the stitching grid it has (counting from 0): rows 0 to 4 are Row_01_05
+def block_name(first_row, last_row):
+	return "Row_%02d_%02d" % (first_row+1, last_row+1)
+
+#Plan the blocks to stitch from the memory available (in bytes): every band of columns (band_rows tall) is cut in as few blocks as fit, with the rows
+#shared evenly between them, so no block is taller than what fits and the blocks differ by one row at most (the taller ones go last). For example, 51 rows
+#with memory for 5 give 11 blocks, four of 4 rows and seven of 5. Returns a list of (first row, last row, memory needed) counting the rows of the stitching
+#grid from 0. Raises an error if not even one row fits
+def plan_stitching_blocks(bands, band_rows, band_width, tile_width, tile_height, tile_overlap, bytes_per_pixel, planes, available_memory):
+	block_memory = lambda rows: stitching_memory([("", 0, 0), ("", band_width-1, rows-1)], tile_width, tile_height, tile_overlap, bytes_per_pixel, planes)
+	if block_memory(1) > available_memory:
+		raise RuntimeError("Not even one row of FOVs can be stitched with " + str(available_memory//1048576) + " MB (" + str(block_memory(1)//1048576) + " MB needed)")
+	most_rows = 1
+	while (most_rows < band_rows) and (block_memory(most_rows+1) <= available_memory):
+		most_rows = most_rows + 1
+	blocks_per_band = -(-band_rows // most_rows)
+	block_rows, extra_rows = divmod(band_rows, blocks_per_band)
+	blocks = []
+	for band in range(bands):
+		first_row = band*band_rows
+		for block in range(blocks_per_band):
+			rows = block_rows + (1 if block >= blocks_per_band - extra_rows else 0)
+			blocks.append((first_row, first_row + rows - 1, block_memory(rows)))
+			first_row = first_row + rows
+	return blocks
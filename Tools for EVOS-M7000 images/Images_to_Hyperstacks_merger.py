@@ -3,7 +3,7 @@
 ###############################################################################################################################################################
 '''
 
-Full name of script: Hyperstack generator for EVOS M700 images [Version 04]
+Full name of script: Hyperstack generator for EVOS M700 images [Version 05]
 
 Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-)
 
@@ -16,7 +16,7 @@ Made by: Eduardo Reyes Alvarez
 
 Contact: eduardo_reyes09@hotmail.com
 
-Last update: Apr 01, 2022
+Last update: Oct 17, 2026
 
 Version History:
 V01 (Mar 28, 2022): First working version of the script, it works but doesnt stack, merge and save the very last image. Code not fully annotated.
@@ -24,6 +24,14 @@ V02 (Mar 28, 2022): Several conditions and specific cases implemented, now it wo
 V03 (Apr 01, 2022): Works with any number of channels and order (selected by user menu). Code fully annotated.
 V04 (Nov 18, 2022): Minor directory change, now it asks for the experiment folder (like the other scripts) instead of the subfolder containing the images.
 		    Pending: Check additional exception scenarios, such as 1 Z-slice FOVs, random FOV numbering and slides/plates with multiple rows of wells.
+V05 (Oct 17, 2026): No windows are used anymore, the hyperstack of each FOV is built in memory from the sorted list of images (stack of each channel and colours
+		    like Merge Channels) and saved directly. The keyword only filters the images used. Works with 1 Z-slice FOVs and random FOV numbering.
+		    The images are grouped by FOV once and the FOVs are made in parallel by a pool of workers (sized by cores and memory), reporting FOVs/min.
+		    The names are parsed by the shared EVOS_file_index.py (one regular expression, check for missing planes and index saved next to the folder).
+		    The areas (A00) and timepoints (p00) are no longer ignored: a folder with several areas and/or a time lapse is done in a single run, making one
+		    5D hyperstack (channels, slices, timepoints) per area+FOV (named A00_FOV_n when there is more than one area).
+		    The hyperstacks are saved by the shared TIFF_writer.py, with the option to compress them (LZW or Deflate). BigTIFF is not offered, the
+		    hyperstacks are opened by ImageJ for the stitching.
 
 '''
 
@@ -31,12 +39,23 @@ V04 (Nov 18, 2022): Minor directory change, now it asks for the experiment folde
 ########################################## Import neccesary packages and make the interactive menu ############################################################
 
 import os
-import time
+import sys
 from datetime import datetime
-from ij import IJ, ImagePlus
-from ij import WindowManager
-from ij.plugin.frame import RoiManager
-from ij.gui import Roi
+from ij import IJ, ImagePlus, ImageStack, CompositeImage
+from ij.process import LUT
+from java.awt import Color
+from java.lang import Runtime
+from java.util.concurrent import Executors, ExecutorCompletionService, Callable, ExecutionException
+
+#The EVOS file names are parsed by EVOS_file_index.py and the images are saved by TIFF_writer.py (in the folder "Tools for EVOS-M7000 images" of the
+#repository, or copied to Fiji.app/jars/Lib)
+try:
+	from EVOS_file_index import build_EVOS_index
+	from TIFF_writer import save_TIFF
+except ImportError:
+	sys.path.append(os.path.dirname(os.path.abspath(globals().get("__file__", ""))))
+	from EVOS_file_index import build_EVOS_index
+	from TIFF_writer import save_TIFF
 
 #@ File    (label = "Experimental condition folder (must contain a -Raw Images- subfolder)", style = "directory") raw_image_directory
 #@ String (visibility=MESSAGE, value="For Brightfield select Gray (check images are saved as Mono and not RGB)", required=false) msg1
@@ -47,6 +66,8 @@ from ij.gui import Roi
 #@String   (label = "Channel 3 colour: ", style = "listBox", choices = { "", "Red", "Green", "Blue", "Gray", "Cyan", "Magenta" }) ch3_color
 #@String   (label = "Channel 4 colour: ", style = "listBox", choices = { "", "Red", "Green", "Blue", "Gray", "Cyan", "Magenta" }) ch4_color
 #@String   (label = "Image name keyword") name_key
+#@ String  (label="TIFF compression of the images saved", style = "listBox", choices = {"Uncompressed", "LZW", "Deflate"}) TIFF_compression
+#@ Integer (label="FOVs made in parallel (0 = automatic from cores and memory):", min=0, max=64, value=0) FOV_workers
 #@ String (visibility=MESSAGE, value="Script made by: Eduardo Reyes-Alvarez", required=false) msg3
 
 
@@ -61,65 +82,38 @@ raw_image_directory = os.path.join(raw_image_directory.getAbsolutePath() , "Raw
 
 #From the directory obtained in the input, we will scan all images and extract information from their name to sort, group, and open in order
 
-#The EVOS M700 saves the images in this format, which is retrieved as a string: ExperimentName_Bottom Slide_R_p00_z00_0_A00f00d0.tif
-	#The R means Raw (could be M for Merged or something else)
-	#The p00 might be for time lapses, as well as the _0_
-	#The z00 is the slice number, usually two numbers from 00 to 20 or 30 (99 or 3 numbers almost never)
-	#The A00 is the areas imaged. For a channel slide could vary from 00-05 (6 channels) but it is recommended to acquire and save one at the time
-	#The f00 is the number of fields of view imaged, and could  be 2 or 3 numbers (depending on settings 00-999)
-	#The d0 is the number of channel, which can be 0-4 given the capabilities of the equipment
+#The names are parsed by the shared EVOS_file_index.py, which gets the area, FOV, channel, slice and timepoint of each image with one regular expression,
+#checks that no plane is missing and keeps the index next to the folder (Raw Images_index.json) so the folder is only scanned again if it changes
+index = build_EVOS_index(raw_image_directory)
 
-#We will collect all the image information as sublists in this list
-images_data = []
-
-#Walk through all the images in the raw image folder (The only subfolder allowed MUST be named Merged and MUST be empty)
-for directory, subfolder, raw_images in os.walk(raw_image_directory):
-	for image in raw_images:
-		
-		#Get the name of the current image and remove the .tif from the name
-		trimmed_image_name = os.path.splitext(image)[0]
-			
-		#Remove the left side of the name delimited by _p00_z, to get something like: 00_0_A00f00d00
-		trimmed_image_name = trimmed_image_name.split("_p00_z")[1]
-		
-		#The last number is the channel number
-		channel = trimmed_image_name[-1]
-
-		#The first 2 numbers now correspond to the slice number
-		zslice = trimmed_image_name[0:2]
-			
-		#Since the FOV can be 2 or 3 numbers, we get it by trimming whatever is between the delimitors f__d
-		trimmed_image_name = trimmed_image_name.split("d")[0]
-		FOV = trimmed_image_name.split("f")[1]
-
-		#Now we append a list with the info of the current image to our main list, transforming the strings to integers to make processing easier
-		images_data.append([os.path.join(directory, image), int(FOV), int(channel), int(zslice)])
-
-#Once the data from all images has been extracted, we sort by FOV, then by channel, then by slice
-images_data.sort(key = lambda x : (x[1], x[2], x[3]))
+#All the images of the folder are used (every area and timepoint), sorted by area, FOV, timepoint, channel and slice
+images_data = index["images"]
 	
-#We print the FOV, channel and slice extracted from the images as a control in case there is an error or mismatch 
+#We print the area, FOV, timepoint, channel and slice extracted from the images as a control in case there is an error or mismatch 
 for i in images_data:
-	print("FOV:", i[1], "Channel:", i[2], "Slice:", i[3])
-
-#Retrieve the total number of FOVs for progress print statements
-total_FOVs = images_data[-1][1]
-
-#Based on the input from the user, we get ready the variable to pass the channels to merge (if needed)
-channels_to_merge = ""
-total_channels = 5
-#Iterate through the dropdowns displayed to the user
-for i,color_input in enumerate([ch0_color, ch1_color, ch2_color, ch3_color, ch4_color]):
-	#If the user didn't select anything, we have one less channel in total
-	if color_input == "":
-		total_channels = total_channels - 1
-		continue
-	#If the user selected a color, we iterate through the options we showed in the menu to find it
-	for ii, color_option in enumerate(["Red", "Green", "Blue", "Gray", "Cyan", "Magenta"]):
-		#Once we find what the color of each "...d" number of the images will be, we add it to the merge command
-		if color_input == color_option:
-			channels_to_merge = channels_to_merge + ("c"+str(ii+1)+"=[Stack_channel_"+str(i)+"] ")
-			break
+	print("Area:", i["area"], "FOV:", i["FOV"], "Timepoint:", i["timepoint"], "Channel:", i["channel"], "Slice:", i["slice"])
+
+#Keep only the images with the keyword in their name (as the "Images to Stack" title filter did before)
+images_data = [image_info for image_info in images_data if name_key in os.path.basename(image_info["path"])]
+
+#Based on the input from the user, we get the colour of each channel to merge. Same as Merge Channels, the channels of the hyperstack are ordered by
+#colour (c1=Red, c2=Green, c3=Blue, c4=Gray, c5=Cyan, c6=Magenta), not by the channel number of the EVOS
+colour_options = ["Red", "Green", "Blue", "Gray", "Cyan", "Magenta"]
+colour_LUTs = {"Red": Color.red, "Green": Color.green, "Blue": Color.blue, "Gray": Color.white, "Cyan": Color.cyan, "Magenta": Color.magenta}
+channels_to_merge = [(i, color_input) for i, color_input in enumerate([ch0_color, ch1_color, ch2_color, ch3_color, ch4_color]) if color_input != ""]
+channels_to_merge.sort(key = lambda x : colour_options.index(x[1]))
+total_channels = len(channels_to_merge)
+
+#Only the channels with a colour selected are used
+images_data = [image_info for image_info in images_data if image_info["channel"] in [channel for channel, colour in channels_to_merge]]
+
+#Slices and timepoints of each area (the areas of a mixed export can have different Z or T), every FOV must have all the ones of its area (and all the channels
+#selected)
+area_slices = {}
+area_timepoints = {}
+for image_info in images_data:
+	area_slices.setdefault(image_info["area"], set()).add(image_info["slice"])
+	area_timepoints.setdefault(image_info["area"], set()).add(image_info["timepoint"])
 
 #We also make a subdirectory in the folder to save all the hyperstacks made
 hyperstack_saving_path = os.path.join(raw_image_directory + "_Merged")
@@ -127,85 +121,108 @@ if not os.path.exists(hyperstack_saving_path):
 	os.makedirs(hyperstack_saving_path)
 
 ###############################################################################################################################################################
-#############################################################  Deciding the action to do for each image #######################################################
-
-#The previous section produces a list where all the slices for each channel for one FOV are ordered together, then next channel and so on, same for next FOV
-#We need to open all the images no matter what, we just need to decide when to do the stacking and merging+saving
-
-#We will use some control variables to notice when the current image corresponds to a different channel or FOV
-#For several exceptions, it is better to retrieve the first FOV and channel from the first image in our list
-control_FOV = images_data[0][1]
-control_channel = images_data[0][2]
-image_index = 0
-
-#In this loop we decide whether something is needed before opening an image (for the very 1st image, we compare to the control variables above)
-#Since we open the image at the very end of the loop, we need to enter one more time after the last picture was open, so we can stack, merge and save
-while image_index <= len(images_data):
-
-	#First, we get the list of directory, FOV, Ch, Slice for the current image
-	#The conditional here avoids an error once the image index is out of range of the image data elements
-	image_info = images_data[image_index] if image_index < len(images_data) else images_data[image_index-1]
-
-	#We extract the working FOV and channel for simplicity
-	current_FOV = image_info[1]
-	current_channel = image_info[2]
-
-	#Second, we check whether we need to make a stack right now (when Ch or FOV change or when we are in the very last image 
-	if control_FOV != current_FOV or control_channel != current_channel or image_index == len(images_data):
-		#If true, we make a stack selecting only newly opened images (with a string in the name) so we leave untouched existing stacks for other channels
-		IJ.run("Images to Stack", "name=Stack title="+name_key+" use")                                                          
-		stack = WindowManager.getImage("Stack")
-		stack.setTitle("Stack_channel_" + str(control_channel))
-
-		#If we did a stack then we are done with the previous channel and we need to update the control channel to be aware of future changes
-		control_channel = current_channel
-
-		#Since we combined lots of images into one (still existing), we empty some memory (may not be much)
-		IJ.run("Collect Garbage", "")
-
-		#Third, if the info of the image to be opened corresponds to a new FOV (or it is the very last image), merge all channels if needed, save and close
-		if control_FOV != current_FOV or image_index == len(images_data):
-
-			#If we only have one channel, we don't need to run the merge plugin (will cause an error)
-			if total_channels > 1:        
-				IJ.run("Merge Channels...",  channels_to_merge+"create")
-				#A small placeholder just in case it is too heavy
-				time.sleep(0.5)
-
-				#We select and get the merge before saving it
-				IJ.selectWindow("Composite")
-				hyperstack = IJ.getImage()
-				
-			#We save the stack or hyperstack
-			save_FOV_as = os.path.join(hyperstack_saving_path, "FOV_"+str(control_FOV))
-			image_to_save = hyperstack if total_channels > 1 else stack
-			IJ.saveAs(image_to_save, "Tiff", save_FOV_as)
-
-			#We print a counter to keep track of the progress with total number of FOVs and add a placeholder of 3s (for heavy images or slow computers)
-			print("Fields of view completed:", control_FOV+1, "/", total_FOVs+1) 
-			time.sleep(3)
-
-			#Once saved, we close everything, reset the memory and update the control FOV before opening the image
-			IJ.run("Close All")
-			IJ.run("Collect Garbage", "")
-			control_FOV = current_FOV
-
-			#After the final image is saved, we no longer need the loop so we exit it to prevent errors
-			if image_index == len(images_data):
-				break
+################################################################  Making the hyperstack of each FOV ###########################################################
+
+#The previous section produces a list where all the slices for each channel and timepoint for one FOV are ordered together, then next FOV and area
+#Instead of opening each image in a window and stacking/merging the windows by title, the hyperstack of each area+FOV is built in memory from that list with
+#all its channels, slices and timepoints (no windows are shown, so this also works when running ImageJ --headless)
+def make_FOV_hyperstack(FOV_name, FOV_images):
 	
-	#Fourth, once we collect the info, check for new stack, and check for new FOV... we open, show and get the current image
-	current_raw_image = IJ.openImage(image_info[0])
-	current_raw_image.show()
-	image_opened = WindowManager.getWindow(os.path.split(image_info[0])[1])
-
-	#If the image is heavy or PC resources low, ImageJ will take a moment to open it, so we use a placeholder checking every 0.1s until is open
-	while image_opened==None:
-		time.sleep(0.1)
+	#Find the plane of each channel, slice and timepoint. Every combination of its area must be there (a FOV missing a whole channel or slice would
+	#otherwise get other dimensions than the rest of the area), or the hyperstack would be mixed up
+	planes = dict(((image_info["channel"], image_info["slice"], image_info["timepoint"]), image_info["path"]) for image_info in FOV_images)
+	slices = sorted(area_slices[FOV_images[0]["area"]])
+	timepoints = sorted(area_timepoints[FOV_images[0]["area"]])
+	for channel, colour in channels_to_merge:
+		for zslice in slices:
+			for timepoint in timepoints:
+				if (channel, zslice, timepoint) not in planes:
+					raise IOError(FOV_name + " is missing channel " + str(channel) + ", slice " + str(zslice) + ", timepoint " + str(timepoint))
 	
-	#We print a counter to keep track of the progress for the images processed vs the total in the folder, and update the image index
-	print("Image:", image_index+1, "/", len(images_data))
-	image_index = image_index + 1
+	#Open the planes and add them to the hyperstack in the order ImageJ keeps them (channel, then slice, then timepoint), the channels go in the merge order
+	hyperstack_planes = None
+	calibration = None
+	for timepoint in timepoints:
+		for zslice in slices:
+			for channel, colour in channels_to_merge:
+				current_raw_image = IJ.openImage(planes[(channel, zslice, timepoint)])
+				if current_raw_image == None:
+					raise IOError("Could not open image " + planes[(channel, zslice, timepoint)])
+				if hyperstack_planes == None:
+					hyperstack_planes = ImageStack(current_raw_image.getWidth(), current_raw_image.getHeight())
+					calibration = current_raw_image.getCalibration()
+				hyperstack_planes.addSlice(os.path.basename(planes[(channel, zslice, timepoint)]), current_raw_image.getProcessor())
+				current_raw_image.close()
+	
+	#Give the dimensions to the hyperstack and the colours to each channel (same as Merge Channels with "create")
+	hyperstack = ImagePlus(FOV_name, hyperstack_planes)
+	hyperstack.setCalibration(calibration)
+	hyperstack.setDimensions(total_channels, len(slices), len(timepoints))
+	hyperstack.setOpenAsHyperStack(True)
+	if total_channels > 1:
+		hyperstack = CompositeImage(hyperstack, CompositeImage.COMPOSITE)
+		for channel_index, (channel, colour) in enumerate(channels_to_merge):
+			hyperstack.setChannelLut(LUT.createLutFromColor(colour_LUTs[colour]), channel_index+1)
+			hyperstack.setC(channel_index+1)
+			hyperstack.resetDisplayRange()
+		hyperstack.setC(1)
+	return hyperstack
+
+#Make, save and close the hyperstack of one area+FOV (everything used belongs to this FOV, so several FOVs can be done at the same time)
+class FOVTask(Callable):
+	def __init__(self, FOV_name, FOV_images):
+		self.FOV_name = FOV_name
+		self.FOV_images = FOV_images
+	def call(self):
+		hyperstack = make_FOV_hyperstack(self.FOV_name, self.FOV_images)
+		save_FOV_as = os.path.join(hyperstack_saving_path, self.FOV_name+".tif")
+		try:
+			save_TIFF(hyperstack, save_FOV_as, TIFF_compression)
+		finally:
+			hyperstack.close()
+		return self.FOV_name
+
+#Group the images of each area+FOV once (the list is already sorted). With one area the hyperstacks keep the names of previous versions (FOV_n), with more
+#areas (e.g. all the channels of a channel slide exported together) the area goes first (A00_FOV_n)
+areas = sorted(set(image_info["area"] for image_info in images_data))
+FOV_groups = {}
+for image_info in images_data:
+	FOV_name = ("FOV_" if len(areas) == 1 else image_info["area"] + "_FOV_") + str(image_info["FOV"])
+	FOV_groups.setdefault((image_info["area"], image_info["FOV"], FOV_name), []).append(image_info)
+FOVs = sorted(FOV_groups.keys())
+total_FOVs = len(FOVs)
+
+#The FOVs are independent, so they are done by a pool of workers: as many as cores (or the number given), as long as the free memory allows to hold them.
+#Each worker holds the raw images of one FOV in its hyperstack, which we take as ~2 times the size of the biggest FOV in the files
+runtime = Runtime.getRuntime()
+free_memory = runtime.maxMemory() - (runtime.totalMemory() - runtime.freeMemory())
+memory_per_FOV = 2 * max([sum(os.path.getsize(image_info["path"]) for image_info in FOV_images) for FOV_images in FOV_groups.values()] or [1])
+FOV_workers = FOV_workers if FOV_workers > 0 else int(max(1, min(runtime.availableProcessors(), free_memory // max(1, memory_per_FOV), total_FOVs)))
+print("Making " + str(total_FOVs) + " hyperstacks (" + str(len(areas)) + " areas) with " + str(FOV_workers) + " workers")
+
+#Send every FOV to the pool and collect them as they finish (in any order), printing the progress and the throughput. A FOV that fails (e.g. a missing plane)
+#is reported and the others continue
+FOV_executor = Executors.newFixedThreadPool(FOV_workers)
+FOV_tasks = ExecutorCompletionService(FOV_executor)
+for FOV in FOVs:
+	FOV_tasks.submit(FOVTask(FOV[2], FOV_groups[FOV]))
+FOV_executor.shutdown()
+merging_starting_time = datetime.now()
+failed_FOVs = 0
+try:
+	for FOV_index in range(total_FOVs):
+		try:
+			FOV_name = FOV_tasks.take().get()
+		except ExecutionException as error:
+			failed_FOVs = failed_FOVs + 1
+			print("A field of view failed:", error.getCause())
+			continue
+		
+		#We print a counter to keep track of the progress with total number of FOVs (the throughput only counts the FOVs saved)
+		merging_time = max(0.001, (datetime.now().getTime() - merging_starting_time.getTime())/60000.00)
+		print("Fields of view completed:", FOV_index+1, "/", total_FOVs, "("+FOV_name+",", round((FOV_index+1-failed_FOVs)/merging_time, 1), "FOVs/min)")
+finally:
+	FOV_executor.shutdownNow()
 
 ######################################################################### End of the script ###################################################################
 
@@ -214,7 +231,8 @@ ending_time = datetime.now()
 processing_time = (ending_time.getTime() - starting_time.getTime())/1000.00
 
 #Print a summary of the work done and time it required
-print("Images processed:", len(images_data), "Hyperstacks made:", total_FOVs+1, "Script processing time (min):", round(processing_time/60, 1))
+print("Images processed:", len(images_data), "Hyperstacks made:", total_FOVs - failed_FOVs, "Failed:", failed_FOVs, "Script processing time (min):", round(processing_time/60, 1))
+print("Throughput (FOVs/min):", round((total_FOVs - failed_FOVs)/max(0.001, processing_time/60), 1))
 
 ###############################################################################################################################################################
 ###############################################################################################################################################################
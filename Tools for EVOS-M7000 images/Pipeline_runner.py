@@ -0,0 +1,184 @@
+###############################################################################################################################################################
+'''
+
+Full name of script: Waits and stages for the image processing pipelines [Version 01]
+
+Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-)
+
+Description: The automated PLA processing scripts used to wait a fixed time (time.sleep of 2, 3, 5, 10 or 20 s) and collect the garbage after every step,
+             just in case the image was not open, the file was not saved or the memory was not freed yet. Those waits added many minutes to each folder and
+             still didn't prevent running out of memory with a slow disk. This module waits for the real signal instead and returns as soon as it happens:
+                 - wait_for_file: the file exists and its size doesn't change between two checks.
+                 - wait_for_image: an image (window) exists.
+                 - wait_for_memory: there is enough free memory in ImageJ (the garbage is collected only if there isn't).
+             Every wait is timed, the ones longer than 1 s are printed and print_wait_summary() prints the total time spent in each kind of wait.
+
+             It also runs the parts of a pipeline as stages (like make): each stage declares the files or folders it reads (inputs) and saves (outputs),
+             the stages are ordered so each one runs after the ones that make its inputs, and a stage is skipped when all its outputs exist and are newer
+             than all its inputs. The settings of each stage (from the menu) are saved as one more input, so changing them runs that stage again.
+
+             To use it from Fiji, keep it in this folder of the repository (the scripts look for it here) or copy it to Fiji.app/jars/Lib.
+
+Made by: Eduardo Reyes Alvarez
+
+Contact: eduardo_reyes09@hotmail.com
+
+Last update: Oct 17, 2026
+
+Version History:
+V01 (Oct 17, 2026): First version, replaces the fixed waits of 04-Image_Processing_SYTTMZ_automated_PLA.py and 01-Image_Processing_PLA_SYEVE4_16Nov2022.py,
+		    and runs the parts of 04-Image_Processing_SYTTMZ_automated_PLA.py as stages.
+
+'''
+
+###############################################################################################################################################################
+
+import os
+import json
+import time
+from java.lang import Runtime, System
+
+#Time between checks and the default time limits of each wait (in seconds)
+POLL_INTERVAL = 0.1
+FILE_TIMEOUT = 600
+IMAGE_TIMEOUT = 120
+MEMORY_TIMEOUT = 60
+
+#Total time and number of waits of each kind, printed by print_wait_summary()
+wait_totals = {}
+
+#Keep the time of one wait and print it if it was long enough to notice
+def log_wait(wait_kind, description, waited_time):
+	total_time, total_waits = wait_totals.get(wait_kind, (0.0, 0))
+	wait_totals[wait_kind] = (total_time + waited_time, total_waits + 1)
+	if waited_time >= 1:
+		print("Waited " + str(round(waited_time, 1)) + " s for " + description)
+	return waited_time
+
+#Print the total time spent waiting for each kind of signal
+def print_wait_summary():
+	for wait_kind in sorted(wait_totals):
+		total_time, total_waits = wait_totals[wait_kind]
+		print("Waits for " + wait_kind + ": " + str(total_waits) + ", total time (s): " + str(round(total_time, 1)))
+
+#Free memory of ImageJ in bytes (the part of the maximum memory that is not in use, ImageJ can still take it from the system)
+def free_memory():
+	runtime = Runtime.getRuntime()
+	return runtime.maxMemory() - runtime.totalMemory() + runtime.freeMemory()
+
+#Wait until the file exists and its size is the same in two checks in a row (a file still being written or copied keeps growing). Returns the time waited
+def wait_for_file(file_path, description=None, timeout=FILE_TIMEOUT):
+	starting_time = time.time()
+	last_size = -1
+	while True:
+		current_size = os.path.getsize(file_path) if os.path.isfile(file_path) else -1
+		if (current_size >= 0) and (current_size == last_size):
+			return log_wait("files", description or os.path.basename(file_path), time.time() - starting_time)
+		if time.time() - starting_time > timeout:
+			raise IOError("The file was not saved after " + str(timeout) + " s: " + file_path)
+		last_size = current_size
+		time.sleep(POLL_INTERVAL)
+
+#Wait until the function given returns an image (for example, lambda: WindowManager.getImage("Composite")). Returns the image
+def wait_for_image(get_image, description, timeout=IMAGE_TIMEOUT):
+	starting_time = time.time()
+	image = get_image()
+	while image == None:
+		if time.time() - starting_time > timeout:
+			raise RuntimeError("No image after " + str(timeout) + " s: " + description)
+		time.sleep(POLL_INTERVAL)
+		image = get_image()
+	log_wait("images", description, time.time() - starting_time)
+	return image
+
+#Wait until ImageJ has the free memory required (in bytes), collecting the garbage only when there isn't enough. If it is not freed before the time limit,
+#a warning is printed and the script continues (same as before, when it only collected the garbage). Returns the time waited
+def wait_for_memory(required_memory, description, timeout=MEMORY_TIMEOUT):
+	starting_time = time.time()
+	while free_memory() < required_memory:
+		if time.time() - starting_time > timeout:
+			print("Warning: only " + str(free_memory()//1048576) + " MB free of the " + str(required_memory//1048576) + " MB needed for " + description)
+			break
+		System.gc()
+		time.sleep(POLL_INTERVAL)
+	return log_wait("memory", description, time.time() - starting_time)
+
+###############################################################################################################################################################
+############################################################# Stages of a pipeline ############################################################################
+
+#Modification times of the files given (a folder counts as all the files inside it)
+def file_times(paths):
+	times = []
+	for path in paths:
+		if os.path.isdir(path):
+			for directory, subfolders, file_names in os.walk(path):
+				times.extend([os.path.getmtime(os.path.join(directory, file_name)) for file_name in file_names])
+		elif os.path.isfile(path):
+			times.append(os.path.getmtime(path))
+	return times
+
+#A stage is up to date when all its outputs exist and the oldest one is newer than the newest input
+def stage_is_up_to_date(stage):
+	if (not stage["outputs"]) or (not all(os.path.exists(path) for path in stage["outputs"])):
+		return False
+	input_times = file_times(stage["inputs"])
+	output_times = file_times(stage["outputs"])
+	if not output_times:
+		return False
+	return (not input_times) or (min(output_times) >= max(input_times))
+
+#Save the settings of a stage as JSON (only if they changed, so the file is newer than the outputs only when a setting is different). Returns its path,
+#to be added to the inputs of the stage
+def save_stage_settings(settings_directory, stage_name, settings):
+	if not os.path.exists(settings_directory):
+		os.makedirs(settings_directory)
+	settings_path = os.path.join(settings_directory, stage_name + " settings.json")
+	if os.path.isfile(settings_path):
+		try:
+			with open(settings_path) as settings_file:
+				if json.load(settings_file) == settings:
+					return settings_path
+		except ValueError:
+			pass
+	with open(settings_path, "w") as settings_file:
+		json.dump(settings, settings_file, indent=1, sort_keys=True)
+	return settings_path
+
+#Check if a path is the same or inside another one
+def is_inside(path, folder):
+	path = os.path.normcase(os.path.abspath(path))
+	folder = os.path.normcase(os.path.abspath(folder))
+	return (path == folder) or path.startswith(folder.rstrip(os.sep) + os.sep)
+
+#A stage depends on another one if it reads any of the outputs of the other one (or a folder where they are)
+def depends_on(stage, previous_stage):
+	return any(is_inside(output_path, input_path) or is_inside(input_path, output_path)
+			   for output_path in previous_stage["outputs"] for input_path in stage["inputs"])
+
+#Order the stages so each one runs after the stages that make its inputs (keeping the order given when it doesn't matter)
+def order_stages(stages):
+	ordered = []
+	pending = list(stages)
+	while pending:
+		for stage in pending:
+			if not any(depends_on(stage, other_stage) for other_stage in pending if other_stage is not stage):
+				break
+		else:
+			raise ValueError("The stages depend on each other in a circle: " + ", ".join(stage["name"] for stage in pending))
+		ordered.append(stage)
+		pending.remove(stage)
+	return ordered
+
+#Run the stages given as a list of dictionaries with their "name", "inputs" and "outputs" (lists of files or folders) and a "run" function, skipping the
+#ones that are up to date (all of them run if rerun_all is True). Since the stages run in order, the outputs of a stage that runs are newer than the
+#outputs of the next stages, so those run too. Returns the names of the stages that ran
+def run_stages(stages, rerun_all=False):
+	stages_run = []
+	for stage in order_stages(stages):
+		if (not rerun_all) and stage_is_up_to_date(stage):
+			print("Skipping " + stage["name"] + " (its images are newer than its inputs and settings)")
+			continue
+		print("Running " + stage["name"] + "...")
+		stage["run"]()
+		stages_run.append(stage["name"])
+	return stages_run
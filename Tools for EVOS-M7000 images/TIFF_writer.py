@@ -0,0 +1,119 @@
+###############################################################################################################################################################
+'''
+
+Full name of script: TIFF writer with compression options for hyperstacks, stitched images and projections [Version 01]
+
+Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-)
+
+Description: ImageJ only saves uncompressed TIFFs, so the folders with merged, stitched and processed images of one experiment can take hundreds of GB and
+             most of the time of the scripts is spent writing them to the server. This module is shared by the scripts that save those images
+             (Images_to_Hyperstacks_merger.py, the automated PLA processing scripts and the projection script), so all of them save the same way:
+                 - "Uncompressed": same file as File > Save As > Tiff (the default, readable by any program and by the tiled mode of PLA_quantification.py).
+                 - "LZW" or "Deflate": lossless compression done with the Bio-Formats library included in Fiji. The ImageJ description is kept in the file,
+                   so ImageJ still opens them as hyperstacks with the same channels, slices and frames, and the pixel size is saved as the resolution
+                   of the TIFF (the channel colours go back to the default ones). Deflate is usually smaller and LZW faster.
+                 - "BigTIFF": uncompressed BigTIFF (64-bit offsets) for stitched images over 4 GB. Open these with Bio-Formats (File > Import > Bio-Formats).
+             LZW and Deflate files that would be over 4 GB are also saved as BigTIFF. Use TIFF_writer_benchmark.py to compare the options with your images.
+             ImageJ can't open BigTIFFs (File > Open, Grid/Collection stitching, PLA_quantification.py), so BigTIFF is only used for the images that are only
+             read with Bio-Formats afterwards (the stitched images, read by Z_projector.py), given with allow_BigTIFF=True. Any other image saved with
+             "BigTIFF", or compressed but over 4 GB, is saved uncompressed by ImageJ instead (ImageJ writes and reads its own TIFFs over 4 GB).
+
+             To use it from Fiji, keep it in this folder of the repository (the scripts look for it here) or copy it to Fiji.app/jars/Lib.
+
+Made by: Eduardo Reyes Alvarez
+
+Contact: eduardo_reyes09@hotmail.com
+
+Last update: Oct 17, 2026
+
+Version History:
+V01 (Oct 17, 2026): First version of the writer, used by Images_to_Hyperstacks_merger.py, 04-Image_Processing_SYTTMZ_automated_PLA.py,
+		    01-Image_Processing_PLA_SYEVE4_16Nov2022.py and 02-Projection_for_manual_folders_PLA_SYEVE4_16Nov2022.py.
+
+'''
+
+###############################################################################################################################################################
+
+import os
+from ij import ImagePlus
+from ij.io import FileSaver
+from loci.common import DataTools
+from loci.common.services import ServiceFactory
+from loci.formats import MetadataTools, FormatTools
+from loci.formats.out import TiffWriter
+from loci.formats.services import OMEXMLService
+from loci.formats.tiff import IFD
+
+#Options shown in the menus of the scripts
+TIFF_COMPRESSIONS = ["Uncompressed", "LZW", "Deflate", "BigTIFF"]
+
+#A standard TIFF can't point to data after 4 GB, so bigger files are saved as BigTIFF (with some margin for the tags)
+BIGTIFF_LIMIT = 4000000000
+
+#Bio-Formats names for the compressions and pixel types of ImageJ
+BIO_FORMATS_COMPRESSIONS = {"LZW": TiffWriter.COMPRESSION_LZW, "Deflate": TiffWriter.COMPRESSION_ZLIB, "BigTIFF": TiffWriter.COMPRESSION_UNCOMPRESSED}
+BIO_FORMATS_PIXEL_TYPES = {ImagePlus.GRAY8: "uint8", ImagePlus.GRAY16: "uint16", ImagePlus.GRAY32: "float"}
+MICRONS_PER_UNIT = {"micron": 1.0, "microns": 1.0, "um": 1.0, u"\u00b5m": 1.0, "nm": 0.001, "mm": 1000.0, "cm": 10000.0, "inch": 25400.0, "inches": 25400.0}
+
+#Get the bytes of one plane in the byte order of the file
+def plane_bytes(processor, little_endian):
+	pixels = processor.getPixels()
+	if processor.getBitDepth() == 8:
+		return pixels
+	if processor.getBitDepth() == 16:
+		return DataTools.shortsToBytes(pixels, little_endian)
+	return DataTools.floatsToBytes(pixels, little_endian)
+
+#Save an image as TIFF with one of the TIFF_COMPRESSIONS (.tif is added to the path if it doesn't have it, same as IJ.saveAs). RGB images are always saved
+#uncompressed by ImageJ, and so are the images that need a BigTIFF if allow_BigTIFF is False (when the file is opened by ImageJ later). Returns the path of
+#the file saved
+def save_TIFF(image_to_save, save_path, compression="Uncompressed", allow_BigTIFF=False):
+	if not save_path.lower().endswith((".tif", ".tiff")):
+		save_path = save_path + ".tif"
+	uncompressed_size = image_to_save.getWidth() * image_to_save.getHeight() * (image_to_save.getBitDepth() // 8) * image_to_save.getStackSize()
+	if (not allow_BigTIFF) and ((compression == "BigTIFF") or (uncompressed_size > BIGTIFF_LIMIT)):
+		compression = "Uncompressed"
+	if (compression not in BIO_FORMATS_COMPRESSIONS) or (image_to_save.getType() not in BIO_FORMATS_PIXEL_TYPES):
+		if not FileSaver(image_to_save).saveAsTiff(save_path):
+			raise IOError("The image could not be saved: " + save_path)
+		return save_path
+
+	#Describe the planes for Bio-Formats (ImageJ keeps them in channel, slice, frame order)
+	little_endian = False
+	stack = image_to_save.getStack()
+	metadata = ServiceFactory().getInstance(OMEXMLService).createOMEXMLMetadata()
+	MetadataTools.populateMetadata(metadata, 0, image_to_save.getTitle(), little_endian, "XYCZT", BIO_FORMATS_PIXEL_TYPES[image_to_save.getType()],
+								   image_to_save.getWidth(), image_to_save.getHeight(), image_to_save.getNSlices(), image_to_save.getNChannels(),
+								   image_to_save.getNFrames(), 1)
+	
+	#The pixel size is written by Bio-Formats as the resolution of the TIFF (in microns, so the other units are converted)
+	calibration = image_to_save.getCalibration()
+	unit_in_microns = MICRONS_PER_UNIT.get(calibration.getUnit().lower())
+	if calibration.scaled() and (unit_in_microns != None):
+		metadata.setPixelsPhysicalSizeX(FormatTools.getPhysicalSizeX(calibration.pixelWidth * unit_in_microns), 0)
+		metadata.setPixelsPhysicalSizeY(FormatTools.getPhysicalSizeY(calibration.pixelHeight * unit_in_microns), 0)
+
+	#Bio-Formats adds the planes to an existing file, so it is written to a temporary file and then replaces the old one
+	temporary_path = save_path[:-len(os.path.splitext(save_path)[1])] + ".part.tif"
+	if os.path.exists(temporary_path):
+		os.remove(temporary_path)
+	TIFF_writer = TiffWriter()
+	TIFF_writer.setMetadataRetrieve(metadata)
+	TIFF_writer.setCompression(BIO_FORMATS_COMPRESSIONS[compression])
+	TIFF_writer.setBigTiff((compression == "BigTIFF") or (uncompressed_size > BIGTIFF_LIMIT))
+	TIFF_writer.setWriteSequentially(True)
+	TIFF_writer.setId(temporary_path)
+	try:
+		for plane_index in range(stack.getSize()):
+
+			#The first plane has the same description ImageJ writes, so ImageJ opens the file with the hyperstack dimensions
+			plane_tags = IFD()
+			if plane_index == 0:
+				plane_tags.putIFDValue(IFD.IMAGE_DESCRIPTION, FileSaver(image_to_save).getDescriptionString())
+			TIFF_writer.saveBytes(plane_index, plane_bytes(stack.getProcessor(plane_index+1), little_endian), plane_tags)
+	finally:
+		TIFF_writer.close()
+	if os.path.exists(save_path):
+		os.remove(save_path)
+	os.rename(temporary_path, save_path)
+	return save_path
@@ -0,0 +1,74 @@
+###############################################################################################################################################################
+'''
+
+Full name of script: Benchmark of the TIFF writer options [Version 01]
+
+Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-)
+
+Description: Saves one image (a merged hyperstack, a stitched image or a projection) with each option of TIFF_writer.py a few times in the folder selected
+             (ideally the same server/drive where the experiments are saved) and prints the average time to write it and the size of the file for each one,
+             so we can decide which option to use for each kind of image. The results are also saved as "TIFF writer benchmark.csv" in that folder and the
+             test files are deleted at the end.
+
+Made by: Eduardo Reyes Alvarez
+
+Contact: eduardo_reyes09@hotmail.com
+
+Last update: Oct 17, 2026
+
+Version History:
+V01 (Oct 17, 2026): First version of the benchmark.
+
+'''
+
+###############################################################################################################################################################
+########################################## Import neccesary packages and make the interactive menu ############################################################
+
+import os
+import sys
+import csv
+from datetime import datetime
+from ij import IJ
+
+#The TIFF writer is in TIFF_writer.py (in the folder "Tools for EVOS-M7000 images" of the repository, or copied to Fiji.app/jars/Lib)
+try:
+	from TIFF_writer import save_TIFF, TIFF_COMPRESSIONS
+except ImportError:
+	sys.path.append(os.path.dirname(os.path.abspath(globals().get("__file__", ""))))
+	from TIFF_writer import save_TIFF, TIFF_COMPRESSIONS
+
+#@ File    (label = "Image to save", style = "file") image_path
+#@ File    (label = "Folder to save the test files (e.g. on the lab server)", style = "directory") benchmark_directory
+#@ Integer (label="Repetitions per option", min=1, max=20, value=3) repetitions
+#@ String (visibility=MESSAGE, value="Script made by: Eduardo Reyes-Alvarez", required=false) msg1
+
+benchmark_directory = benchmark_directory.getAbsolutePath()
+image_to_save = IJ.openImage(image_path.getAbsolutePath())
+if image_to_save == None:
+	raise IOError("Could not open image " + image_path.getAbsolutePath())
+
+###############################################################################################################################################################
+##################################################################### Save with each option ###################################################################
+
+benchmark_results = []
+for compression in TIFF_COMPRESSIONS:
+	writing_times = []
+	for repetition in range(repetitions):
+		starting_time = datetime.now()
+		saved_path = save_TIFF(image_to_save, os.path.join(benchmark_directory, "TIFF writer benchmark_" + compression + ".tif"), compression, True)
+		writing_times.append((datetime.now().getTime() - starting_time.getTime())/1000.00)
+	file_size = os.path.getsize(saved_path)/1048576.0
+	os.remove(saved_path)
+	benchmark_results.append((compression, round(sum(writing_times)/len(writing_times), 2), round(min(writing_times), 2), round(file_size, 1)))
+	print("Option:", compression, "Average time (s):", benchmark_results[-1][1], "Size (MB):", benchmark_results[-1][3])
+
+#Save the results next to the test files
+with open(os.path.join(benchmark_directory, "TIFF writer benchmark.csv"), "wb") as benchmark_file:
+	benchmark_writer = csv.writer(benchmark_file)
+	benchmark_writer.writerow(("Option", "Average writing time (s)", "Fastest writing time (s)", "File size (MB)"))
+	benchmark_writer.writerows(benchmark_results)
+image_to_save.close()
+
+###############################################################################################################################################################
+###############################################################################################################################################################
+###############################################################################################################################################################
@@ -0,0 +1,125 @@
+###############################################################################################################################################################
+'''
+
+Full name of script: Streaming Z-projection of hyperstacks saved as TIFF [Version 01]
+
+Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-)
+
+Description: Image > Stacks > Z Project needs the whole hyperstack open, so the stitched images (1-3 GB or more) needed almost all the memory of an 8 GB PC
+             and the scripts had to wait and collect the garbage after each one. This module makes the same projections (Max Intensity, Average Intensity
+             and Sum Slices, with the same bit depth and titles as Z Project) reading one plane at a time from the file and keeping one running result per
+             channel, so the memory needed is the projection plus one plane. It is shared by the automated PLA processing scripts and the projection script.
+
+             The files are read as a virtual stack by ImageJ (uncompressed, LZW and Deflate TIFFs, including the ones saved by TIFF_writer.py), or with the
+             Bio-Formats library included in Fiji for the files ImageJ can't read that way (BigTIFF).
+
+             To use it from Fiji, keep it in this folder of the repository (the scripts look for it here) or copy it to Fiji.app/jars/Lib.
+
+Made by: Eduardo Reyes Alvarez
+
+Contact: eduardo_reyes09@hotmail.com
+
+Last update: Oct 17, 2026
+
+Version History:
+V01 (Oct 17, 2026): First version of the projector, used by 04-Image_Processing_SYTTMZ_automated_PLA.py, 01-Image_Processing_PLA_SYEVE4_16Nov2022.py and
+		    02-Projection_for_manual_folders_PLA_SYEVE4_16Nov2022.py.
+
+'''
+
+###############################################################################################################################################################
+
+import os
+from ij import IJ, ImagePlus, ImageStack, CompositeImage
+from ij.measure import Calibration
+from ij.process import Blitter, FloatProcessor
+from loci.formats import ChannelSeparator, MetadataTools
+from loci.plugins.util import ImageProcessorReader, LociPrefs
+
+#Options shown in the menus of the scripts and the prefix Z Project gives to the title of each one
+Z_PROJECTIONS = ["Max Intensity", "Average Intensity", "Sum Slices"]
+PROJECTION_PREFIXES = {"Max Intensity": "MAX_", "Average Intensity": "AVG_", "Sum Slices": "SUM_"}
+
+#Check the header of the file, ImageJ only reads standard TIFFs (magic number 42) as a virtual stack, not BigTIFFs (43) or other formats
+def is_standard_TIFF(image_path):
+	with open(image_path, "rb") as image_file:
+		header = bytearray(image_file.read(4))
+	if len(header) < 4:
+		return False
+	if header[:2] == bytearray(b"II"):
+		return header[2] + 256*header[3] == 42
+	if header[:2] == bytearray(b"MM"):
+		return 256*header[2] + header[3] == 42
+	return False
+
+#Open a hyperstack without reading its pixels. Returns a dictionary with its dimensions, title, calibration and colours (LUTs), a function to read one plane
+#get_plane(channel, slice, frame) (counting from 1, like ImageJ) and a function to close the file
+def open_planes(image_path):
+	image = IJ.openVirtual(image_path) if is_standard_TIFF(image_path) else None
+	if image != None:
+		return {"channels": image.getNChannels(), "slices": image.getNSlices(), "frames": image.getNFrames(), "title": image.getTitle(),
+				"calibration": image.getCalibration(), "LUTs": image.getLuts() if image.isComposite() else [],
+				"get_plane": lambda channel, zslice, frame: image.getStack().getProcessor(image.getStackIndex(channel, zslice, frame)),
+				"close": image.close}
+
+	#Bio-Formats reads the BigTIFFs (or other formats) one plane at a time
+	metadata = MetadataTools.createOMEXMLMetadata()
+	reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+	reader.setMetadataStore(metadata)
+	reader.setId(image_path)
+	calibration = Calibration()
+	if metadata.getPixelsPhysicalSizeX(0) != None:
+		calibration.pixelWidth = metadata.getPixelsPhysicalSizeX(0).value().doubleValue()
+		calibration.pixelHeight = metadata.getPixelsPhysicalSizeY(0).value().doubleValue()
+		calibration.setUnit("micron")
+	return {"channels": reader.getSizeC(), "slices": reader.getSizeZ(), "frames": reader.getSizeT(), "title": os.path.basename(image_path),
+			"calibration": calibration, "LUTs": [],
+			"get_plane": lambda channel, zslice, frame: reader.openProcessors(reader.getIndex(zslice-1, channel-1, frame-1))[0],
+			"close": reader.close}
+
+#Make the Z-projection of a hyperstack saved in a file, reading one plane at a time. Max Intensity keeps the bit depth of the image, Average Intensity and
+#Sum Slices give 32-bit images (same as Z Project). Returns the projection as an ImagePlus (not shown), with one slice and the same channels and frames
+def project_Z(image_path, method="Max Intensity"):
+	if method not in PROJECTION_PREFIXES:
+		raise ValueError("Unknown projection: " + str(method) + " (options: " + ", ".join(Z_PROJECTIONS) + ")")
+	planes = open_planes(image_path)
+	projection_stack = None
+	try:
+		for frame in range(1, planes["frames"]+1):
+			for channel in range(1, planes["channels"]+1):
+
+				#Keep a running result for the channel, the planes read are released once they are added to it
+				projection = None
+				for zslice in range(1, planes["slices"]+1):
+					plane = planes["get_plane"](channel, zslice, frame)
+					if method == "Max Intensity":
+						if projection == None:
+							projection = plane.duplicate()
+						else:
+							projection.copyBits(plane, 0, 0, Blitter.MAX)
+					else:
+						if projection == None:
+							projection = FloatProcessor(plane.getWidth(), plane.getHeight())
+						projection.copyBits(plane.convertToFloat(), 0, 0, Blitter.ADD)
+				if method == "Average Intensity":
+					projection.multiply(1.0/planes["slices"])
+				projection.resetMinAndMax()
+				if projection_stack == None:
+					projection_stack = ImageStack(projection.getWidth(), projection.getHeight())
+				projection_stack.addSlice(projection)
+	finally:
+		planes["close"]()
+
+	#Put the projections back together as a hyperstack with the calibration and colours of the original image
+	projected_image = ImagePlus(PROJECTION_PREFIXES[method] + planes["title"], projection_stack)
+	projected_image.setDimensions(planes["channels"], 1, planes["frames"])
+	projected_image.setCalibration(planes["calibration"].copy())
+	if planes["channels"] > 1:
+		projected_image = CompositeImage(projected_image, CompositeImage.COMPOSITE)
+		if len(planes["LUTs"]) == planes["channels"]:
+			projected_image.setLuts(planes["LUTs"])
+		for channel in range(1, planes["channels"]+1):
+			projected_image.setPositionWithoutUpdate(channel, 1, 1)
+			projected_image.resetDisplayRange()
+		projected_image.setPositionWithoutUpdate(1, 1, 1)
+	return projected_image
@@ -1,7 +1,7 @@
 ######################################################################################################################################################################################
 '''
 
-Full name of script: Proximity Ligation Assay (PLA) quantification  [Version 04]
+Full name of script: Proximity Ligation Assay (PLA) quantification  [Version 05]
 
 Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-)
 
@@ -18,7 +18,7 @@ Made by: Eduardo Reyes Alvarez
 
 Contact: eduardo_reyes09@hotmail.com
 
-Last update: December 11, 2022
+Last update: October 17, 2026
 
 Version History:
 V01 (Jun 01, 2021): First working version of the script. Requires a specific folder structure and 2 sets of ROIs per cell of interest. Some outputs are optional
@@ -35,27 +35,75 @@ V03 (Aug  21,2022): Changed the folder structure that the script requires (compa
                     produced by this script for easier result presentation.
 V04 (Dec 11, 2022): Added short parameter that needs to be passed on to the Analyze Particles plug-in for images that are calibrated in inches. Added option to pass a set
                     of particle size and circularity different for each method. Also, there is now a Colab notebook to generate a pptx from the outputs of this script.
+V05 (Oct 17, 2026): The quantification is now done in a single pass, each ROI is opened once and both methods count particles on in-memory masks made from the same
+                    background-subtracted PLA channel (no windows, Results or Summary tables). Fixed the parsing of different circularities for each method.
+                    Removed the fixed waits after saving each cropped cell, the JPEGs are written synchronously and checked on disk instead. The cropped cells are
+                    saved by a pool of background threads (with a capped queue) while the next ROIs are processed. The cropping no longer uses the ROI manager or
+                    any window (ROIs are read from their files and cropped in memory), so the whole script can run with ImageJ --headless. The ROIs of each image
+                    are read once and kept in memory, with the option to save them as a single RoiSet.zip per image for faster reading in the next runs (the
+                    ROIs are read by the shared ROI_sets.py, also used by Tool 03).
+                    The code is now enclosed into functions to enable batch mode: instead of one condition folder, the user can select a root folder (all its
+                    subfolders with the images folder are processed, each one can have a "PLA settings.json" with its own parameters) or a CSV/JSON manifest with
+                    one row per condition folder and the parameters to use (any missing parameter is taken from the menu). The conditions are processed one after
+                    the other without asking again, and the result of each one is written to "Batch status.csv" (next to the manifest or in the root folder).
+                    The results of each ROI are written to Results.csv as soon as the ROI is quantified, and a checkpoint keeps track of the images (and ROIs)
+                    completed. If a run crashes, running it again with "Resume" skips the completed images and the cells already cropped (an image is only
+                    completed once its crops are saved, and it is quantified again if its ROIs changed; the images are named by their path in the folder).
+                    Added a parameter sweep mode: sizes, circularities, threshold methods and prominences can be given as lists separated by ";", each image is
+                    opened and background-subtracted once and every combination is counted on the same masks, with all the counts in "Sweep results.csv" (the
+                    masks are made as in the quantification; the tiled mode, Resume and images in parallel don't apply to the sweep).
+                    The background-subtracted PLA channels are kept in a cache ("Quantification/PLA channel cache", named by the content of the image, the channel and
+                    the radius), so re-running the quantification with other parameters or ROIs skips the rolling ball.
+                    The images can be quantified in parallel (as many at a time as cores and free memory allow, or the number given), and their results are added to
+                    Results.csv in the same order as when quantified one by one.
+                    Optionally, every particle of each image (position, area, circularity and the cell it belongs to) is saved in "Quantification/Particle tables",
+                    so the cells can be re-counted with other size/circularity ranges in seconds with PLA_requantification.py (Python + NumPy, no Fiji needed).
+                    Added a tiled mode for stitched images bigger than the memory: for uncompressed TIFFs only the region of each cell (plus a margin for the rolling
+                    ball) is read from the file, and the background subtraction and masks are done on it. Note that the auto-threshold is then calculated for each
+                    cell region instead of the whole image, so the Threshold counts can differ from the normal mode (Find Maxima is barely affected).
 '''
 
 ######################################################################################################################################################################################
 ################################################## Import neccesary packages and make the interactive menu ###########################################################################
 
 import os
-import time
+import sys
 import csv
+import json
+import hashlib
+import traceback
+from threading import Lock
 from datetime import datetime
-from ij import IJ, ImagePlus
-from ij import WindowManager
-from ij.measure import ResultsTable
-from ij.plugin.frame import RoiManager
-from ij.gui import Roi
+from ij import IJ, ImagePlus, ImageStack
+from ij import Prefs
+from ij.measure import ResultsTable, Measurements, Calibration
+from ij.plugin import ChannelSplitter, Duplicator
+from ij.plugin.filter import BackgroundSubtracter, MaximumFinder, EDM, ParticleAnalyzer
+from ij.process import ImageProcessor
+from ij.io import FileSaver, TiffDecoder, FileInfo, FileOpener, ImageReader
+from java.lang import Runnable, Runtime
+from java.lang import Exception as JavaException
+from java.util.concurrent import ThreadPoolExecutor, ArrayBlockingQueue, TimeUnit, Executors, Callable
+from java.io import ByteArrayInputStream, RandomAccessFile
+from jarray import zeros
 
-#@ File    (label = "Experimental condition folder:", style = "directory") exp_condition_folder
+#The ROIs are read by ROI_sets.py (in the same folder of the repository as this script, or copied to Fiji.app/jars/Lib)
+try:
+    from ROI_sets import load_ROI_set as read_ROI_set
+except ImportError:
+    sys.path.append(os.path.dirname(os.path.abspath(globals().get("__file__", ""))))
+    from ROI_sets import load_ROI_set as read_ROI_set
+
+#@ File    (label = "Experimental condition folder:", style = "directory", required=false) exp_condition_folder
 #@ String  (label="Name of folder containing images to crop/quantify:", description="Name field") source_images_folder
 #@ Integer (label = "PLA channel number", style = "slider", min=1, max=5, stepSize=1) PLA_channel
 #@ String  (visibility=MESSAGE, value="Particle counting is usually improved by background subtraction with low radius", required=false) msg1
 #@ Integer (label="Rolling radius for PLA background subtraction:", min=1, max=50, description="<10 recommended, test your images first", value=3) PLA_background_radius
 #@ Boolean (label="Crop cells", style = "checkbox") Crop_cells
+#@ Boolean (label="Resume from the last run (skip images and cropped cells already done)", style = "checkbox", value=true) Resume
+#@ Integer (label="Images quantified in parallel (0 = automatic from cores and memory):", min=0, max=64, value=0) Image_workers
+#@ Boolean (label="Keep the background-subtracted PLA channels in a cache (faster re-runs with other parameters)", style = "checkbox", value=true) Cache_PLA_channels
+#@ Boolean (label="Save the ROIs of each image as a RoiSet.zip (faster to read from network drives)", style = "checkbox", value=false) Save_ROI_sets
 #@ String  (choices={"-", "Threshold + Analyze Particles", "Find Maxima + Analyze Particles", "Both"}, style="listBox") Quantification
 #@ String  (visibility=MESSAGE, value="Parameters for quantification:", required=false) msg2
 #@ String  (visibility=MESSAGE, value="For different size+circularity between methods, pass T first a comma and then FM", required=false) msg3
@@ -63,31 +111,364 @@ from ij.gui import Roi
 #@ String  (label="Particle circuarity:", description="0.00-1.00", value="0.10-1.00") particle_circularity
 #@ String  (label = "Threshold method (if selected)", style = "listBox", choices = { "-","Default", "Huang", "Intermodes","IsoData", "IJ_IsoData", "Li", "MaxEntropy", "Mean", "MinError", "Minimum", "Moments", "Otsu", "Percentile", "RenyiEntropy", "Shanbhag", "Triangle", "Yen"}) threshold_method
 #@ Integer (label="Prominence for Maxima (if selected):", min=1, max=100000, description="Test this number in a subset of images beforehand", value=500) prominence
+#@ Boolean (label="Tiled mode: read only the region of each cell (for images bigger than the memory, the auto-threshold is done per cell)", style = "checkbox", value=false) Tiled_processing
+#@ Boolean (label="Save a table with all the particles of each image (to re-count with other sizes/circularities)", style = "checkbox", value=false) Particle_tables
+#@ Boolean (label="Parameter sweep (count with every combination of the values below, separated by ;)", style = "checkbox", value=false) Parameter_sweep
+#@ String  (label="Threshold methods to sweep:", description="Default;Otsu;Li (empty = the method above)", value="", required=false) sweep_threshold_methods
+#@ String  (label="Prominences to sweep:", description="250;500;1000 (empty = the prominence above)", value="", required=false) sweep_prominences
+#@ String  (visibility=MESSAGE, value="Batch mode (optional): select a root folder with one subfolder per condition, or a CSV/JSON manifest", required=false) msg5
+#@ File    (label = "Batch root folder:", style = "directory", required=false) batch_root_folder
+#@ File    (label = "Batch manifest (CSV/JSON):", style = "file", required=false) batch_manifest
 #@ String  (visibility=MESSAGE, value="Script made by: Eduardo Reyes-Alvarez", required=false) msg4
 
 #Start the timer
 whole_script_starting_time = datetime.now()
 
-#Get full path of the folder containing the images and prepare the other directories
-exp_condition_folder = exp_condition_folder.getAbsolutePath()
-raw_image_directory =os.path.join(exp_condition_folder, source_images_folder)
-ROIs_directory = os.path.join(exp_condition_folder, "ROIs")
-summary_ppt_cells_directory = os.path.join(exp_condition_folder, "Cropped cells")
+#Collect the parameters given in the menu, which are used for a single condition or as the defaults of the batch mode
+menu_condition = {"exp_condition_folder": exp_condition_folder.getAbsolutePath() if exp_condition_folder != None else None,
+                  "source_images_folder": source_images_folder, "PLA_channel": PLA_channel, "PLA_background_radius": PLA_background_radius,
+                  "Crop_cells": Crop_cells, "Quantification": Quantification, "particle_sizes": particle_sizes, "particle_circularity": particle_circularity,
+                  "threshold_method": threshold_method, "prominence": prominence, "Resume": Resume, "Cache_PLA_channels": Cache_PLA_channels,
+                  "Save_ROI_sets": Save_ROI_sets, "Image_workers": Image_workers, "Particle_tables": Particle_tables, "Tiled_processing": Tiled_processing,
+                  "Parameter_sweep": Parameter_sweep,
+                  "sweep_threshold_methods": sweep_threshold_methods if sweep_threshold_methods != None else "",
+                  "sweep_prominences": sweep_prominences if sweep_prominences != None else ""}
+
+######################################################################################################################################################################################
+############################################################################ Helpers used by all sections ############################################################################
+
+#The JPEG is written synchronously, so instead of waiting a fixed time after saving we just confirm the file landed on disk before moving on. It is written to a
+#temporary name first, so a crash never leaves a half-written JPEG that a resumed run would take as done
+def save_jpeg(image_to_save, save_path):
+    saved = FileSaver(image_to_save).saveAsJpeg(save_path + ".part")
+    if not (saved and os.path.isfile(save_path + ".part") and os.path.getsize(save_path + ".part") > 0):
+        raise IOError("The image could not be saved: " + save_path)
+    replace_file(save_path + ".part", save_path)
+
+#Replace a file with a new version written next to it (os.rename can't overwrite on Windows)
+def replace_file(new_path, old_path):
+    if os.path.exists(old_path):
+        os.remove(old_path)
+    os.rename(new_path, old_path)
+
+#A file that exists and is not empty was already saved by a previous run
+def already_saved(file_path):
+    return os.path.isfile(file_path) and os.path.getsize(file_path) > 0
+
+#The cropped cells are encoded and saved by a small pool of background threads while the main loop moves on to the next ROI. The queue of crops waiting to be saved
+#is capped, so if the writers fall behind, the main loop saves that crop itself instead of piling up images in memory (important for 8gb PCs)
+JPEG_writer_threads = max(1, min(4, Runtime.getRuntime().availableProcessors() - 1))
+JPEG_writer_queue_size = 32
+JPEG_writer_errors = []
+JPEG_writer = ThreadPoolExecutor(JPEG_writer_threads, JPEG_writer_threads, 60, TimeUnit.SECONDS, ArrayBlockingQueue(JPEG_writer_queue_size), 
+                                 ThreadPoolExecutor.CallerRunsPolicy())
+JPEG_writer.allowCoreThreadTimeOut(True)
+
+#Each task saves one crop (its own duplicated image, so nothing is shared with the main loop) and closes it when done
+class JpegWriterTask(Runnable):
+    def __init__(self, image_to_save, save_path):
+        self.image_to_save = image_to_save
+        self.save_path = save_path
+    def run(self):
+        try:
+            save_jpeg(self.image_to_save, self.save_path)
+        except (Exception, JavaException) as error:
+            JPEG_writer_errors.append(str(error))
+        finally:
+            self.image_to_save.close()
+
+#Wait for all the crops still in the queue to be saved and report any that failed
+def drain_JPEG_writer():
+    JPEG_writer.shutdown()
+    while not JPEG_writer.awaitTermination(10, TimeUnit.SECONDS):
+        print("Waiting for " + str(JPEG_writer.getQueue().size() + JPEG_writer.getActiveCount()) + " cropped cells to be saved...")
+    for error in JPEG_writer_errors:
+        print(error)
+
+#The ROIs of each image are decoded once into a list of (file name, ROI) pairs kept in memory by image name, instead of opening each small .roi file every time.
+#The list is only read again if the folder was modified after it was read, and it can also be saved as a single "<image>_RoiSet.zip" next to the folder of the
+#image, so the next runs read one file per image (instead of hundreds, which is slow on network drives) as long as the zip is newer than the folder
+ROI_sets_cache = {}
+
+def load_ROI_set(ROI_sets_directory, image_name, save_ROI_set=False):
+    ROI_folder = os.path.join(ROI_sets_directory, image_name)
+    folder_time = os.path.getmtime(ROI_folder) if os.path.isdir(ROI_folder) else None
+    
+    #Use the ROIs already in memory if the folder has not changed since they were read
+    cached_ROI_set = ROI_sets_cache.get((ROI_sets_directory, image_name))
+    if (cached_ROI_set != None) and (cached_ROI_set[0] == folder_time):
+        return cached_ROI_set[1]
+    
+    #Read the zip if it is up to date, otherwise the ROIs folder (shared with Tool 03 by ROI_sets.py, so both read the ROIs in the same order)
+    ROI_set = read_ROI_set(ROI_sets_directory, image_name, save_ROI_set)
+    ROI_sets_cache[(ROI_sets_directory, image_name)] = (folder_time, ROI_set)
+    return ROI_set
+
+
+#The quantification keeps a checkpoint in "Quantification/Checkpoint.json" with the parameters used and the images (with their ROIs) already added to Results.csv.
+#It is rewritten after every image, so if the run crashes, the next run with the same parameters skips those images instead of starting over
+def read_checkpoint(checkpoint_path, checkpoint_parameters):
+    if os.path.isfile(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint["parameters"] == checkpoint_parameters:
+            return checkpoint
+        print("The parameters changed since the last run, the quantification will start over")
+    return {"parameters": checkpoint_parameters, "completed_images": {}}
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    with open(checkpoint_path + ".tmp", "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=1)
+    replace_file(checkpoint_path + ".tmp", checkpoint_path)
+
+#Start Results.csv again keeping only the rows of the images completed (rows of an image interrupted halfway are dropped, that image is done again)
+def restart_results(results_path, column_titles, completed_images):
+    kept_rows = []
+    if completed_images and os.path.isfile(results_path):
+        with open(results_path, "rb") as results_file:
+            kept_rows = [row for row in list(csv.reader(results_file))[1:] if row and (row[0] in completed_images)]
+    with open(results_path + ".tmp", "wb") as results_file:
+        writer = csv.writer(results_file)
+        writer.writerow(column_titles)
+        writer.writerows(kept_rows)
+    replace_file(results_path + ".tmp", results_path)
+
+#The background-subtracted PLA channels are cached by content: the name of each cached TIFF has the SHA-1 of the source image, the channel and the radius, so
+#re-runs with other thresholds, prominences or ROIs just open it, and an image edited or replaced gets a new one. Hashing a stitched image takes a while, so the
+#hashes are kept in "File hashes.json" (by path, size and modification time) and only recomputed when the source file changes
+PLA_cache_file_hashes = {}
+PLA_cache_lock = Lock()
+PLA_cache_file_locks = {}
+
+def file_hash(file_path, cache_directory):
+    file_key = file_path + "|" + str(os.path.getsize(file_path)) + "|" + str(int(os.path.getmtime(file_path)))
+    with PLA_cache_lock:
+        if cache_directory not in PLA_cache_file_hashes:
+            hashes_path = os.path.join(cache_directory, "File hashes.json")
+            PLA_cache_file_hashes[cache_directory] = {}
+            if os.path.isfile(hashes_path):
+                with open(hashes_path) as hashes_file:
+                    PLA_cache_file_hashes[cache_directory] = json.load(hashes_file)
+        file_hashes = PLA_cache_file_hashes[cache_directory]
+        file_lock = PLA_cache_file_locks.setdefault(file_key, Lock())
+    
+    #Only one worker hashes each file (another one quantifying the same file waits for it and takes its hash), different files are hashed at the same time
+    with file_lock:
+        with PLA_cache_lock:
+            if file_key in file_hashes:
+                return file_hashes[file_key]
+        sha1 = hashlib.sha1()
+        with open(file_path, "rb") as source_file:
+            for file_chunk in iter(lambda: source_file.read(1 << 20), ""):
+                sha1.update(file_chunk)
+        
+        #The images quantified in parallel share the index, so only one of them writes it at a time
+        with PLA_cache_lock:
+            file_hashes[file_key] = sha1.hexdigest()
+            with open(os.path.join(cache_directory, "File hashes.json.tmp"), "w") as hashes_file:
+                json.dump(file_hashes, hashes_file, indent=1)
+            replace_file(os.path.join(cache_directory, "File hashes.json.tmp"), os.path.join(cache_directory, "File hashes.json"))
+            return file_hashes[file_key]
+
+#Open an image and keep only the PLA channel (the other channels are not needed for the quantification) with the background subtracted (needed to enhance particle
+#detection, same defaults as the Subtract Background... menu). Without a cache directory it is always computed
+def open_PLA_channel(image_path, PLA_channel, PLA_background_radius, cache_directory=None):
+    image_name = os.path.basename(image_path)
+    if cache_directory != None:
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+        cached_path = os.path.join(cache_directory, file_hash(image_path, cache_directory)+"_C"+str(PLA_channel)+"_r"+str(PLA_background_radius)+".tif")
+        if os.path.isfile(cached_path):
+            cached_PLA_channel = IJ.openImage(cached_path)
+            if cached_PLA_channel != None:
+                cached_PLA_channel.setTitle("C"+str(PLA_channel)+"-"+image_name)
+                return cached_PLA_channel
+    
+    raw_image = IJ.openImage(image_path)
+    if raw_image == None:
+        return None
+    PLA_channel_image = ImagePlus("C"+str(PLA_channel)+"-"+image_name, ChannelSplitter.getChannel(raw_image, PLA_channel).getProcessor(1))
+    PLA_channel_image.setCalibration(raw_image.getCalibration())
+    raw_image.close()
+    BackgroundSubtracter().rollingBallBackground(PLA_channel_image.getProcessor(), PLA_background_radius, False, False, False, True, True)
+    
+    #Same as the JPEGs, the TIFF is written to a temporary name so a crash never leaves a broken file in the cache
+    if cache_directory != None:
+        if FileSaver(PLA_channel_image).saveAsTiff(cached_path + ".part"):
+            replace_file(cached_path + ".part", cached_path)
+    return PLA_channel_image
+
+#Each image quantified in parallel collects its rows in its own list, which are returned with the ROIs quantified once the image is done
+class QuantifyImageTask(Callable):
+    def __init__(self, quantify_image, raw_temp_directory, raw_image_name):
+        self.quantify_image = quantify_image
+        self.raw_temp_directory = raw_temp_directory
+        self.raw_image_name = raw_image_name
+    def call(self):
+        image_rows = []
+        ROIs_quantified = self.quantify_image(self.raw_temp_directory, self.raw_image_name, image_rows.append)
+        return image_rows, ROIs_quantified
+
+#Measure all the particles of a cropped cell without any size or circularity filter (position in the whole image, area in pixels and circularity), so they
+#can be filtered later with other ranges without running the script again (see PLA_requantification.py)
+def measure_particles(cropped_cell):
+    particles_table = ResultsTable()
+    particle_analyzer = ParticleAnalyzer(ParticleAnalyzer.SHOW_NONE, Measurements.AREA | Measurements.CENTROID | Measurements.SHAPE_DESCRIPTORS, particles_table,
+                                         0, float("inf"), 0.0, 1.0)
+    particle_analyzer.setHideOutputImage(True)
+    particle_analyzer.analyze(cropped_cell, cropped_cell.getProcessor())
+    crop_x, crop_y = cropped_cell.getProperty("Crop origin")
+    
+    return [(particles_table.getValue("X", row) + crop_x, particles_table.getValue("Y", row) + crop_y, particles_table.getValue("Area", row),
+             particles_table.getValue("Circ.", row)) for row in range(particles_table.size())]
+
+#Make the masks of the methods selected from a background-subtracted PLA channel (255 = particle), the threshold mask is split with watershed
+def make_masks(PLA_processor, do_FM, prominence, do_T, threshold_method):
+    maxima_mask = thresholded_mask = None
+    if do_FM:
+        maxima_mask = MaximumFinder().findMaxima(PLA_processor, prominence, ImageProcessor.NO_THRESHOLD, MaximumFinder.IN_TOLERANCE, False, False)
+    if do_T:
+        thresholded_processor = PLA_processor.duplicate()
+        thresholded_processor.setAutoThreshold(threshold_method, True, ImageProcessor.NO_LUT_UPDATE)
+        thresholded_mask = thresholded_processor.createMask()
+        EDM().toWatershed(thresholded_mask)
+    return maxima_mask, thresholded_mask
+
+#For the tiled mode, find where the pixels of the PLA channel are in the file. This only works for uncompressed grayscale TIFFs (as saved by ImageJ), where
+#the pixels of each plane are stored one row after the other, so any region can be read without reading the rest. Returns None for any other image
+def read_TIFF_layout(image_path, PLA_channel):
+    if not image_path.lower().endswith((".tif", ".tiff")):
+        return None
+    try:
+        TIFF_info = TiffDecoder(os.path.dirname(image_path), os.path.basename(image_path)).getTiffInfo()
+    except (Exception, JavaException):
+        return None
+    if (TIFF_info == None) or (len(TIFF_info) == 0):
+        return None
+    plane_info = TIFF_info[0] if len(TIFF_info) == 1 else TIFF_info[min(PLA_channel, len(TIFF_info))-1]
+    if (plane_info.compression != FileInfo.COMPRESSION_NONE) or (plane_info.fileType not in
+            [FileInfo.GRAY8, FileInfo.GRAY16_UNSIGNED, FileInfo.GRAY16_SIGNED, FileInfo.GRAY32_FLOAT, FileInfo.GRAY32_INT]):
+        return None
+    
+    #The rows are read from the offset of the first strip, so the strips of the plane must be one after the other in the file (always true for the TIFFs saved by
+    #ImageJ, other software can save them anywhere). Otherwise the image is opened whole
+    bytes_per_pixel = plane_info.getBytesPerPixel()
+    plane_offset = plane_info.getOffset()
+    if (plane_info.stripOffsets != None) and (len(plane_info.stripOffsets) > 0):
+        strip_offsets, strip_lengths = list(plane_info.stripOffsets), list(plane_info.stripLengths or [])
+        if (len(strip_lengths) != len(strip_offsets)) or (strip_offsets[0] != plane_offset) or (sum(strip_lengths) < plane_info.width*plane_info.height*bytes_per_pixel):
+            return None
+        if any(strip_offsets[strip+1] != strip_offsets[strip] + strip_lengths[strip] for strip in range(len(strip_offsets)-1)):
+            return None
+    
+    #In an ImageJ hyperstack all the planes are in one block (channels first), the first plane of the PLA channel is the same one ChannelSplitter gives
+    if len(TIFF_info) == 1:
+        if plane_info.nImages < PLA_channel:
+            return None
+        plane_offset += (PLA_channel-1) * (plane_info.width*plane_info.height*bytes_per_pixel + plane_info.gapBetweenImages)
+    
+    #The calibration is taken from the file too (same as when the image is opened), so the cell areas don't change
+    FileOpener(plane_info).decodeDescriptionString(plane_info)
+    calibration = Calibration()
+    calibration.pixelWidth, calibration.pixelHeight = plane_info.pixelWidth, plane_info.pixelHeight
+    calibration.setUnit(plane_info.unit)
+    return {"info": plane_info, "offset": plane_offset, "bytes_per_pixel": bytes_per_pixel, "calibration": calibration}
+
+#Read only the bounding box of a ROI (plus a margin, cut at the borders of the image) from the file, one row at a time. Returns the tile and where it starts in the image
+def read_TIFF_tile(image_path, TIFF_layout, ROI_bounds, tile_margin):
+    plane_info, bytes_per_pixel = TIFF_layout["info"], TIFF_layout["bytes_per_pixel"]
+    tile_x, tile_y = max(0, ROI_bounds.x - tile_margin), max(0, ROI_bounds.y - tile_margin)
+    tile_width = min(plane_info.width, ROI_bounds.x + ROI_bounds.width + tile_margin) - tile_x
+    tile_height = min(plane_info.height, ROI_bounds.y + ROI_bounds.height + tile_margin) - tile_y
+    tile_bytes = zeros(tile_width*tile_height*bytes_per_pixel, "b")
+    TIFF_file = RandomAccessFile(image_path, "r")
+    try:
+        for tile_row in range(tile_height):
+            TIFF_file.seek(TIFF_layout["offset"] + ((tile_y + tile_row)*plane_info.width + tile_x)*bytes_per_pixel)
+            TIFF_file.readFully(tile_bytes, tile_row*tile_width*bytes_per_pixel, tile_width*bytes_per_pixel)
+    finally:
+        TIFF_file.close()
+    
+    #Decode the bytes of the tile the same way ImageJ decodes the whole plane (byte order, signed 16-bit, etc.)
+    tile_info = plane_info.clone()
+    tile_info.width, tile_info.height, tile_info.offset, tile_info.nImages, tile_info.gapBetweenImages = tile_width, tile_height, 0, 1, 0
+    tile_info.stripOffsets = tile_info.stripLengths = None
+    tile_stack = ImageStack(tile_width, tile_height)
+    tile_stack.addSlice("", ImageReader(tile_info).readPixels(ByteArrayInputStream(tile_bytes)))
+    PLA_tile = ImagePlus("PLA tile", tile_stack.getProcessor(1))
+    PLA_tile.setCalibration(TIFF_layout["calibration"])
+    return PLA_tile, tile_x, tile_y
+
+#Number of images to quantify at the same time: the one given in the menu, or (with 0) as many as cores, as long as the free memory allows it. Each worker holds
+#one image while it opens it and then its PLA channel and masks, which we take as ~3 times the size of the biggest image file
+def count_image_workers(requested_workers, image_paths):
+    if requested_workers > 0 or not image_paths:
+        return max(1, requested_workers)
+    runtime = Runtime.getRuntime()
+    free_memory = runtime.maxMemory() - (runtime.totalMemory() - runtime.freeMemory())
+    memory_per_worker = 3 * max(os.path.getsize(image_path) for image_path in image_paths)
+    return int(max(1, min(runtime.availableProcessors(), free_memory // max(1, memory_per_worker), len(image_paths))))
+
+#Keep the first time each value is given (the order of the sweep is the order given by the user)
+def unique_values(values):
+    return [value for value_index, value in enumerate(values) if value not in values[:value_index]]
+
+#The Analyze Particles ranges are given as text like "3-Infinity", so we turn them into the (min, max) numbers the plug-in needs
+def parse_range(range_text):
+    range_min, range_max = range_text.split("-")
+    range_max = float("inf") if range_max.strip().lower() == "infinity" else float(range_max)
+    return float(range_min), range_max
+
+#Count the particles of one ROI in a mask (255 = particle) without opening any window, and keep the colour-coded crop for the preview images
+def crop_mask(mask_processor, ROI_to_count):
+    
+    #Crop the bounding box of the ROI from the mask, and move a copy of the ROI to the origin of that crop
+    ROI_bounds = ROI_to_count.getBounds()
+    mask_processor.setRoi(ROI_bounds)
+    crop_bounds = mask_processor.getRoi()
+    cropped_mask = mask_processor.crop()
+    local_ROI = ROI_to_count.clone()
+    local_ROI.setLocation(ROI_bounds.x - crop_bounds.x, ROI_bounds.y - crop_bounds.y)
+    mask_processor.resetRoi()
+    
+    #The particles are the thresholded pixels (255) of the crop, and only the ones inside the ROI are analyzed
+    cropped_mask.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+    if not Prefs.blackBackground:
+        cropped_mask.invertLut()
+    cropped_cell = ImagePlus("current_ROI.tif", cropped_mask)
+    cropped_cell.setRoi(local_ROI)
+    cropped_cell.setProperty("Crop origin", [crop_bounds.x, crop_bounds.y])
+    
+    return cropped_cell
+
+#Analyze Particles on a cropped cell (by default same as show=[Overlay Masks] in the menu), each particle counted adds one row to a private table 
+def count_particles(cropped_cell, size_range, circularity_range, show_option=ParticleAnalyzer.SHOW_OVERLAY_MASKS):
+    particles_table = ResultsTable()
+    particle_analyzer = ParticleAnalyzer(show_option, Measurements.AREA, particles_table,
+                                         size_range[0], size_range[1], circularity_range[0], circularity_range[1])
+    particle_analyzer.setHideOutputImage(True)
+    particle_analyzer.analyze(cropped_cell, cropped_cell.getProcessor())
+    
+    return particles_table.size()
 
 
 ######################################################################################################################################################################################
 ############################################################ Crop all the individual cells from raw images (Optional) ################################################################
 
 #If the raw cells are big images with multiple cells, this section will be done for data/results presentation. If not needed, then uncheck the box and proceed to the next section
-if Crop_cells==True:
+def crop_cells(condition):
+    
+    #Get the directories of the current condition
+    raw_image_directory = os.path.join(condition["exp_condition_folder"], condition["source_images_folder"])
+    ROIs_directory = os.path.join(condition["exp_condition_folder"], "ROIs")
+    summary_ppt_cells_directory = os.path.join(condition["exp_condition_folder"], "Cropped cells")
+    cropping_starting_time = datetime.now()
+    
     cropped_cells_directory = os.path.join(summary_ppt_cells_directory, "Fluorescence")
     if not os.path.exists(cropped_cells_directory):
         os.makedirs(cropped_cells_directory)
     presentation_ROIs_directory = os.path.join(ROIs_directory, "For Presentation")
     
-    #Initialize the ROI manager
-    rm = RoiManager()
-    
     #Walk through the raw image folder in case additional subfolders are used
     for raw_temp_directory, subfolder, raw_image_names in os.walk(raw_image_directory):
         raw_image_names.sort()
@@ -99,41 +480,40 @@ if Crop_cells==True:
             raw_image_original_name = raw_image_name.split("X_")[1]
             raw_image_original_name = raw_image_original_name.split(".t")[0]
             
-            #Find the folder with the ROIs for the current raw image
-            ROIs_to_crop_folder = os.path.join(presentation_ROIs_directory, raw_image_original_name)
+            #Make the directories to save the images
+            save_cropped_directory = os.path.join(cropped_cells_directory, raw_image_original_name)
+            if not os.path.exists(save_cropped_directory):
+                os.makedirs(save_cropped_directory)
+            
+            #Get the ROIs of the current image (read once from the ROIs folder or its RoiSet.zip), when resuming we skip the cells already cropped by a previous run
+            ROIs_to_crop = [(ROI, current_ROI) for ROI, current_ROI in load_ROI_set(presentation_ROIs_directory, raw_image_original_name, condition["Save_ROI_sets"])
+                            if not (condition["Resume"] and already_saved(os.path.join(save_cropped_directory, os.path.splitext(ROI)[0]+".jpg")))]
+            if not ROIs_to_crop:
+                print("Cropping of ROIs on image " + raw_image_name + " was already done, skipping it...")
+                continue
             
-            #Now we're ready to open the current raw image 
+            #Now we're ready to open the current raw image (it is never shown, so this also works when running ImageJ --headless)
             current_raw_image = IJ.openImage(os.path.join(raw_temp_directory, raw_image_name))
-            while current_raw_image==None:
-                time.sleep(0.5)
-            current_raw_image.show()
+            if current_raw_image == None:
+                print("Could not open image " + raw_image_name + ", skipping it...")
+                continue
             
-            #Walk through the ROIs folder to get all the ROIs
-            for ROI_temp_directory, subfolder2, ROIs in os.walk(ROIs_to_crop_folder):
-                ROIs.sort()
+            #Iterate through each ROI of the current image
+            for ROI, current_ROI in ROIs_to_crop:
                 
-                #Iterate through each ROI (for the current opened image)
-                for ROI in ROIs:
-                    
-                    #Open the current ROI
-                    current_ROI_directory = os.path.join(ROI_temp_directory, ROI)
-                    rm.runCommand("Open", str(current_ROI_directory))
-                    rm.select(0)
-                    
-                    #Duplicate the current ROI and get it into a variable
-                    IJ.run("Duplicate...", "title=current_ROI.tif duplicate")
-                    cropped_cell = IJ.getImage()
-                    
-                    #Make the directories and names to save the images
-                    save_cropped_directory = os.path.join(cropped_cells_directory, raw_image_original_name)
-                    save_cropped_name = os.path.join(save_cropped_directory, os.path.splitext(ROI)[0]+".jpg")					
-                    if not os.path.exists(save_cropped_directory):
-                        os.makedirs(save_cropped_directory)
-                    
-                    #Save cropped image, give it 1 second to finish, and close the cropped image and the ROI used to make it
-                    IJ.saveAs(cropped_cell, "Jpeg", save_cropped_name)
-                    cropped_cell.close()
-                    rm.runCommand("Delete")
+                #Set the current ROI on the raw image
+                current_raw_image.setRoi(current_ROI)
+                
+                #Crop all the channels/slices inside the ROI into a new image, without the GUI Duplicate command
+                cropped_cell = Duplicator().run(current_raw_image)
+                cropped_cell.deleteRoi()
+                current_raw_image.deleteRoi()
+                
+                #Hand the cropped image to the writers, which save it (checking it was written) and close it
+                save_cropped_name = os.path.join(save_cropped_directory, os.path.splitext(ROI)[0]+".jpg")
+                if not os.path.exists(os.path.dirname(save_cropped_name)):
+                    os.makedirs(os.path.dirname(save_cropped_name))
+                JPEG_writer.execute(JpegWriterTask(cropped_cell, save_cropped_name))
                     
             #Print a progress update
             print("Cropping of ROIs on image " + raw_image_name + " complete!")
@@ -141,247 +521,453 @@ if Crop_cells==True:
             #Close the current raw image just completed, empty memory and proceed to the next image
             current_raw_image.close()
             IJ.run("Collect Garbage", "")
-            
-    #Close the ROI manager when we finish cropping all the images (for independency between sections)
-    rm.close()
     
     #Print the time spent cropping
     partial_timer1 = datetime.now()
-    cropping_time = (partial_timer1.getTime() - whole_script_starting_time.getTime())/1000.00
+    cropping_time = (partial_timer1.getTime() - cropping_starting_time.getTime())/1000.00
     print("Time spent cropping all the images (hours):", round(cropping_time/3600, 1))
-    
+
 
 ######################################################################################################################################################################################
 ############################################################# PLA quantification (Measure cell area + puncta) ########################################################################
 
 #This section quantifies area of the cell and number of puncta per cell by 2 methods: Analyze Particles and Find Maxima (Review results to see which works better for the experiment)
-if Quantification!= "-":
+#Both methods are done in a single pass: each ROI is opened once and its particles are counted on the in-memory masks made from the same background-subtracted PLA channel
+def quantify_cells(condition):
     
-    #This line is needed to avoid problems with measuring ROI area
-    IJ.run("Set Measurements...", "area display redirect=None decimal=2")
+    #Get the directories and parameters of the current condition
+    exp_condition_folder = condition["exp_condition_folder"]
+    raw_image_directory = os.path.join(exp_condition_folder, condition["source_images_folder"])
+    ROIs_directory = os.path.join(exp_condition_folder, "ROIs")
+    summary_ppt_cells_directory = os.path.join(exp_condition_folder, "Cropped cells")
+    PLA_channel = condition["PLA_channel"]
+    PLA_background_radius = condition["PLA_background_radius"]
+    Quantification = condition["Quantification"]
+    particle_sizes = condition["particle_sizes"]
+    particle_circularity = condition["particle_circularity"]
+    threshold_method = condition["threshold_method"]
+    prominence = condition["prominence"]
+    quantification_starting_time = datetime.now()
     
-    #Check if we have one pair of parameters or two for the quantification methods
+    #Check if we have one pair of parameters or two for the quantification methods (Threshold first, then Find Maxima)
     if ("," in particle_sizes) & ("," in particle_circularity):
-        particle_sizes_T = particle_sizes.split(",")[0]
-        particle_sizes_FM = particle_sizes.split(",")[1]
-        particle_circularity_T = particle_circularity.split(", ")[0]
-        particle_circularity_FM = particle_circularity.split(", ")[0]
+        particle_sizes_T, particle_sizes_FM = [sizes.strip() for sizes in particle_sizes.split(",")]
+        particle_circularity_T, particle_circularity_FM = [circularity.strip() for circularity in particle_circularity.split(",")]
     else:
         particle_sizes_T = particle_sizes_FM = particle_sizes
         particle_circularity_T = particle_circularity_FM = particle_circularity
     
+    #Decide which methods are needed according to the menu
+    do_FM = (Quantification == "Find Maxima + Analyze Particles") or (Quantification == "Both")
+    do_T = (Quantification == "Threshold + Analyze Particles") or (Quantification == "Both")
+    
+    #Size and circularity ranges for each method
+    size_range_T = parse_range(particle_sizes_T)
+    size_range_FM = parse_range(particle_sizes_FM)
+    circularity_range_T = parse_range(particle_circularity_T)
+    circularity_range_FM = parse_range(particle_circularity_FM)
+    
     #Create neccesary directories
     analysis_directory = os.path.join(exp_condition_folder, "Quantification")
     if not os.path.exists(analysis_directory):
         os.makedirs(analysis_directory)
     analysis_ROIs_directory = os.path.join(ROIs_directory, "For Analysis")
+    PLA_cache_directory = os.path.join(analysis_directory, "PLA channel cache") if condition["Cache_PLA_channels"] else None
+    particle_tables_directory = os.path.join(analysis_directory, "Particle tables")
+    if condition["Particle_tables"] and not os.path.exists(particle_tables_directory):
+        os.makedirs(particle_tables_directory)
     
-    #Initialize the ROI manager and variables to save all the results table
-    rm = RoiManager()
-    maxima_ROI_names = []
-    maxima_raw_image_names = []
-    maxima_cell_areas = []
-    maxima_cell_particle_count = []
-    t_ROI_names = []
-    t_raw_image_names = []
-    t_cell_areas = []
-    t_cell_particle_count = []
+    #Prepare the columns of the results table according to the methods selected
+    if Quantification == "Both":
+        column_titles = ("Image used", "Cell quantified", "Particle count threshold", "Cell area", "Particle count maxima")
+    else:
+        column_titles = ("Image used", "Cell quantified", "Particle count", "Cell area")
     
-    #Walk through the raw image folder in case additional subfolders are used
+    #Read the checkpoint of a previous run (only used if resuming with the same parameters) and start Results.csv with the images it already completed
+    results_path = os.path.join(analysis_directory, "Results.csv")
+    checkpoint_path = os.path.join(analysis_directory, "Checkpoint.json")
+    checkpoint_parameters = dict((parameter, condition[parameter]) for parameter in ["source_images_folder", "PLA_channel", "PLA_background_radius", "Quantification",
+                                 "particle_sizes", "particle_circularity", "threshold_method", "prominence", "Particle_tables", "Tiled_processing"])
+    checkpoint = read_checkpoint(checkpoint_path, checkpoint_parameters) if condition["Resume"] else {"parameters": checkpoint_parameters, "completed_images": {}}
+    
+    #The images are named in Results.csv and the checkpoint by their path inside the images folder (the name alone for the images directly in it), so images with
+    #the same name in different subfolders don't get mixed up
+    def image_key(raw_temp_directory, raw_image_name):
+        return os.path.relpath(os.path.join(raw_temp_directory, raw_image_name), raw_image_directory).replace(os.sep, "/")
+    
+    #Since this version of the script works with Z-projected images, we need to trim the name of the images (MAX_Row_01_05.tif to find a folder Row_01_05)
+    def ROI_set_name(raw_image_name):
+        return raw_image_name.split("X_")[1].split(".t")[0]
+    
+    #List the images to quantify, walking through the raw image folder in case additional subfolders are used and skipping the images completed by a previous run.
+    #An image completed before is quantified again if its ROIs changed since then (e.g. more cells were added with Tool 03)
+    images_to_quantify = []
     for raw_temp_directory, subfolder, raw_image_names in os.walk(raw_image_directory):
+        subfolder.sort()
         raw_image_names.sort()
-        
-        #Iterate through each raw image 
         for raw_image_name in raw_image_names:
+            current_image_key = image_key(raw_temp_directory, raw_image_name)
+            if current_image_key in checkpoint["completed_images"]:
+                current_ROIs = [ROI for ROI, current_ROI in load_ROI_set(analysis_ROIs_directory, ROI_set_name(raw_image_name), condition["Save_ROI_sets"])]
+                if current_ROIs == checkpoint["completed_images"][current_image_key]:
+                    print("Quantification of ROIs on image " + current_image_key + " was already done, skipping it...")
+                    continue
+                print("The ROIs of image " + current_image_key + " changed since the last run, it will be quantified again...")
+                del checkpoint["completed_images"][current_image_key]
+            images_to_quantify.append((raw_temp_directory, raw_image_name))
+    restart_results(results_path, column_titles, checkpoint["completed_images"])
+    write_checkpoint(checkpoint_path, checkpoint)
+    
+    #Quantify one image: its rows are passed to write_row as soon as each ROI is done, and the names of the ROIs quantified are returned (None if it can't be opened).
+    #Everything used here (PLA channel, masks, crops, Analyze Particles and its table) belongs to this call, so several images can be quantified at the same time
+    def quantify_image(raw_temp_directory, raw_image_name, write_row):
+        raw_image_original_name = ROI_set_name(raw_image_name)
+        current_image_key = image_key(raw_temp_directory, raw_image_name)
+        
+        #In the tiled mode, only the region around each ROI is read from the file (if the image is an uncompressed TIFF, otherwise the whole image is opened)
+        raw_image_path = os.path.join(raw_temp_directory, raw_image_name)
+        TIFF_layout = read_TIFF_layout(raw_image_path, PLA_channel) if condition["Tiled_processing"] else None
+        if condition["Tiled_processing"] and (TIFF_layout == None):
+            print("Image " + raw_image_name + " is not an uncompressed TIFF with its rows in one block, it will be opened whole...")
+        
+        #Otherwise, we're ready to open the background-subtracted PLA channel of the current raw image (from the cache if it was already made) and make its masks
+        if TIFF_layout == None:
+            current_PLA_channel = open_PLA_channel(raw_image_path, PLA_channel, PLA_background_radius, PLA_cache_directory)
+            if current_PLA_channel == None:
+                print("Could not open image " + raw_image_name + ", skipping it...")
+                return None
+            maxima_mask, thresholded_mask = make_masks(current_PLA_channel.getProcessor(), do_FM, prominence, do_T, threshold_method)
+        
+        #Iterate through each ROI of the current image (read once from the ROIs folder or its RoiSet.zip)
+        ROIs_quantified = []
+        particle_rows = []
+        crops_saving = []
+        for ROI, current_ROI in load_ROI_set(analysis_ROIs_directory, raw_image_original_name, condition["Save_ROI_sets"]):
+            particle_counts = {}
             
-            #Since this version of the script works with Z-projected images, we need to trim the name of the images (MAX_Row_01_05.tif to find a folder Row_01_05)
-            raw_image_original_name = raw_image_name.split("X_")[1]
-            raw_image_original_name = raw_image_original_name.split(".t")[0]
+            #In the tiled mode, read the region of the ROI plus a margin for the rolling ball, and do the background subtraction and the masks on it alone
+            tile_x = tile_y = 0
+            if TIFF_layout != None:
+                current_PLA_channel, tile_x, tile_y = read_TIFF_tile(raw_image_path, TIFF_layout, current_ROI.getBounds(), 4*PLA_background_radius + 16)
+                BackgroundSubtracter().rollingBallBackground(current_PLA_channel.getProcessor(), PLA_background_radius, False, False, False, True, True)
+                maxima_mask, thresholded_mask = make_masks(current_PLA_channel.getProcessor(), do_FM, prominence, do_T, threshold_method)
+                current_ROI = current_ROI.clone()
+                current_ROI.setLocation(current_ROI.getXBase() - tile_x, current_ROI.getYBase() - tile_y)
             
-            #Find the folder with the ROIs for the current raw image
-            ROIs_to_analyze_folder = os.path.join(analysis_ROIs_directory, raw_image_original_name)
+            #Measure the area of the cell (calibrated, same as Measure)
+            current_PLA_channel.setRoi(current_ROI)
+            cell_area = current_PLA_channel.getStatistics(Measurements.AREA).area
+            current_PLA_channel.deleteRoi()
             
-            #Now we're ready to open the current raw image 
-            current_raw_image = IJ.openImage(os.path.join(raw_temp_directory, raw_image_name))
-            while current_raw_image==None:
-                time.sleep(0.5)
-            current_raw_image.show()
+            #Quantify the particles with each method selected and save the colour-coded crop of the particles counted
+            for method_selected, method_mask, size_range, circularity_range, method_folder in [
+                    (do_FM, maxima_mask, size_range_FM, circularity_range_FM, "FM_Particles"),
+                    (do_T, thresholded_mask, size_range_T, circularity_range_T, "T_Particles")]:
+                if not method_selected:
+                    continue
+                cropped_cell = crop_mask(method_mask, current_ROI)
+                particle_count = count_particles(cropped_cell, size_range, circularity_range)
+                if condition["Particle_tables"]:
+                    for particle_index, (particle_x, particle_y, particle_area, particle_circularity) in enumerate(measure_particles(cropped_cell)):
+                        particle_rows.append((current_image_key, ROI, method_folder, particle_index+1, particle_x + tile_x, particle_y + tile_y, particle_area,
+                                              particle_circularity))
+                cropped_cell.deleteRoi()
+                
+                #Make the directories and names to save the images
+                save_cropped_directory = os.path.join(summary_ppt_cells_directory, method_folder, raw_image_original_name)
+                save_cropped_name = os.path.join(save_cropped_directory, os.path.splitext(ROI)[0]+".jpg")
+                if not os.path.exists(os.path.dirname(save_cropped_name)):
+                    os.makedirs(os.path.dirname(save_cropped_name))
+                
+                #Hand the cropped image to the writers, which save it (checking it was written) and close it
+                crops_saving.append(JPEG_writer.submit(JpegWriterTask(cropped_cell, save_cropped_name)))
+                
+                #Keep the count of this method
+                particle_counts[method_folder] = particle_count
             
-            #Split the image and close channels not needed 
-            IJ.run("Split Channels")
-            for channel in [5, 4, 3, 2, 1]:
-                channel_to_close = WindowManager.getImage("C"+str(channel)+"-"+raw_image_name)
-                if (PLA_channel != channel) and (channel_to_close != None):
-                    channel_to_close.close()
+            #Pass on the current ROI and raw image names with the results of the methods
+            if Quantification == "Both":
+                write_row((current_image_key, ROI, particle_counts["T_Particles"], cell_area, particle_counts["FM_Particles"]))
+            else:
+                write_row((current_image_key, ROI, particle_counts.values()[0], cell_area))
+            ROIs_quantified.append(ROI)
             
-            #Subtract background (needed to enhance particle detection) and get the PLA channel into a variable
-            IJ.run("Subtract Background...", "rolling="+str(PLA_background_radius))
-            current_PLA_channel = IJ.getImage()
+            #The tile of the ROI is not needed anymore
+            if TIFF_layout != None:
+                current_PLA_channel.close()
+        
+        #Wait for the crops of this image to be saved, so an image is never marked as completed with crops still in the queue (they would be lost if the run stops)
+        for crop_saving in crops_saving:
+            crop_saving.get()
+        
+        #Save the table with every particle of the image (before it is marked as completed)
+        if condition["Particle_tables"]:
+            particle_table_path = os.path.join(particle_tables_directory, os.path.splitext(current_image_key)[0].replace("/", "_")+".csv")
+            with open(particle_table_path + ".tmp", "wb") as particle_table_file:
+                particle_table_writer = csv.writer(particle_table_file)
+                particle_table_writer.writerow(("Image used", "Cell quantified", "Method", "Particle", "X", "Y", "Area (pixels)", "Circularity"))
+                particle_table_writer.writerows(particle_rows)
+            replace_file(particle_table_path + ".tmp", particle_table_path)
+        
+        #Close the current PLA channel just completed
+        if TIFF_layout == None:
+            current_PLA_channel.close()
+        return ROIs_quantified
+    
+    #Keep Results.csv open during the whole run
+    results_file = open(results_path, "ab")
+    results_writer = csv.writer(results_file)
+    image_workers = count_image_workers(condition["Image_workers"], [os.path.join(*image_to_quantify) for image_to_quantify in images_to_quantify])
+    
+    #With one worker, each row is written (and flushed) as soon as its ROI is quantified so nothing is kept in memory
+    if image_workers == 1:
+        def write_row(row):
+            results_writer.writerow(row)
+            results_file.flush()
+        quantified_images = ((image_key(raw_temp_directory, raw_image_name), quantify_image(raw_temp_directory, raw_image_name, write_row))
+                             for raw_temp_directory, raw_image_name in images_to_quantify)
+    
+    #With more workers, the images are quantified at the same time and each one keeps its rows until it is added to Results.csv. The images are added in the same
+    #order as with one worker (waiting for the next one if needed), so Results.csv is the same no matter how many workers were used
+    else:
+        print("Quantifying " + str(len(images_to_quantify)) + " images with " + str(image_workers) + " workers")
+        image_executor = Executors.newFixedThreadPool(image_workers)
+        image_tasks = [(image_key(raw_temp_directory, raw_image_name), image_executor.submit(QuantifyImageTask(quantify_image, raw_temp_directory, raw_image_name)))
+                       for raw_temp_directory, raw_image_name in images_to_quantify]
+        image_executor.shutdown()
+        def merge_image_task(current_image_key, image_task):
+            image_rows, ROIs_quantified = image_task.get()
+            results_writer.writerows(image_rows)
+            results_file.flush()
+            return current_image_key, ROIs_quantified
+        quantified_images = (merge_image_task(current_image_key, image_task) for current_image_key, image_task in image_tasks)
+    
+    #All the rows of each image are in Results.csv before the image (and its ROIs) is marked as completed in the checkpoint
+    try:
+        for current_image_key, ROIs_quantified in quantified_images:
+            if ROIs_quantified == None:
+                continue
+            checkpoint["completed_images"][current_image_key] = ROIs_quantified
+            write_checkpoint(checkpoint_path, checkpoint)
             
-            #Based on the quantification method selected by the user, we may do or skip what is needed for the Find Maxima method 
-            if (Quantification == "Find Maxima + Analyze Particles") or (Quantification == "Both"):
-                
-                #Create the appropriate folder to save this set of images
-                cropped_cells_directory = os.path.join(summary_ppt_cells_directory, "FM_Particles")
+            #Empty memory and print a progress update
+            IJ.run("Collect Garbage", "")
+            print("Quantification of ROIs on image " + current_image_key + " complete!")
+    finally:
+        results_file.close()
+        if image_workers > 1:
+            image_executor.shutdownNow()
+    
+    #The rows were written to Results.csv while quantifying
+    print("Results of " + str(len(checkpoint["completed_images"])) + " images saved in " + results_path)
             
-                #Run the function Find Maxima with the parameter that the user gave and get the image to quantify the ROIs
-                IJ.run("Find Maxima...", "prominence="+str(prominence)+" output=[Maxima Within Tolerance]")
-                maxima_PLA_channel = IJ.getImage()
-                maxima_PLA_channel.setTitle("Maxima.tif")
-                IJ.selectWindow("Maxima.tif")
-                
-                #Walk through the ROIs folder to get all the ROIs
-                for ROI_temp_directory, subfolder2, ROIs in os.walk(ROIs_to_analyze_folder):
-                    ROIs.sort()
-                    
-                    #Iterate through each ROI (for the current opened image)
-                    for ROI in ROIs:
-                        
-                        #Open the current ROI
-                        current_ROI_directory = os.path.join(ROI_temp_directory, ROI)
-                        rm.runCommand("Open", current_ROI_directory)
-                        rm.select(0)
-                        
-                        #Quantify the variables of interest for the current ROI (adjust these parameters if needed)
-                        IJ.run("Measure", "")
-                        IJ.run("Analyze Particles...", "size="+particle_sizes_FM+" pixel circularity="+particle_circularity_FM+" show=[Overlay Masks] summarize")
-                        
-                        #Duplicate the current ROI and get it into a variable
-                        IJ.run("Duplicate...", "title=current_ROI.tif duplicate")
-                        cropped_cell = IJ.getImage()
-                        rm.runCommand(cropped_cell,"Show None")
-                        rm.runCommand(cropped_cell,"Show All without labels")
-                        
-                        #Make the directories and names to save the images
-                        save_cropped_directory = os.path.join(cropped_cells_directory, raw_image_original_name)
-                        save_cropped_name = os.path.join(save_cropped_directory, os.path.splitext(ROI)[0]+".jpg")					
-                        if not os.path.exists(save_cropped_directory):
-                            os.makedirs(save_cropped_directory)
-                        
-                        #Save cropped image, give it 1 second to finish, and close the cropped image and the ROI used to make it
-                        IJ.saveAs(cropped_cell, "Jpeg", save_cropped_name)
-                        time.sleep(0.5)
-                        cropped_cell.close()
-                        rm.runCommand("Delete")
-                        
-                        #Save the current ROI and raw image names for the results table
-                        maxima_ROI_names.append(ROI)
-                        maxima_raw_image_names.append(raw_image_name)
-                        
-                #Get the columns of interest from the Measure and Analyze Particles results tables
-                maxima_areas_table = ResultsTable.getResultsTable("Results") 
-                maxima_cell_areas = maxima_cell_areas + list(maxima_areas_table.getColumn("Area"))
-                maxima_particles_table = ResultsTable.getResultsTable("Summary") 
-                maxima_cell_particle_count = maxima_cell_particle_count + list(maxima_particles_table.getColumn("Count"))
-                IJ.selectWindow("Results")
-                IJ.run("Close")
-                IJ.selectWindow("Summary")
-                IJ.run("Close")
-                
-                #Close the current maxima image just completed and proceed to the next image
-                maxima_PLA_channel.changes = False
-                maxima_PLA_channel.close()
-                IJ.run("Collect Garbage", "")
+    #Print the time spent quantifying
+    partial_timer2 = datetime.now()
+    quantification_time = (partial_timer2.getTime() - quantification_starting_time.getTime())/1000.00
+    print("Time spent quantifying all the images (hours):", round(quantification_time/3600, 1))
+
+
+######################################################################################################################################################################################
+############################################################### Parameter sweep to choose the quantification parameters ##############################################################
+
+#Instead of running the whole script once per set of parameters, each image is opened and background-subtracted once, the masks are made once per threshold method and
+#prominence, and every size and circularity range is counted on the same crop of each ROI. All the counts go to one long table (one row per ROI and combination)
+def sweep_parameters(condition):
+    
+    #Get the directories and parameters of the current condition (sizes and circularities are separated by ;, and each one can be "T-range, FM-range" like in the
+    #normal quantification to use a different range for each method)
+    exp_condition_folder = condition["exp_condition_folder"]
+    raw_image_directory = os.path.join(exp_condition_folder, condition["source_images_folder"])
+    analysis_ROIs_directory = os.path.join(exp_condition_folder, "ROIs", "For Analysis")
+    PLA_channel = condition["PLA_channel"]
+    PLA_background_radius = condition["PLA_background_radius"]
+    Quantification = condition["Quantification"]
+    particle_sizes = [sizes.strip() for sizes in condition["particle_sizes"].split(";") if sizes.strip()]
+    particle_circularities = [circularity.strip() for circularity in condition["particle_circularity"].split(";") if circularity.strip()]
+    threshold_methods = [method.strip() for method in condition["sweep_threshold_methods"].split(";") if method.strip()] or [condition["threshold_method"]]
+    prominences = [int(float(value)) for value in condition["sweep_prominences"].split(";") if value.strip()] or [condition["prominence"]]
+    sweep_starting_time = datetime.now()
+    
+    #Decide which methods are needed according to the menu, each value of their own parameter gives one mask per image
+    masks_to_make = []
+    if (Quantification == "Threshold + Analyze Particles") or (Quantification == "Both"):
+        masks_to_make.extend([("Threshold", threshold_method, "-") for threshold_method in threshold_methods])
+    if (Quantification == "Find Maxima + Analyze Particles") or (Quantification == "Both"):
+        masks_to_make.extend([("Find Maxima", "-", prominence) for prominence in prominences])
+    
+    #Each method counts its own sizes and circularities (the first range of "T-range, FM-range" for the Threshold and the second for Find Maxima, or the same
+    #range for both), so the comma form of the normal quantification can be swept too
+    ranges_to_count = {}
+    for method, method_index in [("Threshold", 0), ("Find Maxima", -1)]:
+        method_sizes = unique_values([sizes.split(",")[method_index].strip() for sizes in particle_sizes])
+        method_circularities = unique_values([circularity.split(",")[method_index].strip() for circularity in particle_circularities])
+        ranges_to_count[method] = [(sizes, parse_range(sizes), circularity, parse_range(circularity)) for sizes in method_sizes for circularity in method_circularities]
+        method_masks = len([mask for mask in masks_to_make if mask[0] == method])
+        if method_masks > 0:
+            print("Parameter sweep: " + str(method_masks) + " " + method + " masks x " + str(len(ranges_to_count[method])) + " size/circularity ranges per ROI")
+    
+    #The sweep always opens the whole images one by one and counts every ROI again, so these options of the menu are not used here
+    ignored_options = [option for option, selected in [("Tiled mode", condition["Tiled_processing"]), ("Resume", condition["Resume"]),
+                                                       ("Images quantified in parallel", condition["Image_workers"] != 0)] if selected]
+    if ignored_options:
+        print("Note: " + ", ".join(ignored_options) + " not used in the parameter sweep (each image is opened whole and swept from the start, one at a time)")
+    
+    #Create neccesary directories and start the table, each row is written as soon as it is counted
+    analysis_directory = os.path.join(exp_condition_folder, "Quantification")
+    if not os.path.exists(analysis_directory):
+        os.makedirs(analysis_directory)
+    sweep_results_path = os.path.join(analysis_directory, "Sweep results.csv")
+    PLA_cache_directory = os.path.join(analysis_directory, "PLA channel cache") if condition["Cache_PLA_channels"] else None
+    with open(sweep_results_path, "wb") as sweep_results_file:
+        sweep_writer = csv.writer(sweep_results_file)
+        sweep_writer.writerow(("Image used", "Cell quantified", "Method", "Threshold method", "Prominence", "Particle size", "Particle circularity",
+                               "Particle count", "Cell area"))
+        
+        #Walk through the raw image folder in case additional subfolders are used
+        for raw_temp_directory, subfolder, raw_image_names in os.walk(raw_image_directory):
+            raw_image_names.sort()
+            for raw_image_name in raw_image_names:
+                raw_image_original_name = raw_image_name.split("X_")[1]
+                raw_image_original_name = raw_image_original_name.split(".t")[0]
                 
-                #When we are doing the Find Maxima method only, we need to close the original image since it wont be used
-                if Quantification == "Find Maxima + Analyze Particles":
-                    current_PLA_channel.changes = False
-                    current_PLA_channel.close()
-                        
-            #Based on the quantification method selected by the user, we may do or skip what is needed for the Threshold method 
-            if (Quantification == "Threshold + Analyze Particles") or (Quantification == "Both"):
+                #Open the background-subtracted PLA channel of the current raw image once for all the combinations (from the cache if it was already made)
+                current_PLA_channel = open_PLA_channel(os.path.join(raw_temp_directory, raw_image_name), PLA_channel, PLA_background_radius, PLA_cache_directory)
+                if current_PLA_channel == None:
+                    print("Could not open image " + raw_image_name + ", skipping it...")
+                    continue
+                PLA_processor = current_PLA_channel.getProcessor()
                 
-                #Create the appropriate folder to save this set of images
-                cropped_cells_directory = os.path.join(summary_ppt_cells_directory, "T_Particles")
+                #Make each mask once (255 = particle) with the same function as the normal quantification, so both always give the same masks
+                masks = []
+                for method, threshold_method, prominence in masks_to_make:
+                    if method == "Find Maxima":
+                        method_mask = make_masks(PLA_processor, True, prominence, False, None)[0]
+                    else:
+                        method_mask = make_masks(PLA_processor, False, None, True, threshold_method)[1]
+                    masks.append((method, threshold_method, prominence, method_mask))
                 
-                #Threshold the image and run watershed
-                IJ.setAutoThreshold(current_PLA_channel, threshold_method + " dark")
-                IJ.run(current_PLA_channel, "Convert to Mask", "")
-                IJ.run("Watershed")
-                thresholded_PLA_channel = IJ.getImage()
-            
-                #Walk through the ROIs folder to get all the ROIs
-                for ROI_temp_directory, subfolder2, ROIs in os.walk(ROIs_to_analyze_folder):
-                    ROIs.sort()
-                    
-                    #Iterate through each ROI (for the current opened image)
-                    for ROI in ROIs:
-                        
-                        #Open the current ROI
-                        current_ROI_directory = os.path.join(ROI_temp_directory, ROI)
-                        rm.runCommand("Open", current_ROI_directory)
-                        rm.select(0)
-                        
-                        #Quantify the variables of interest for the current ROI (adjust these parameters if needed)
-                        IJ.run("Measure", "")
-                        IJ.run("Analyze Particles...", "size="+particle_sizes_T+" pixel circularity="+particle_circularity_T+" show=[Overlay Masks] summarize")
-                        
-                        #Duplicate the current ROI and get it into a variable
-                        IJ.run("Duplicate...", "title=current_ROI.tif duplicate")
-                        cropped_cell = IJ.getImage()
-                        rm.runCommand(cropped_cell,"Show None")
-                        rm.runCommand(cropped_cell,"Show All without labels")
-                        
-                        #Make the directories and names to save the images
-                        save_cropped_directory = os.path.join(cropped_cells_directory, raw_image_original_name)
-                        save_cropped_name = os.path.join(save_cropped_directory, os.path.splitext(ROI)[0]+".jpg")					
-                        if not os.path.exists(save_cropped_directory):
-                            os.makedirs(save_cropped_directory)
-                        
-                        #Save cropped image, give it 1 second to finish, and close the cropped image and the ROI used to make it
-                        IJ.saveAs(cropped_cell, "Jpeg", save_cropped_name)
-                        time.sleep(1)
+                #Count every combination on the same crop of each ROI (no overlay is made since the crops are not saved)
+                for ROI, current_ROI in load_ROI_set(analysis_ROIs_directory, raw_image_original_name, condition["Save_ROI_sets"]):
+                    current_PLA_channel.setRoi(current_ROI)
+                    cell_area = current_PLA_channel.getStatistics(Measurements.AREA).area
+                    current_PLA_channel.deleteRoi()
+                    for method, threshold_method, prominence, method_mask in masks:
+                        cropped_cell = crop_mask(method_mask, current_ROI)
+                        for sizes, size_range, circularity, circularity_range in ranges_to_count[method]:
+                            particle_count = count_particles(cropped_cell, size_range, circularity_range, ParticleAnalyzer.SHOW_NONE)
+                            sweep_writer.writerow((raw_image_name, ROI, method, threshold_method, prominence, sizes, circularity, particle_count, cell_area))
                         cropped_cell.close()
-                        rm.runCommand("Delete")
-                        
-                        #Save the current ROI and raw image names for the results table
-                        t_ROI_names.append(ROI)
-                        t_raw_image_names.append(raw_image_name)
-                       
-                #Get the columns of interest from the Measure and Analyze Particles results tables
-                t_areas_table = ResultsTable.getResultsTable("Results") 
-                t_cell_areas = t_cell_areas + list(t_areas_table.getColumn("Area"))
-                t_particles_table = ResultsTable.getResultsTable("Summary") 
-                t_cell_particle_count = t_cell_particle_count + list(t_particles_table.getColumn("Count"))
-                IJ.selectWindow("Results")
-                IJ.run("Close")
-                IJ.selectWindow("Summary")
-                IJ.run("Close")
+                    sweep_results_file.flush()
                 
-                #Close the current raw image just completed (need to set changes as False since we dont want to save the thresholded image) and proceed to the next image
-                thresholded_PLA_channel.changes = False
-                thresholded_PLA_channel.close()
+                #Close the current PLA channel and masks just completed, empty memory and proceed to the next image
+                current_PLA_channel.close()
+                masks = None
                 IJ.run("Collect Garbage", "")
-            
-            #Print a progress update
-            print("Quantification of ROIs on image " + raw_image_name + " complete!")
-            
-    #Close the ROI manager when we finish quantifying all the images 
-    rm.close()
+                print("Parameter sweep on image " + raw_image_name + " complete!")
+    
+    #Print the time spent on the sweep
+    sweep_time = (datetime.now().getTime() - sweep_starting_time.getTime())/1000.00
+    print("Sweep results saved in " + sweep_results_path)
+    print("Time spent on the parameter sweep (hours):", round(sweep_time/3600, 1))
 
-    #Finally, save the results table to a csv file
-    if Quantification == "Threshold + Analyze Particles":
-        rows = zip(t_raw_image_names, t_ROI_names, t_cell_particle_count, t_cell_areas)
-        column_titles = ("Image used", "Cell quantified", "Particle count", "Cell area")
-    elif Quantification == "Find Maxima + Analyze Particles":
-        rows = zip(maxima_raw_image_names, maxima_ROI_names, maxima_cell_particle_count, maxima_cell_areas)
-        column_titles = ("Image used", "Cell quantified", "Particle count", "Cell area")
-    else :
-        rows = zip(t_raw_image_names, t_ROI_names, t_cell_particle_count, t_cell_areas, maxima_cell_particle_count)
-        column_titles = ("Image used", "Cell quantified", "Particle count threshold", "Cell area", "Particle count maxima")
+
+######################################################################################################################################################################################
+######################################################################## Run one condition or a batch of them ########################################################################
+
+#Do the sections selected for one experimental condition folder
+def run_condition(condition):
+    if not os.path.isdir(os.path.join(condition["exp_condition_folder"], condition["source_images_folder"])):
+        raise IOError("Folder not found: " + os.path.join(condition["exp_condition_folder"], condition["source_images_folder"]))
+    if condition["Crop_cells"]:
+        crop_cells(condition)
+    if (condition["Quantification"] != "-") and condition["Parameter_sweep"]:
+        sweep_parameters(condition)
+    elif condition["Quantification"] != "-":
+        quantify_cells(condition)
+
+#Values read from a manifest or a settings file are text, so they are converted to the same type as in the menu
+def read_condition_settings(settings, condition, settings_directory):
+    for parameter, value in settings.items():
+        parameter = parameter.strip()
+        if (parameter not in condition) or (value == None) or (str(value).strip() == ""):
+            continue
+        if parameter == "exp_condition_folder":
+            value = os.path.join(settings_directory, str(value).strip())
+        elif parameter in ["PLA_channel", "PLA_background_radius", "prominence", "Image_workers"]:
+            value = int(float(value))
+        elif parameter in ["Crop_cells", "Resume", "Cache_PLA_channels", "Save_ROI_sets", "Particle_tables", "Tiled_processing", "Parameter_sweep"]:
+            value = str(value).strip().lower() in ["true", "yes", "1"]
+        else:
+            value = str(value).strip()
+        condition[parameter] = value
+    return condition
+
+#Make the queue of conditions from a manifest (one row/object per condition folder with the parameters to change), or from all the subfolders of a root folder that
+#contain the folder with the images (each one may have a "PLA settings.json" with its parameters). Anything not given is taken from the menu
+def read_batch_conditions(batch_root_folder, batch_manifest):
+    conditions = []
+    if batch_manifest != None:
+        manifest_directory = os.path.dirname(batch_manifest)
+        if batch_manifest.lower().endswith(".json"):
+            with open(batch_manifest) as manifest_file:
+                manifest_rows = json.load(manifest_file)
+            manifest_rows = manifest_rows["conditions"] if isinstance(manifest_rows, dict) else manifest_rows
+        else:
+            with open(batch_manifest, "rb") as manifest_file:
+                manifest_rows = list(csv.DictReader(manifest_file))
+        for manifest_row in manifest_rows:
+            conditions.append(read_condition_settings(manifest_row, dict(menu_condition), manifest_directory))
+    else:
+        for condition_folder in sorted(os.listdir(batch_root_folder)):
+            condition = dict(menu_condition)
+            condition["exp_condition_folder"] = os.path.join(batch_root_folder, condition_folder)
+            condition_settings = os.path.join(condition["exp_condition_folder"], "PLA settings.json")
+            if os.path.isfile(condition_settings):
+                with open(condition_settings) as settings_file:
+                    condition = read_condition_settings(json.load(settings_file), condition, condition["exp_condition_folder"])
+            if os.path.isdir(os.path.join(condition["exp_condition_folder"], condition["source_images_folder"])):
+                conditions.append(condition)
+    return conditions
+
+#Without batch inputs we just do the condition folder from the menu (as in previous versions)
+try:
+    if (batch_root_folder == None) and (batch_manifest == None):
+        if menu_condition["exp_condition_folder"] == None:
+            raise IOError("Select an experimental condition folder, or a batch root folder/manifest")
+        run_condition(menu_condition)
+    else:
+        batch_manifest = batch_manifest.getAbsolutePath() if batch_manifest != None else None
+        batch_root_folder = batch_root_folder.getAbsolutePath() if batch_root_folder != None else None
+        batch_conditions = read_batch_conditions(batch_root_folder, batch_manifest)
     
-    with open(os.path.join(analysis_directory, "Results.csv"), "wb") as results_file:
-        writer = csv.writer(results_file)
-        writer.writerow(column_titles)
-        for row in rows:
-            writer.writerow(row)
-            
-    #Print the time spent quantifying
-    partial_timer2 = datetime.now()
-    quantification_time = (partial_timer2.getTime() - whole_script_starting_time.getTime())/1000.00
-    quantification_time = round(quantification_time/3600, 1) if Crop_cells==False else round(quantification_time/3600, 1) - round(cropping_time/3600, 1)
-    print("Time spent cropping all the images (hours):", quantification_time)
+        #The status of each condition is appended (and flushed) as soon as it finishes, so it can be checked while the batch is still running
+        batch_status_path = os.path.join(os.path.dirname(batch_manifest) if batch_manifest != None else batch_root_folder, "Batch status.csv")
+        new_status_file = not os.path.exists(batch_status_path)
+        with open(batch_status_path, "ab") as batch_status_file:
+            status_writer = csv.writer(batch_status_file)
+            if new_status_file:
+                status_writer.writerow(("Condition folder", "Status", "Started", "Running time (min)", "Message"))
+        
+            #Process the conditions back to back, a failure is recorded and the batch continues with the next condition
+            for condition_index, condition in enumerate(batch_conditions):
+                print("Processing condition " + str(condition_index+1) + "/" + str(len(batch_conditions)) + ": " + condition["exp_condition_folder"])
+                condition_starting_time = datetime.now()
+                try:
+                    run_condition(condition)
+                    condition_status, condition_message = "Completed", ""
+                except (Exception, JavaException) as error:
+                    condition_status, condition_message = "Failed", str(error)
+                    print(traceback.format_exc())
+                condition_time = (datetime.now().getTime() - condition_starting_time.getTime())/1000.00
+                status_writer.writerow((condition["exp_condition_folder"], condition_status, str(condition_starting_time), round(condition_time/60, 1), condition_message))
+                batch_status_file.flush()
     
+        print("Batch complete: " + str(len(batch_conditions)) + " conditions, status saved in " + batch_status_path)
+finally:
+    
+    #Make sure all the cropped cells have been saved before finishing (also if a condition fails, so the crops still in the queue are not lost)
+    drain_JPEG_writer()
+
 
 ######################################################################################################################################################################################
 
@@ -390,7 +976,7 @@ whole_script_ending_time = datetime.now()
 whole_script_running_time = (whole_script_ending_time.getTime() - whole_script_starting_time.getTime())/1000.00
 
 #Print a summary of the work done and time it required
-print("Whole script running time for one channel/condition (hours):", round(whole_script_running_time/3600, 1))
+print("Whole script running time (hours):", round(whole_script_running_time/3600, 1))
 
 ######################################################################################################################################################################################
 ######################################################################################################################################################################################
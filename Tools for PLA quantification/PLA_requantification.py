@@ -0,0 +1,126 @@
+######################################################################################################################################################################################
+'''
+
+Full name of script: Proximity Ligation Assay (PLA) re-quantification from the particle tables  [Version 01]
+
+Script languague: Python 3 + NumPy (run from a terminal or a notebook, Fiji is not needed)
+
+Description: Re-counts the particles of each cell quantified by PLA_quantification.py with new particle size and circularity ranges. It needs a previous run of
+             PLA_quantification.py with the option "Save a table with all the particles of each image" selected, which saves "Quantification/Particle tables"
+             with every particle found (no size or circularity filter) and the cell it belongs to. Since the thresholding/Find Maxima and Analyze Particles are
+             not done again, any new range takes seconds instead of re-running the whole script. Sizes are in pixels and the ranges follow the same rules as
+             Analyze Particles (both limits included), so the counts are the same as running PLA_quantification.py with those ranges.
+             The results are saved in the Quantification folder with the same columns as Results.csv (the cell areas are taken from Results.csv).
+
+             Usage:  python PLA_requantification.py "<experimental condition folder>" --sizes 5-Infinity --circularity 0.20-1.00
+                     (as in the script menu, pass T first a comma and then FM for different ranges per method: --sizes "3-Infinity, 5-Infinity")
+
+Made by: Eduardo Reyes Alvarez
+
+Contact: eduardo_reyes09@hotmail.com
+
+Last update: October 17, 2026
+
+Version History:
+V01 (Oct 17, 2026): First version of the script, filters the particle tables saved by PLA_quantification.py (Version 05) with NumPy.
+
+'''
+
+######################################################################################################################################################################################
+################################################################################ Import neccesary packages ##########################################################################
+
+import os
+import csv
+import glob
+import argparse
+import numpy as np
+
+######################################################################################################################################################################################
+################################################################################ Read the previous run ##############################################################################
+
+#The ranges are given as text like in the script menu, "3-Infinity" or "0.10-1.00"
+def parse_range(range_text):
+    range_minimum, range_maximum = range_text.strip().split("-")
+    return float(range_minimum), (np.inf if range_maximum.strip().lower() == "infinity" else float(range_maximum))
+
+#Same as in PLA_quantification.py, one pair of ranges for both methods or two separated by a comma (Threshold first, then Find Maxima)
+def ranges_per_method(particle_sizes, particle_circularity):
+    if ("," in particle_sizes) and ("," in particle_circularity):
+        sizes_T, sizes_FM = [sizes.strip() for sizes in particle_sizes.split(",")]
+        circularity_T, circularity_FM = [circularity.strip() for circularity in particle_circularity.split(",")]
+    else:
+        sizes_T = sizes_FM = particle_sizes
+        circularity_T = circularity_FM = particle_circularity
+    return {"T_Particles": (parse_range(sizes_T), parse_range(circularity_T)), "FM_Particles": (parse_range(sizes_FM), parse_range(circularity_FM))}
+
+#Read all the particle tables into one set of arrays (one position per particle), with the cell of each particle as an index into the list of cells
+def read_particle_tables(particle_tables_directory, cell_indexes):
+    cell_index, method, area, circularity = [], [], [], []
+    for particle_table_path in sorted(glob.glob(os.path.join(particle_tables_directory, "*.csv"))):
+        with open(particle_table_path, newline="") as particle_table_file:
+            for particle in csv.DictReader(particle_table_file):
+                cell_key = (particle["Image used"], particle["Cell quantified"])
+                if cell_key not in cell_indexes:
+                    continue
+                cell_index.append(cell_indexes[cell_key])
+                method.append(particle["Method"])
+                area.append(float(particle["Area (pixels)"]))
+                circularity.append(float(particle["Circularity"]))
+    return np.array(cell_index, dtype=np.int64), np.array(method), np.array(area), np.array(circularity)
+
+#Count the particles of each cell inside the ranges of one method, all the cells at once
+def count_particles(particles, method_folder, size_range, circularity_range, number_of_cells):
+    cell_index, method, area, circularity = particles
+    kept = ((method == method_folder) & (area >= size_range[0]) & (area <= size_range[1]) &
+            (circularity >= circularity_range[0]) & (circularity <= circularity_range[1]))
+    return np.bincount(cell_index[kept], minlength=number_of_cells)
+
+######################################################################################################################################################################################
+################################################################################ Re-quantify and save ###############################################################################
+
+def requantify(exp_condition_folder, particle_sizes, particle_circularity):
+    analysis_directory = os.path.join(exp_condition_folder, "Quantification")
+    particle_tables_directory = os.path.join(analysis_directory, "Particle tables")
+    if not os.path.isdir(particle_tables_directory):
+        raise IOError("No particle tables found, run PLA_quantification.py with the particle tables option first: " + particle_tables_directory)
+
+    #The cells (and their areas) are the ones in Results.csv, so cells without any particle get a count of 0
+    with open(os.path.join(analysis_directory, "Results.csv"), newline="") as results_file:
+        results_rows = list(csv.reader(results_file))
+    column_titles, results_rows = results_rows[0], [row for row in results_rows[1:] if row]
+    both_methods = len(column_titles) == 5
+    cell_indexes = dict(((row[0], row[1]), index) for index, row in enumerate(results_rows))
+
+    #Filter the particles of all the cells with the new ranges
+    particles = read_particle_tables(particle_tables_directory, cell_indexes)
+    method_ranges = ranges_per_method(particle_sizes, particle_circularity)
+    counts = dict((method_folder, count_particles(particles, method_folder, size_range, circularity_range, len(results_rows)))
+                  for method_folder, (size_range, circularity_range) in method_ranges.items())
+
+    #Save the new counts with the same columns as Results.csv (with Both methods, Threshold is the third column and Find Maxima the last one)
+    if both_methods:
+        new_rows = [(row[0], row[1], counts["T_Particles"][index], row[3], counts["FM_Particles"][index]) for index, row in enumerate(results_rows)]
+    else:
+        used_method = "T_Particles" if np.any(particles[1] == "T_Particles") else "FM_Particles"
+        new_rows = [(row[0], row[1], counts[used_method][index], row[3]) for index, row in enumerate(results_rows)]
+    requantified_path = os.path.join(analysis_directory, "Results_size=" + particle_sizes.replace(" ", "") + "_circularity=" + particle_circularity.replace(" ", "") + ".csv")
+    with open(requantified_path, "w", newline="") as requantified_file:
+        results_writer = csv.writer(requantified_file)
+        results_writer.writerow(column_titles)
+        results_writer.writerows(new_rows)
+
+    print("Re-quantified " + str(len(new_rows)) + " cells (" + str(len(particles[0])) + " particles), results saved in " + requantified_path)
+    return requantified_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-count the PLA particles per cell with new size/circularity ranges from the saved particle tables")
+    parser.add_argument("exp_condition_folder", help="Experimental condition folder used in PLA_quantification.py")
+    parser.add_argument("--sizes", default="3-Infinity", help="Particle size in pixels, 0-Infinity, 10-1000, etc.")
+    parser.add_argument("--circularity", default="0.10-1.00", help="Particle circularity, 0.00-1.00")
+    arguments = parser.parse_args()
+    requantify(arguments.exp_condition_folder, arguments.sizes, arguments.circularity)
+
+######################################################################################################################################################################################
+######################################################################################################################################################################################
+######################################################################################################################################################################################
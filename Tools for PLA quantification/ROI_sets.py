@@ -0,0 +1,96 @@
+######################################################################################################################################################################
+'''
+
+Full name of script: Reading and saving the sets of ROIs of each image for PLA [Version 01]
+
+Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-)
+
+Description: The ROIs of each image are saved by the Tools 01/02 as one .roi file per cell inside a folder with the name of the image (in "ROIs/For Presentation" and
+             "ROIs/For Analysis"). Opening hundreds of small files is slow on network drives, so the PLA quantification script can save them as a single
+             "<image>_RoiSet.zip" next to the folder. This module reads the ROIs of an image from the zip if it is newer than the folder, otherwise from the folder
+             (walking its subfolders in alphabetical order), so the PLA quantification script and Tool 03 always get the ROIs in the same order. The ROIs
+             of subfolders are named with their path inside the folder of the image (Section_1/0_1.roi), so ROIs with the same file name don't collide.
+
+             To use it from Fiji, keep it in this folder of the repository (the scripts look for it here) or copy it to Fiji.app/jars/Lib.
+
+Made by: Eduardo Reyes Alvarez
+
+Contact: eduardo_reyes09@hotmail.com
+
+Last update: Oct 17, 2026
+
+Version History:
+V01 (Oct 17, 2026): First version, replaces the copies of the ROI reader in PLA_quantification.py and Tool_03_ROI_opening_for_PLA.py.
+
+'''
+
+######################################################################################################################################################################
+
+import os
+from ij.io import RoiDecoder, RoiEncoder
+from java.util.zip import ZipFile, ZipOutputStream, ZipEntry
+from java.io import FileOutputStream, BufferedOutputStream, DataOutputStream, ByteArrayOutputStream
+from jarray import zeros
+
+#Read all the ROIs saved in a RoiSet.zip, in the order they were saved. Returns a list of (file name, ROI) pairs
+def read_ROI_set_zip(ROI_set_zip):
+	ROI_set = []
+	zip_file = ZipFile(ROI_set_zip)
+	try:
+		entries = zip_file.entries()
+		while entries.hasMoreElements():
+			entry = entries.nextElement()
+			if not entry.getName().endswith(".roi"):
+				continue
+			entry_stream = zip_file.getInputStream(entry)
+			entry_bytes = ByteArrayOutputStream()
+			read_buffer = zeros(8192, "b")
+			read_length = entry_stream.read(read_buffer)
+			while read_length > 0:
+				entry_bytes.write(read_buffer, 0, read_length)
+				read_length = entry_stream.read(read_buffer)
+			entry_stream.close()
+			ROI_set.append((entry.getName(), RoiDecoder(entry_bytes.toByteArray(), entry.getName()).getRoi()))
+	finally:
+		zip_file.close()
+	return ROI_set
+
+#Save a list of (file name, ROI) pairs as a RoiSet.zip. It is written to a temporary file first, so an interrupted run never leaves a half-written zip that looks up to date
+def write_ROI_set_zip(ROI_set, ROI_set_zip):
+	zip_stream = ZipOutputStream(BufferedOutputStream(FileOutputStream(ROI_set_zip + ".tmp")))
+	zip_data = DataOutputStream(zip_stream)
+	ROI_encoder = RoiEncoder(zip_data)
+	for ROI_name, ROI_to_save in ROI_set:
+		zip_stream.putNextEntry(ZipEntry(ROI_name))
+		ROI_encoder.write(ROI_to_save)
+		zip_data.flush()
+	zip_data.close()
+	if os.path.exists(ROI_set_zip):
+		os.remove(ROI_set_zip)
+	os.rename(ROI_set_zip + ".tmp", ROI_set_zip)
+
+#Open every .roi file in the folder of an image (and its subfolders), sorted by name so the order doesn't depend on the file system. Each ROI is named by
+#its path inside the folder with "/" (same as the entries of the zip), so a ROI directly in the folder keeps its file name and two ROIs with the same name in
+#different subfolders don't collide
+def read_ROI_folder(ROI_folder):
+	ROI_set = []
+	for ROI_temp_directory, subfolders, ROIs in os.walk(ROI_folder):
+		subfolders.sort()
+		for ROI in sorted(ROIs):
+			if ROI.endswith(".roi"):
+				ROI_path = os.path.join(ROI_temp_directory, ROI)
+				ROI_set.append((os.path.relpath(ROI_path, ROI_folder).replace(os.sep, "/"), RoiDecoder.open(ROI_path)))
+	return ROI_set
+
+#Read all the ROIs of one image, from "<image>_RoiSet.zip" if it is newer than the folder of the image, otherwise from the folder (saving them as the zip if
+#save_zip is True). Returns a list of (name, ROI) pairs, where the name is the path of the .roi file inside the folder of the image
+def load_ROI_set(ROI_sets_directory, image_name, save_zip=False):
+	ROI_folder = os.path.join(ROI_sets_directory, image_name)
+	ROI_set_zip = os.path.join(ROI_sets_directory, image_name + "_RoiSet.zip")
+	folder_time = os.path.getmtime(ROI_folder) if os.path.isdir(ROI_folder) else None
+	if os.path.isfile(ROI_set_zip) and ((folder_time == None) or (os.path.getmtime(ROI_set_zip) >= folder_time)):
+		return read_ROI_set_zip(ROI_set_zip)
+	ROI_set = read_ROI_folder(ROI_folder)
+	if save_zip and ROI_set:
+		write_ROI_set_zip(ROI_set, ROI_set_zip)
+	return ROI_set
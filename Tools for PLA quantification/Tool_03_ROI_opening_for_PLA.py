@@ -1,7 +1,7 @@
 ######################################################################################################################################################################
 '''
 
-Full name of script: Tool 03 to open ROIs for Proximity Ligation Assay (PLA) quantification  [Version 02]
+Full name of script: Tool 03 to open ROIs for Proximity Ligation Assay (PLA) quantification  [Version 03]
 
 Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-)
 
@@ -18,19 +18,23 @@ Made by: Eduardo Reyes Alvarez
 
 Contact: eduardo_reyes09@hotmail.com
 
-Last update: Aug 23, 2022
+Last update: Oct 17, 2026
 
 Version History:
 V01 (Aug 23, 2022): First working version, fully annotated. 
 V02 (Sept 06, 2022): Minor adjustment to 1 line, where we replace the path of "For Presentation", for "For Analysis" to find the second ROI, just added the extension
                      .roi because some folders have 2 sections were "_2" can be found, like ".../Row_16_20/0_2.roi" and thus both were changed to ".../Row_16_10/0_1.roi"
                      which can't be found and cause multiple error messages from the ROI manager. Fixed issue, fully working now and everything else is the same.
+V03 (Oct 17, 2026): If the PLA quantification script saved the ROIs of the image as "<image>_RoiSet.zip" (and the zip is newer than the folder), the ROIs are read
+                    from the zip in one go instead of opening each .roi file, which is much faster on network drives. Otherwise the folders are read as before.
+                    The ROIs are read by the shared ROI_sets.py (same reader and order as the PLA quantification script).
 
 '''
 ######################################################################################################################################################################
 ################################################### Import neccesary packages and make the interactive menu ##########################################################
 
 import os
+import sys
 import time
 from datetime import datetime
 from ij import IJ, ImagePlus
@@ -38,6 +42,13 @@ from ij import WindowManager
 from ij.plugin.frame import RoiManager
 from ij.gui import Roi
 
+#The ROIs are read by ROI_sets.py, same as the PLA quantification script (in the same folder of the repository as this script, or copied to Fiji.app/jars/Lib)
+try:
+	from ROI_sets import load_ROI_set
+except ImportError:
+	sys.path.append(os.path.dirname(os.path.abspath(globals().get("__file__", ""))))
+	from ROI_sets import load_ROI_set
+
 
 IJ.run("Collect Garbage", "")
 
@@ -55,22 +66,25 @@ image_name = image_name.split("X_")[1]
 
 #Prepare the directories for the ROIs
 ROIs_folder = os.path.join(os.path.split(os.path.split(image_processed_directory)[0])[0], "ROIs")
-presentation_ROIs_folder = os.path.join(ROIs_folder, "For Presentation", image_name)
-analysis_ROIs_folder = os.path.join(ROIs_folder, "For Analysis", image_name)
+
+#Read the two sets of ROIs (from "<image>_RoiSet.zip" if it is newer than the folder, otherwise from the folder, in the same order as the PLA quantification
+#script), the ones "For Analysis" are found by their name (with the subfolder they are in) to pair them with the ones "For Presentation"
+presentation_ROIs = load_ROI_set(os.path.join(ROIs_folder, "For Presentation"), image_name)
+analysis_ROIs = dict(load_ROI_set(os.path.join(ROIs_folder, "For Analysis"), image_name))
 
 #Initialize the ROI manager
 rm = RoiManager()
 
-#Iterate for all the ROIs fond in the "For Presentation" folder
-for ROI_folder, subfolder, ROIs in os.walk(presentation_ROIs_folder):
+#Iterate for all the ROIs found in the "For Presentation" set
+for ROI, presentation_ROI in presentation_ROIs:
+	
+	#Add each ROI found in the For Presentation set
+	rm.addRoi(presentation_ROI)
 	
-	for ROI in ROIs:
-		
-		#Open each ROI found in the For Presentation folder
-		rm.runCommand("Open", os.path.join(ROI_folder, ROI))
-		
-		#Open each ROI with the same name but in the For Analysis Folder
-		rm.runCommand("Open", os.path.join(ROI_folder, ROI).replace("Presentation", "Analysis").replace("_2.roi", "_1.roi"))
+	#Add the ROI with the same name but in the For Analysis set
+	analysis_ROI = analysis_ROIs.get(ROI.replace("_2.roi", "_1.roi"))
+	if analysis_ROI != None:
+		rm.addRoi(analysis_ROI)
 
 #Let the user know the script is done
 print("\n \t All the ROIs have been opened!")
@@ -1,7 +1,7 @@
 ############################################################################################################################################################
 '''
 
-Full name of script: Whole image processing for automated PLA experiments [Version 01]
+Full name of script: Whole image processing for automated PLA experiments [Version 02]
 
 Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-)
 
@@ -24,7 +24,7 @@ Made by: Eduardo Reyes Alvarez
 
 Contact: eduardo_reyes09@hotmail.com
 
-Last update: July 14, 2022
+Last update: October 17, 2026
 
 Version History:
 V01 (July 14, 2022): First version where all the individual parts that were written separately are fully integrated and working. The code is fully annotated
@@ -37,6 +37,31 @@ V01 (July 14, 2022): First version where all the individual parts that were writ
                      know when the script is done in case a separate PC is used to run the script. 3)Make the option to iterate through multiple condition/
                      experiment folders automatically. 4)A checkbox for optional deletion of the folders containing merged images and stitched images at the
                      end of the script (in case the user only needs to keep the final, processed images.
+V02 (October 17, 2026): The names of the raw images are parsed by the shared EVOS_file_index.py (one regular expression instead of splitting the names, with
+                     a check for missing planes and an index saved next to the Raw Images folder). The merged, stitched and processed images are saved
+                     by the shared TIFF_writer.py, with the option to compress them (LZW or Deflate) or save them as BigTIFF (only the stitched images,
+                     the merged and processed ones are opened by ImageJ later and are saved uncompressed instead).
+                     The hand-typed list used to rename the merged images for the stitching was replaced by the shared EVOS_tile_layout.py, which computes
+                     the position of each FOV from the size of the grid and the acquisition order (new options in the menu) and writes TileConfiguration
+                     files, so the images are no longer renamed and any area or scan order can be stitched without editing the script.
+                     The stitching fuses all the channels and slices of each block into one hyperstack in memory that is saved directly, instead of writing
+                     each slice of each channel to the disk and opening, stacking and merging them again.
+                     The Z-projection is made by the shared Z_projector.py, which reads one plane at a time from the stitched images instead of opening them
+                     completely, so only the projection is kept in memory (no waits to collect the garbage). The projection can be selected in the menu.
+                     The fixed waits (time.sleep) and garbage collections between steps were replaced by the shared Pipeline_runner.py, which waits until
+                     the image is there, the file is saved or there is enough free memory, and prints how long each wait took.
+                     Each part is now a stage with the files it reads and saves (run by the shared Pipeline_runner.py, see the end of the script), and
+                     only the parts with images missing or older than their inputs or settings are run, like make does (pending 1 of V01). For example,
+                     changing only the stitching parameters runs the stitching and projection again but not the merging. A new option of the menu runs
+                     all of them again. The stitching reads the positions of the FOVs from the TileConfiguration.txt saved by Part 2 (one of its inputs).
+                     The stitched blocks are saved while the next block is fused, as many at once as the free memory allows (measured for each block from the
+                     size of the tiles, channels and slices), and each stitched image is named with its rows (Row_01_05...) instead of a list of names for
+                     each slide.
+                     The blocks of rows are planned by default from the size, bit depth, channels and slices of the FOVs and the memory of ImageJ (the fewest
+                     blocks that fit, with the rows shared evenly), and the predicted memory of each block is printed. The rows and first images can still
+                     be given by hand (the default). The automatic plan is saved and used again while the grid and FOVs don't change, so a different memory
+                     doesn't rename the blocks. The images of blocks that are not in the current plan are never deleted, they are listed with a warning
+                     and only the blocks of the plan are stitched and projected.
 
 '''
 
@@ -45,12 +70,33 @@ V01 (July 14, 2022): First version where all the individual parts that were writ
 ########################################## Import neccesary packages and make the interactive menu #########################################################
 
 import os
-import time
+import sys
+import re
+import json
 from datetime import datetime
-from ij import IJ, ImagePlus
+from ij import IJ
 from ij import WindowManager
-from ij.plugin.frame import RoiManager
-from ij.gui import Roi
+from ij.io import Opener
+from java.lang import Runtime
+from threading import Lock
+from java.util.concurrent import Executors, ExecutorCompletionService, Callable, ExecutionException, Semaphore
+
+#The EVOS file names are parsed by EVOS_file_index.py, the FOVs are placed in the grid by EVOS_tile_layout.py, the images are saved by TIFF_writer.py and
+#projected by Z_projector.py. The waits between steps are done by Pipeline_runner.py (all in the folder "Tools for EVOS-M7000 images" of the repository,
+#or copied to Fiji.app/jars/Lib)
+try:
+	from EVOS_file_index import build_EVOS_index, EVOS_images_data
+	from EVOS_tile_layout import stitching_grid_positions, write_tile_configuration, read_tile_configuration, stitching_memory, block_name, plan_stitching_blocks
+	from TIFF_writer import save_TIFF
+	from Z_projector import project_Z, PROJECTION_PREFIXES
+	from Pipeline_runner import wait_for_file, wait_for_image, wait_for_memory, free_memory, print_wait_summary, save_stage_settings, run_stages
+except ImportError:
+	sys.path.append(os.path.join(os.path.dirname(os.path.abspath(globals().get("__file__", ""))), "..", "..", "Tools for EVOS-M7000 images"))
+	from EVOS_file_index import build_EVOS_index, EVOS_images_data
+	from EVOS_tile_layout import stitching_grid_positions, write_tile_configuration, read_tile_configuration, stitching_memory, block_name, plan_stitching_blocks
+	from TIFF_writer import save_TIFF
+	from Z_projector import project_Z, PROJECTION_PREFIXES
+	from Pipeline_runner import wait_for_file, wait_for_image, wait_for_memory, free_memory, print_wait_summary, save_stage_settings, run_stages
 
 #@ File    (label = "Experiment folder", style = "directory") experiment_directory
 #@ String (visibility=MESSAGE, value="For Brightfield select Gray (check images are saved as Mono and not RGB)", required=false) msg1
@@ -61,7 +107,11 @@ from ij.gui import Roi
 #@String   (label = "Channel 3 colour: ", style = "listBox", choices = { "", "Red", "Green", "Blue", "Gray", "Cyan", "Magenta" }) ch3_color
 #@String   (label = "Channel 4 colour: ", style = "listBox", choices = { "", "Red", "Green", "Blue", "Gray", "Cyan", "Magenta" }) ch4_color
 #@String   (label = "Image name keyword") name_key
-#@ String (visibility=MESSAGE, value="Specify below the rows to stitch (all columns will be used)", required=false) msg3
+#@ Integer (label="Columns acquired (whole area)", min=1, max=200, value=7) acquisition_columns
+#@ Integer (label="Rows acquired (whole area)", min=1, max=200, value=51) acquisition_rows
+#@ String  (label="Acquisition order", style = "listBox", choices = {"Snake by columns", "Snake by rows", "Raster by rows", "Raster by columns"}) acquisition_order
+#@ String  (label="Blocks of rows to stitch", style = "listBox", choices = {"Manual (rows and first images below)", "Automatic (from the memory of ImageJ)"}) stitching_plan
+#@ String (visibility=MESSAGE, value="Specify below the columns to stitch (and the rows, only for manual blocks)", required=false) msg3
 #@ Integer (label="Columns", style="slider", min=1, max=10, stepSize=1) grid_size_x
 #@ Integer (label="Rows", style="slider", min=1, max=10, stepSize=1) grid_size_y1
 #@ String (visibility=MESSAGE, value="If the rows above gives an uneven number of residual rows, specify here:", required=false) msg4
@@ -69,6 +119,9 @@ from ij.gui import Roi
 #@ Integer (label="Tile overlap (%)", min=1, max=100, value=20) tile_overlap
 #@ String (visibility=MESSAGE, value="Numbers separated by comma (0,35,70...)", required=false) msg5
 #@ String (label="First image of each area to stitch", description="Name field") stitching_index
+#@ String  (label="TIFF compression of the images saved", style = "listBox", choices = {"Uncompressed", "LZW", "Deflate", "BigTIFF"}) TIFF_compression
+#@ String  (label="Z-projection of the stitched images", style = "listBox", choices = {"Max Intensity", "Average Intensity", "Sum Slices"}) projection_method
+#@ Boolean (label="Run all the parts again (even the ones with images up to date)", value=false) rerun_all
 #@ String (visibility=MESSAGE, value="Script made by: Eduardo Reyes-Alvarez", required=false) msg6
 
 #Start the MAIN timer
@@ -82,50 +135,17 @@ experiment_directory = experiment_directory.getAbsolutePath()
 
 ####################################################### Retrieving information of raw images ###############################################################
 
-#Start the timer
-starting_time = datetime.now()
-
 #Get full path of where to look for the raw images
 raw_image_directory = os.path.join(experiment_directory, "Raw Images")
 
 #From the directory obtained in the input, we will scan all images and extract information from their name to sort, group, and open in order
 
-#The EVOS M700 saves the images in this format, which is retrieved as a string: ExperimentName_Bottom Slide_R_p00_z00_0_A00f00d0.tif
-	#The R means Raw (could be M for Merged or something else)
-	#The p00 might be for time lapses, as well as the _0_
-	#The z00 is the slice number, usually two numbers from 00 to 20 or 30 (99 or 3 numbers almost never)
-	#The A00 is the areas imaged. For a channel slide could vary from 00-05 (6 channels) but it is recommended to acquire and save one at the time
-	#The f00 is the number of fields of view imaged, and could  be 2 or 3 numbers (depending on settings 00-999)
-	#The d0 is the number of channel, which can be 0-4 given the capabilities of the equipment
-
-#Collect all the image information as sublists in this list
-images_data = []
-
-#Walk through all the images in the raw image folder (The only subfolder allowed MUST be named Merged and MUST be empty)
-for directory, subfolder, raw_images in os.walk(raw_image_directory):
-	for image in raw_images:
-		
-		#Get the name of the current image and remove the .tif from the name
-		trimmed_image_name = os.path.splitext(image)[0]
-			
-		#Remove the left side of the name delimited by _p00_z, to get something like: 00_0_A00f00d00
-		trimmed_image_name = trimmed_image_name.split("_p00_z")[1]
-		
-		#The last number is the channel number
-		channel = trimmed_image_name[-1]
-
-		#The first 2 numbers now correspond to the slice number
-		zslice = trimmed_image_name[0:2]
-			
-		#Since the FOV can be 2 or 3 numbers, we get it by trimming whatever is between the delimitors f__d
-		trimmed_image_name = trimmed_image_name.split("d")[0]
-		FOV = trimmed_image_name.split("f")[1]
-
-		#Append a list with the info of the current image to our main list, transforming the strings to integers to make processing easier
-		images_data.append([os.path.join(directory, image), int(FOV), int(channel), int(zslice)])
-
-#Once the data from all images has been extracted, sort by FOV, then by channel, then by slice
-images_data.sort(key = lambda x : (x[1], x[2], x[3]))
+#The names are parsed by the shared EVOS_file_index.py, which gets the area, FOV, channel, slice and timepoint of each image with one regular expression,
+#checks that no plane is missing and keeps the index next to the folder (Raw Images_index.json) so the folder is only scanned again if it changes
+index = build_EVOS_index(raw_image_directory)
+
+#Get the images as a list of [path, FOV, channel, slice], sorted by FOV, then by channel, then by slice
+images_data = EVOS_images_data(index)
 	
 #Print the FOV, channel and slice extracted from the images as a control in case there is an error or mismatch [No longer needed but left here]
 #for i in images_data:
@@ -150,6 +170,10 @@ for i,color_input in enumerate([ch0_color, ch1_color, ch2_color, ch3_color, ch4_
 			channels_to_merge = channels_to_merge + ("c"+str(ii+1)+"=[Stack_channel_"+str(i)+"] ")
 			break
 
+#Memory needed to open, stack and merge the planes of one FOV (each plane is in memory twice, the raw image and the stack)
+raw_image_info = Opener.getTiffFileInfo(images_data[0][0])[0]
+FOV_memory = 2 * raw_image_info.width * raw_image_info.height * raw_image_info.getBytesPerPixel() * len(images_data) // len(set(image_info[1] for image_info in images_data))
+
 #Make a subdirectory in the folder to save all the hyperstacks made
 hyperstack_saving_path = os.path.join(raw_image_directory + "_Merged")
 if not os.path.exists(hyperstack_saving_path):
@@ -158,122 +182,115 @@ if not os.path.exists(hyperstack_saving_path):
 ############################################################ Deciding action to do for each image ##########################################################
 
 
-#The previous section produces a list where all the slices for each channel for one FOV are ordered together, then next channel and so on, same for next FOV
-#We need to open all the images no matter what, we just need to decide when to do the stacking and merging+saving
-
-#We will use some control variables to notice when the current image corresponds to a different channel or FOV
-#For several exceptions, it is better to retrieve the first FOV and channel from the first image in our list
-control_FOV = images_data[0][1]
-control_channel = images_data[0][2]
-image_index = 0
-
-#In this loop we decide whether something is needed before opening an image (for the very 1st image, we compare to the control variables above)
-#Since we open the image at the very end of the loop, we need to enter one more time after the last picture was open, so we can stack, merge and save
-while image_index <= len(images_data):
-
-	#First, we get the list of directory, FOV, Ch, Slice for the current image
-	#The conditional here avoids an error once the image index is out of range of the image data elements
-	image_info = images_data[image_index] if image_index < len(images_data) else images_data[image_index-1]
-
-	#Extract the working FOV and channel for simplicity
-	current_FOV = image_info[1]
-	current_channel = image_info[2]
-
-	#Second, check whether we need to make a stack right now (when Ch or FOV change or when we are in the very last image 
-	if control_FOV != current_FOV or control_channel != current_channel or image_index == len(images_data):
-		#If true, we make a stack selecting only newly opened images (with a string in the name) so we leave untouched existing stacks for other channels
-		IJ.run("Images to Stack", "name=Stack title="+name_key+" use")                                                          
-		stack = WindowManager.getImage("Stack")
-		stack.setTitle("Stack_channel_" + str(control_channel))
-
-		#If we did a stack then we are done with the previous channel and we need to update the control channel to be aware of future changes
-		control_channel = current_channel
-
-		#Since we combined lots of images into one (still existing), we empty some memory (may not be much)
-		IJ.run("Collect Garbage", "")
-
-		#Third, if the info of the image to be opened corresponds to a new FOV (or it is the very last image), merge all channels if needed, save and close
-		if control_FOV != current_FOV or image_index == len(images_data):
-
-			#If we only have one channel, we don't need to run the merge plugin (will cause an error)
-			if total_channels > 1:        
-				IJ.run("Merge Channels...",  channels_to_merge+"create")
-				#A small placeholder just in case it is too heavy
-				time.sleep(0.5)
-
-				#Select and get the merge before saving it
-				IJ.selectWindow("Composite")
-				hyperstack = IJ.getImage()
-				
-			#Save the stack or hyperstack
-			save_FOV_as = os.path.join(hyperstack_saving_path, "FOV_"+str(control_FOV))
-			image_to_save = hyperstack if total_channels > 1 else stack
-			IJ.saveAs(image_to_save, "Tiff", save_FOV_as)
-
-			#Print a counter to keep track of the progress with total number of FOVs and add a placeholder of 3s (for heavy images or slow computers)
-			print("Fields of view completed:", control_FOV+1, "/", total_FOVs+1) 
-			time.sleep(3)
-
-			#Once saved, close everything, reset the memory and update the control FOV before opening the image
-			IJ.run("Close All")
-			IJ.run("Collect Garbage", "")
-			control_FOV = current_FOV
-
-			#After the final image is saved, we no longer need the loop so we exit it to prevent errors
-			if image_index == len(images_data):
-				break
-	
-	#Fourth, once we collect the info, check for new stack, and check for new FOV... we open, show and get the current image
-	current_raw_image = IJ.openImage(image_info[0])
-	current_raw_image.show()
-	image_opened = WindowManager.getWindow(os.path.split(image_info[0])[1])
-
-	#If the image is heavy or PC resources low, ImageJ will take a moment to open it, so use a placeholder checking every 0.1s until is open
-	while image_opened==None:
-		time.sleep(0.1)
-	
-	#Print a counter to keep track of the progress for the images processed vs the total in the folder, and update the image index [No longer needed]
-	#print("Image:", image_index+1, "/", len(images_data))
-	image_index = image_index + 1
+#Merge all the raw images into one hyperstack per FOV (first stage of the pipeline, see the end of the script)
+def merge_FOVs():
+
+	#Start the timer
+	starting_time = datetime.now()
+
+	#The previous section produces a list where all the slices for each channel for one FOV are ordered together, then next channel and so on, same for next FOV
+	#We need to open all the images no matter what, we just need to decide when to do the stacking and merging+saving
+
+	#We will use some control variables to notice when the current image corresponds to a different channel or FOV
+	#For several exceptions, it is better to retrieve the first FOV and channel from the first image in our list
+	control_FOV = images_data[0][1]
+	control_channel = images_data[0][2]
+	image_index = 0
+
+	#In this loop we decide whether something is needed before opening an image (for the very 1st image, we compare to the control variables above)
+	#Since we open the image at the very end of the loop, we need to enter one more time after the last picture was open, so we can stack, merge and save
+	while image_index <= len(images_data):
+
+		#First, we get the list of directory, FOV, Ch, Slice for the current image
+		#The conditional here avoids an error once the image index is out of range of the image data elements
+		image_info = images_data[image_index] if image_index < len(images_data) else images_data[image_index-1]
+
+		#Extract the working FOV and channel for simplicity
+		current_FOV = image_info[1]
+		current_channel = image_info[2]
+
+		#Second, check whether we need to make a stack right now (when Ch or FOV change or when we are in the very last image 
+		if control_FOV != current_FOV or control_channel != current_channel or image_index == len(images_data):
+			#If true, we make a stack selecting only newly opened images (with a string in the name) so we leave untouched existing stacks for other channels
+			IJ.run("Images to Stack", "name=Stack title="+name_key+" use")                                                          
+			stack = wait_for_image(lambda: WindowManager.getImage("Stack"), "stack of channel "+str(control_channel)+" of FOV "+str(control_FOV))
+			stack.setTitle("Stack_channel_" + str(control_channel))
+
+			#If we did a stack then we are done with the previous channel and we need to update the control channel to be aware of future changes
+			control_channel = current_channel
+
+			#Third, if the info of the image to be opened corresponds to a new FOV (or it is the very last image), merge all channels if needed, save and close
+			if control_FOV != current_FOV or image_index == len(images_data):
+
+				#If we only have one channel, we don't need to run the merge plugin (will cause an error)
+				if total_channels > 1:        
+					IJ.run("Merge Channels...",  channels_to_merge+"create")
 
-################################################################### End of the merging #####################################################################
+					#Get the merge before saving it (as soon as it is ready)
+					hyperstack = wait_for_image(lambda: WindowManager.getImage("Composite"), "merge of FOV "+str(control_FOV))
 
-#Finish the timer and get the total number of seconds spent
-ending_time = datetime.now()
-merging_time = (ending_time.getTime() - starting_time.getTime())/1000.00
+				#Save the stack or hyperstack
+				save_FOV_as = os.path.join(hyperstack_saving_path, "FOV_"+str(control_FOV))
+				image_to_save = hyperstack if total_channels > 1 else stack
+				wait_for_file(save_TIFF(image_to_save, save_FOV_as, TIFF_compression))
 
-#Print a summary of the work done and time it required
-print("Images processed:", len(images_data), "Hyperstacks made:", total_FOVs+1, "Merging time (min):", round(merging_time/60, 1))
+				#Print a counter to keep track of the progress with total number of FOVs
+				print("Fields of view completed:", control_FOV+1, "/", total_FOVs+1) 
+
+				#Once saved, close everything, check there is memory for the next FOV and update the control FOV before opening the image
+				IJ.run("Close All")
+				wait_for_memory(FOV_memory, "FOV "+str(current_FOV))
+				control_FOV = current_FOV
+
+				#After the final image is saved, we no longer need the loop so we exit it to prevent errors
+				if image_index == len(images_data):
+					break
+
+		#Fourth, once we collect the info, check for new stack, and check for new FOV... we open, show and get the current image
+		current_raw_image = IJ.openImage(image_info[0])
+		current_raw_image.show()
+
+		#If the image is heavy or PC resources low, ImageJ will take a moment to show it, so wait until its window is there
+		wait_for_image(lambda: WindowManager.getImage(current_raw_image.getTitle()), os.path.split(image_info[0])[1])
+
+		#Print a counter to keep track of the progress for the images processed vs the total in the folder, and update the image index [No longer needed]
+		#print("Image:", image_index+1, "/", len(images_data))
+		image_index = image_index + 1
+
+	################################################################### End of the merging #####################################################################
+
+	#Finish the timer and get the total number of seconds spent
+	ending_time = datetime.now()
+	merging_time = (ending_time.getTime() - starting_time.getTime())/1000.00
+
+	#Print a summary of the work done and time it required
+	print("Images processed:", len(images_data), "Hyperstacks made:", total_FOVs+1, "Merging time (min):", round(merging_time/60, 1))
 
 
 ############################################################################################################################################################
-######################################################## PART 2 - RENAME THE IMAGES FOR STITCHING ##########################################################
-
-###################################### Create the sequence of re-ordered numbers and replace the current names #############################################
-
-#To create this sequence, make an excel file with the acquisition info+grid, then copy+paste them here in the right order (Serpentine Vertical)
-#This part only works for 15% of a channel slide at 40x from the center with more overlap, scanned serpentine vertically, needs manual edits for others
-new_names = [ 0, 7, 14, 21, 28, 35, 42, 49, 56, 63, 70, 77, 84, 91, 98,  105, 112, 119, 126, 133, 140, 147, 154, 161, 168, 175,  182, 189, 196, 203, 210,
-             217, 224, 231, 238, 245, 252, 259, 266, 273, 280, 287, 294, 301, 308, 315, 322, 329, 336, 343, 350, 351, 344, 337, 330, 323, 316, 309, 302,
-             295, 288, 281, 274, 267, 260, 253, 246, 239, 232, 225, 218, 211, 204, 197, 190, 183, 176, 169, 162, 155, 148, 141, 134, 127, 120, 113, 106,
-             99, 92, 85, 78, 71, 64, 57, 50, 43, 36, 29, 22, 15, 8, 1, 2, 9, 16, 23, 30, 37, 44, 51, 58, 65, 72, 79, 86, 93, 100, 107, 114, 121, 128,
-             135, 142, 149, 156, 163, 170, 177, 184, 191, 198, 205, 212, 219, 226, 233, 240, 247, 254, 261, 268, 275, 282, 289, 296, 303, 310, 317, 324,
-             331, 338, 345, 352, 353, 346, 339, 332, 325, 318, 311, 304, 297, 290, 283, 276, 269, 262, 255, 248, 241, 234, 227, 220, 213, 206, 199, 192,
-             185, 178, 171, 164, 157, 150, 143, 136, 129, 122, 115, 108, 101, 94, 87, 80, 73, 66, 59, 52, 45, 38, 31, 24, 17, 10, 3, 4, 11, 18, 25, 32,
-             39, 46, 53, 60, 67, 74, 81, 88, 95, 102, 109, 116, 123, 130, 137, 144, 151, 158, 165, 172, 179, 186, 193, 200, 207, 214, 221, 228, 235, 242,
-             249, 256, 263, 270, 277, 284, 291, 298, 305, 312, 319, 326, 333, 340, 347, 354, 355, 348, 341, 334, 327, 320, 313, 306, 299, 292, 285, 278,
-             271, 264, 257, 250, 243, 236, 229, 222, 215, 208, 201, 194, 187, 180, 173, 166, 159, 152, 145, 138, 131, 124, 117, 110, 103, 96, 89, 82, 75,
-             68, 61, 54, 47, 40, 33, 26, 19, 12, 5, 6, 13, 20, 27, 34, 41, 48, 55, 62, 69, 76, 83, 90,	97, 104, 111, 118, 125, 132, 139, 146, 153, 160,
-             167, 174, 181, 188, 195, 202, 209, 216, 223, 230, 237, 244, 251, 258, 265, 272, 279, 286, 293, 300, 307, 314, 321, 328, 335, 342, 349, 356]
-			  
-#To avoid problems with natural sorting, we don't scan the folder with os.walk, instead, we know from the acquisition excel file what number was given and
-#what number should be, so we just iterate through the indices of the list above, which we know goes 0...356, locate the corresponding image, and rename it
-for old_index, new_index in enumerate(new_names):
-	old_name = os.path.join(hyperstack_saving_path, ("FOV_"+str(old_index)+".tif"))
-	new_name = os.path.join(hyperstack_saving_path, ("Image_"+str(new_index)+".tif"))
-	os.rename(old_name, new_name)
-
-print("Images succesfully renamed and ready for stitching...")
+######################################################## PART 2 - PLACE THE IMAGES IN THE GRID FOR STITCHING ##############################################
+
+######################################## Compute the position of each FOV from the acquisition order and save it ############################################
+
+#Before, a list typed from an excel file with the acquisition info+grid was used to rename every FOV_k.tif to Image_{position in the grid}.tif (only valid
+#for one size of area and scanned serpentine vertically). Now the column and row of each FOV are computed by EVOS_tile_layout.py from the size of the grid
+#and the acquisition order given in the menu, and the stitching reads them from TileConfiguration files, so the merged images keep their names.
+#The columns to stitch (Columns in the menu) make bands of the grid placed one below the other, so the rows given in Part 3 count from the first row of the
+#first band to the last row of the last band (a last band narrower than the others is not stitched)
+tile_configuration_path = os.path.join(hyperstack_saving_path, "TileConfiguration.txt")
+
+#Compute the position of each FOV in the stitching grid and save the positions of all of them (the blocks stitched in Part 3 read the rows they need from
+#this file). The size of the tiles is read from the header of the first merged image
+def place_FOVs():
+	FOV_positions = stitching_grid_positions(total_FOVs+1, acquisition_columns, acquisition_rows, acquisition_order, grid_size_x)
+	FOV_tiles = sorted([("FOV_"+str(FOV)+".tif", column, row) for FOV, (column, row) in FOV_positions.items()], key = lambda tile: (tile[2], tile[1]))
+	tile_info = Opener.getTiffFileInfo(os.path.join(hyperstack_saving_path, FOV_tiles[0][0]))[0]
+	total_slices = len(set(image_info[3] for image_info in images_data))
+	tile_dimensions = 3 if total_slices > 1 else 2
+	if len(FOV_tiles) < total_FOVs+1:
+		print("FOVs left out of the stitching (last band of columns narrower than the others):", total_FOVs+1-len(FOV_tiles))
+	write_tile_configuration(tile_configuration_path, FOV_tiles, tile_info.width, tile_info.height, tile_overlap, tile_dimensions)
+	print("Tile positions computed and ready for stitching...")
 
 
 ############################################################################################################################################################
@@ -289,16 +306,23 @@ index of first images 0 and 35, with 7 cols and 5 rows, the result would be only
 folder. The only exception is when we have a non-easy to evenly divide the rows, for example, if we have 51, it is easy to do 10 images with 5 rows each,
 but we will have an extra row. For this reason, the script asks for the number of rows for the last image, so we can do 9 images 7 by 5, and the last 7 by 6
 to use all data available. Note that the maximum for the 7-8gb of RAM would be around 42 images, so we could not make 5 images 7 by 10.
-
-Until 2022, ImageJ comes with a plug-in called Grid Stitching included. The settings below correspond to selecting in this plug-in's menu Grid row by row,
-up and down, the size of the grid and overlap is asked to the user, the fusion method is linear blending with the parameters given by default (regression
-threshold 0.3, max/avg displacement threshold 2.5, and absolute displacement threshold 3.5) -these numbers were not adjusted/tested in more detail due to 
-time constraints-. Also, this code will save each slice stitched of each channel directly to the directory without showing the result (until the part 4).
+The blocks can also be planned automatically (option of the menu): the memory each block needs is computed from the size, bit depth, channels and slices
+of the FOVs, and each band of columns is cut in the fewest blocks that fit in the maximum memory of ImageJ. The rows are shared evenly, so the blocks differ
+by one row at most and the taller ones go last (for example, 51 rows with memory for 5 give four images 7 by 4 and seven 7 by 5). If not even one row fits,
+the script stops and asks for more memory. The plan is saved in "Pipeline settings/Stitching plan.json" and used again in the next runs, so opening
+ImageJ with a different memory doesn't change the blocks. The manual option (default) uses the rows and first images given by the user.
+
+Until 2022, ImageJ comes with a plug-in called Grid Stitching included. The settings below correspond to selecting in this plug-in's menu Positions from
+file, with the TileConfiguration of each block made from the positions of Part 2 (the size of the grid and overlap is asked to the user), the fusion
+method is linear blending with the parameters given by default (regression threshold 0.3, max/avg displacement threshold 2.5, and absolute displacement
+threshold 3.5) -these numbers were not adjusted/tested in more detail due to time constraints-. Also, all the channels and slices are fused into one
+hyperstack in memory, which is saved directly in the Raw Images_Stitched folder (no files for each slice of each channel are written and opened again).
+The blocks don't share any data, so they are done by a pool of workers, limited by the memory each block needs (a PC with more memory keeps more
+blocks at once, one with 8gb does them one after the other like before). The plug-in fuses one block at a time (all its results are called "Fused"),
+and the blocks already fused are saved while the next one is fused. The images are named with the rows of the stitching
+grid they have, for example Row_01_05 has the first 5 rows (the rows of the next bands of columns continue after the last row of the first band).
 '''
 
-#Start the timer
-starting_time = datetime.now()
-
 #Make folder to save stitched images
 stitching_saving_path = os.path.join(experiment_directory, "Raw Images_Stitched")
 if not os.path.exists(stitching_saving_path):
@@ -309,117 +333,176 @@ if not os.path.exists(stitching_saving_path):
 #Prepare the directory from a os.path to what is required for the stitching  plug-in
 data_directory = str(experiment_directory).replace("\\", "/")
 
-#Make a list of all the indeces of the first images to be stitched (given by the user, depends on how many want to be stitched together)
-first_image_index = stitching_index.split(",")
-merges_name = "Image"
-
-#Iterates to make big images starting in the given numbers
-for i,index in enumerate(first_image_index):
-
-	#Make a parcial time tracker to print how long it takes for each image to stitch (plus the whole stitching part separately)
-	parcial_time1 = datetime.now()
-	
-	#Pass the amount of rows that will be stitched together, which may be variable             
-	grid_size_y = grid_size_y1 if i<len(first_image_index)-1 else grid_size_y2
-
-	#Make sure to clear the memory to handle this much data processing
-	IJ.run("Collect Garbage", "")
-	time.sleep(5)
-	IJ.run("Collect Garbage", "")
-	
-	#Pass all the information needed for the Grid Stitching plug-in, which will save each slice for each channel separately without showing it
-	IJ.run("Grid/Collection stitching", "type=[Grid: row-by-row] order=[Right & Down                ] "+
-		   "grid_size_x="+str(grid_size_x)+" grid_size_y="+str(grid_size_y)+
-		   " tile_overlap="+str(tile_overlap)+" first_file_index_i="+index+
-		   " directory=["+data_directory+"/Raw Images_Merged] file_names="+merges_name+"_{i}.tif"+
-		   " output_textfile_name=TileConfiguration.txt fusion_method=[Linear Blending] regression_threshold=0.30"+
-		   " max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50"+
-		   " computation_parameters=[Save memory (but be slower)] image_output=[Write to disk] output_directory=["+data_directory+"/]")
-	
-	#Wait a bit after the calculations are done
-	time.sleep(5)
-	
-	#Locate each of the slices that the plug-in produced. This part requires manual edits if a number of slices is different than 4 (current).
-	#Add/delete for each colour the number of slices required, following the name format as below. This plug-in does C1=red, C2=green, C3=blue.
-	#For a 1/2 color image stitching, remove the corresponding list(s).
-	red_slices = [data_directory+"/img_t1_z1_c1",
-                data_directory+"/img_t1_z2_c1",
-                data_directory+"/img_t1_z3_c1",
-                data_directory+"/img_t1_z4_c1"]
-	
-	green_slices = [data_directory+"/img_t1_z1_c2",
-                  data_directory+"/img_t1_z2_c2",
-                  data_directory+"/img_t1_z3_c2",
-                  data_directory+"/img_t1_z4_c2"]
-	
-	blue_slices = [data_directory+"/img_t1_z1_c3",
-                 data_directory+"/img_t1_z2_c3",
-                 data_directory+"/img_t1_z3_c3",
-                 data_directory+"/img_t1_z4_c3"]
-	
-	#Prepare to open the stitched slices			   
-	IJ.run("Collect Garbage", "")
-	time.sleep(5)
-	
-	#Iterate through the lists above. This step also requires manual edits for 1/2 colour images.
-	for ii, channel in enumerate([red_slices, green_slices, blue_slices]):
-		colour_order = ["Red", "Green", "Blue"]
-	
-		#Open all the slices for the current channel and let them load properly
-		for channel_slice in channel:
-			current_slice = IJ.openImage(channel_slice)
-			while current_slice==None:
-				time.sleep(0.1)
-			current_slice.show()
-			time.sleep(3)
-	
-		#Make a stack for the current channel, wait and free any memory we can get
-		IJ.run("Images to Stack", "name=Stack_"+colour_order[ii]+" title=img use")  
-		time.sleep(10)                                                        
-		IJ.run("Collect Garbage", "")
-	
-	#Once the stacks for all the channels are ready, merge them. This step also requires manual edits for images with only 1/2 channels.
-	IJ.run("Merge Channels...",  "c1=Stack_Red c2=Stack_Green c3=Stack_Blue create")
-	time.sleep(10)
-	IJ.run("Collect Garbage", "")
-	
-	#Get the merged image into a variable
-	IJ.selectWindow("Composite")
-	Stitched_image = IJ.getImage()
-	
-	#Save the merged image with just an ascending number (does not especify yet which rows were used for it, that comes next)
-	IJ.saveAs(Stitched_image, "Tiff", os.path.join(stitching_saving_path, "Row_"+str(i+1)+".tif"))   
-	time.sleep(20)
-	Stitched_image.close()
-	IJ.run("Collect Garbage", "")
-	
-	#Remove this output slices once they have been merged, coloured and saved, so we don't have issues in case there are more/less in other folders
-	for slice_generated in (red_slices + green_slices + blue_slices):
-		os.remove(slice_generated)
-	IJ.run("Collect Garbage", "")
-	
-	#Parcial timer and a progress update for each stitched image                                 
-	parcial_time2 = datetime.now()
-	progress_time = (parcial_time2.getTime() - parcial_time1.getTime())/1000.00
-	print("Images stitched: ", i+1, "  Processing time for this image: ", round(progress_time/60, 1))
-
-#Make a list with the names we want on our stitched images. This part also requires manual edits if not used these numbers of rows.
-stitched_names = ["Row_01_05", "Row_06_10", "Row_11_15", "Row_16_20", "Row_21_25", "Row_26_30", "Row_31_35", "Row_36_40", "Row_41_45", "Row_46_51"]
-
-#Iterate through the images saved above and rename them.
-for iii, name in enumerate(stitched_names):
-	old_name = os.path.join(stitching_saving_path, "Row_"+str(iii+1)+".tif")
-	new_name = os.path.join(stitching_saving_path, name+".tif")
-	os.rename(old_name, new_name)
-
-################################################################### End of the stitching ###################################################################
-
-#Finish the timer and get the total number of seconds spent
-ending_time = datetime.now()
-stitching_time = (ending_time.getTime() - starting_time.getTime())/1000.00
-
-#Print a summary of the work done and time it required
-print("Total stitching time (min):", round(stitching_time/60, 1))
+#Get the blocks of rows to stitch, named with the rows they have (Row_01_05, Row_06_10...) instead of a list of names typed for each slide
+total_bands = acquisition_columns // min(grid_size_x, acquisition_columns)
+total_rows = total_bands * acquisition_rows
+
+#The planes (channels x slices) of each FOV are counted in the index of the raw images. The header of a merged FOV can't be used for this, since ImageJ
+#only sees the first plane of the LZW/Deflate files saved by TIFF_writer.py
+FOV_planes = len(images_data) // len(set(image_info[1] for image_info in images_data))
+stitching_blocks = []
+if stitching_plan.startswith("Automatic"):
+
+	#The blocks are planned from the size, bit depth and planes (channels x slices) of the merged FOVs (the raw images have the same size if they are not
+	#merged yet) and the maximum memory of ImageJ, so no block has more rows than fit (6-7 rows of 7 FOVs with 3 colours and 6 slices in 7.5gb).
+	#The plan is saved in "Pipeline settings" and used again in the next runs while the grid and the FOVs are the same, so running with a different memory
+	#doesn't change the blocks (and the names of the stitched images). Delete the file or run all the parts again to plan them for the current memory
+	tile_file = os.path.join(hyperstack_saving_path, "FOV_"+str(images_data[0][1])+".tif")
+	tile_file_info = Opener.getTiffFileInfo(tile_file)[0] if os.path.isfile(tile_file) else raw_image_info
+	stitching_plan_path = os.path.join(experiment_directory, "Pipeline settings", "Stitching plan.json")
+	stitching_layout = {"bands": total_bands, "rows": acquisition_rows, "columns": min(grid_size_x, acquisition_columns), "tile_width": tile_file_info.width,
+						"tile_height": tile_file_info.height, "tile_overlap": tile_overlap, "bytes_per_pixel": tile_file_info.getBytesPerPixel(), "planes": FOV_planes}
+	planned_blocks = None
+	if os.path.isfile(stitching_plan_path) and not rerun_all:
+		try:
+			with open(stitching_plan_path) as plan_file:
+				saved_plan = json.load(plan_file)
+			if saved_plan["layout"] == stitching_layout:
+				planned_blocks = [tuple(block) for block in saved_plan["blocks"]]
+				print("Stitching plan saved in", stitching_plan_path, "(planned for", saved_plan["memory"]//1048576, "MB of memory):")
+		except (ValueError, KeyError):
+			pass
+	if planned_blocks == None:
+		planned_blocks = plan_stitching_blocks(total_bands, acquisition_rows, min(grid_size_x, acquisition_columns), tile_file_info.width, tile_file_info.height,
+											   tile_overlap, tile_file_info.getBytesPerPixel(), FOV_planes, Runtime.getRuntime().maxMemory())
+		if not os.path.exists(os.path.dirname(stitching_plan_path)):
+			os.makedirs(os.path.dirname(stitching_plan_path))
+		with open(stitching_plan_path, "w") as plan_file:
+			json.dump({"layout": stitching_layout, "memory": Runtime.getRuntime().maxMemory(), "blocks": planned_blocks}, plan_file, indent=1, sort_keys=True)
+		print("Stitching plan for", Runtime.getRuntime().maxMemory()//1048576, "MB of memory (saved in", stitching_plan_path+"):")
+	for first_row, last_row, block_memory in planned_blocks:
+		stitching_blocks.append((block_name(first_row, last_row), first_row, last_row))
+		print(block_name(first_row, last_row), "-", min(grid_size_x, acquisition_columns), "x", last_row-first_row+1, "FOVs, memory needed (MB):", block_memory//1048576)
+else:
+
+	#Make a list of all the indeces of the first images to be stitched (given by the user, depends on how many want to be stitched together). The index of
+	#the first image is its position counted row by row, so the block starts in that row of the stitching grid (the last block has the rows given for the
+	#last image)
+	first_image_index = stitching_index.split(",")
+	for i,index in enumerate(first_image_index):
+		first_row = int(index) // grid_size_x
+		last_row = min(first_row + (grid_size_y1 if i<len(first_image_index)-1 else grid_size_y2), total_rows) - 1
+		stitching_blocks.append((block_name(first_row, last_row), first_row, last_row))
+stitched_names = [stitching_block[0] for stitching_block in stitching_blocks]
+
+#The names of the blocks change with the plan, so the images of the blocks of a previous plan (Row_xx_yy.tif, with or without the prefix of a projection) may
+#be in the folders. They are never deleted (they could be the only copy of a stitching), only listed so the user can move them before the quantification,
+#and they are skipped by the stitching and projection (only the blocks of the plan are done)
+def warn_old_blocks(directory, prefixes=("",)):
+	old_blocks = []
+	for file_name in sorted(os.listdir(directory)):
+		for prefix in prefixes:
+			block_match = re.match(re.escape(prefix) + r"(Row_\d+_\d+)\.tif$", file_name)
+			if (block_match != None) and (block_match.group(1) not in stitched_names):
+				old_blocks.append(file_name)
+				break
+	if old_blocks:
+		print("WARNING: images of blocks that are not in the current plan (skipped, move them out of the folder so they are not quantified twice):",
+			  directory, ", ".join(old_blocks))
+
+#The stitching plug-in (from the menu) shows every result as "Fused", so it is run by one block at a time: the block renames its result before the next one
+#starts, and only the saving and closing of the blocks is done at the same time
+stitching_plugin_lock = Lock()
+
+#Stitch the blocks of rows given in the menu and save them with the names of their rows. The blocks are independent, so they are done by a pool of
+#workers, as many at once as the memory of ImageJ allows: each block reserves the memory it needs (from the size of the tiles, channels and slices) and
+#waits if the blocks already running took it. The fusion is done by one block at a time, while the blocks already fused are saved
+def stitch_blocks():
+
+	#Start the timer
+	starting_time = datetime.now()
+
+	#Read the positions of the FOVs saved in Part 2 (all the merged FOVs have the size of the first one) and list the stitched images of the blocks that
+	#are not in the plan
+	tile_info = Opener.getTiffFileInfo(os.path.join(hyperstack_saving_path, "FOV_"+str(images_data[0][1])+".tif"))[0]
+	FOV_tiles, tile_dimensions = read_tile_configuration(tile_configuration_path, tile_info.width, tile_info.height, tile_overlap)
+	warn_old_blocks(stitching_saving_path)
+
+	#The stitching plug-in gives the channels its default colours, so the colours of the merged FOVs (from the menu in Part 1) are copied from the first one
+	first_tile = IJ.openImage(os.path.join(hyperstack_saving_path, FOV_tiles[0][0]))
+	tile_LUTs = first_tile.getLuts() if first_tile.isComposite() else []
+	first_tile.close()
+
+	#Get the tiles and memory of each block (in MB, the units reserved), and the memory free once the garbage is collected
+	blocks = []
+	for name, first_row, last_row in stitching_blocks:
+		block_tiles = [tile for tile in FOV_tiles if first_row <= tile[2] <= last_row]
+		block_memory = stitching_memory(block_tiles, tile_info.width, tile_info.height, tile_overlap, tile_info.getBytesPerPixel(), FOV_planes)
+		blocks.append((name, block_tiles, block_memory//1048576 + 1))
+	wait_for_memory(max(block[2] for block in blocks)*1048576, "stitching")
+	free_MB = max(1, free_memory()//1048576)
+	memory_reserved = Semaphore(free_MB)
+	block_workers = int(max(1, min(len(blocks), free_MB // min(block[2] for block in blocks))))
+	print("Stitching", len(blocks), "blocks, up to", block_workers, "at once (memory per block (MB):", max(block[2] for block in blocks), "free:", free_MB, ")")
+
+	#Stitch one block (a block bigger than all the free memory takes all of it, so it runs alone)
+	class StitchBlockTask(Callable):
+		def __init__(self, name, block_tiles, block_MB):
+			self.name = name
+			self.block_tiles = block_tiles
+			self.block_MB = min(block_MB, free_MB)
+		def call(self):
+			memory_reserved.acquire(self.block_MB)
+			try:
+				block_starting_time = datetime.now()
+				block_configuration = write_tile_configuration(os.path.join(hyperstack_saving_path, "TileConfiguration_"+self.name+".txt"), self.block_tiles,
+															   tile_info.width, tile_info.height, tile_overlap, tile_dimensions)
+
+				#Pass all the information needed for the Grid Stitching plug-in, which fuses all the channels and slices into one hyperstack in memory (before, it
+				#wrote each slice of each channel to the disk, and they were opened again, stacked per colour and merged, so every pixel was written and read twice).
+				#The fused image is renamed with the rows of the block before the next block is fused, so there is only one "Fused" image at a time
+				with stitching_plugin_lock:
+					IJ.run("Grid/Collection stitching", "type=[Positions from file] order=[Defined by TileConfiguration]"+
+						   " directory=["+data_directory+"/Raw Images_Merged] layout_file="+os.path.basename(block_configuration)+
+						   " fusion_method=[Linear Blending] regression_threshold=0.30"+
+						   " max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50"+
+						   " computation_parameters=[Save memory (but be slower)] image_output=[Fuse and display]")
+					Stitched_image = wait_for_image(lambda: WindowManager.getImage("Fused"), "stitched block "+self.name)
+					Stitched_image.setTitle(self.name)
+
+				#Give the fused image the same colours the merged FOVs have
+				if Stitched_image.isComposite() and Stitched_image.getNChannels() == len(tile_LUTs):
+					Stitched_image.setLuts(tile_LUTs)
+
+				#Save the stitched image with the name of its rows
+				try:
+					wait_for_file(save_TIFF(Stitched_image, os.path.join(stitching_saving_path, self.name+".tif"), TIFF_compression, True))
+				finally:
+					Stitched_image.close()
+				return self.name, (datetime.now().getTime() - block_starting_time.getTime())/1000.00
+			finally:
+				memory_reserved.release(self.block_MB)
+
+	#Send every block to the pool and collect them as they finish, printing the progress. A block that fails is reported and the others continue (it is
+	#stitched again the next time the script runs, since its image is missing)
+	block_executor = Executors.newFixedThreadPool(block_workers)
+	block_tasks = ExecutorCompletionService(block_executor)
+	for name, block_tiles, block_MB in blocks:
+		block_tasks.submit(StitchBlockTask(name, block_tiles, block_MB))
+	block_executor.shutdown()
+	failed_blocks = 0
+	try:
+		for block_index in range(len(blocks)):
+			try:
+				name, block_time = block_tasks.take().get()
+			except ExecutionException as error:
+				failed_blocks = failed_blocks + 1
+				print("A block failed to stitch:", error.getCause())
+				continue
+
+			#Progress update for each stitched image
+			print("Images stitched: ", block_index+1, "/", len(blocks), "("+name+")  Processing time for this image: ", round(block_time/60, 1))
+	finally:
+		block_executor.shutdownNow()
+
+	################################################################### End of the stitching ###################################################################
+
+	#Finish the timer and get the total number of seconds spent
+	ending_time = datetime.now()
+	stitching_time = (ending_time.getTime() - starting_time.getTime())/1000.00
+
+	#Print a summary of the work done and time it required
+	print("Total stitching time (min):", round(stitching_time/60, 1), "Blocks failed:", failed_blocks)
 
 
 ############################################################################################################################################################
@@ -427,64 +510,73 @@ print("Total stitching time (min):", round(stitching_time/60, 1))
 
 ######################################################### Make Z-projection for data analysis ##############################################################
 
-#Start the timer
-starting_time = datetime.now()
-
 #Make folder to save the processed images
 projections_saving_path = os.path.join(experiment_directory, "Processed Images for Analysis")
 if not os.path.exists(projections_saving_path):
 	os.makedirs(projections_saving_path)
 
-#Scan the folder were all the stitched images are
-for folder, subfolder, stitched_images in os.walk(stitching_saving_path):
-	
-	#Iterate through the stitched images
-	for stitched_image in stitched_images:
-		
-		#Open a stitched image (these are heavy, 1-3gb so they need longer to load)
-		original_image = IJ.openImage(os.path.join(folder, stitched_image))
-		while original_image==None:
-			time.sleep(1)
-		original_image.show()
-		
-		#Make the Z-projection
-		IJ.run("Z Project...", "projection=[Max Intensity]")
-		
-		#Close the original -heavy- image and clear some memory
-		original_image.close()
-		time.sleep(2)
-		IJ.run("Collect Garbage", "")
-		time.sleep(5)
-		IJ.run("Collect Garbage", "")
-		
+#Make the projection of every stitched image of the plan, subtract the background and save it
+def project_images():
+
+	#Start the timer
+	starting_time = datetime.now()
+
+	#List the projections of the blocks that are not in the plan (made with any of the projections)
+	warn_old_blocks(projections_saving_path, list(PROJECTION_PREFIXES.values()))
+
+	#Iterate through the stitched images of the blocks in the plan (any other file in the folder is left out)
+	for name in stitched_names:
+		stitched_image = name+".tif"
+
+		#Make the Z-projection reading one plane at a time from the file (the stitched images are heavy, 1-3gb, so they are not opened completely)
+		projected_image = project_Z(os.path.join(stitching_saving_path, stitched_image), projection_method)
+
 		#Subtract the background to clean the image and improve contrast
-		projected_image = IJ.getImage()
-		IJ.run("Subtract Background...", "rolling=50")
-		projected_image = IJ.getImage()
+		IJ.run(projected_image, "Subtract Background...", "rolling=50")
 
 		#Save the projection
 		projections_saving_name = os.path.join(projections_saving_path, projected_image.getTitle())
-		IJ.saveAs(projected_image, "Tiff", projections_saving_name)
-		time.sleep(10)
-		
-		#Close the image and clear the memory
+		save_TIFF(projected_image, projections_saving_name, TIFF_compression)
 		projected_image.close()
-		time.sleep(2)
-		IJ.run("Collect Garbage", "")
-		time.sleep(5)
-		IJ.run("Collect Garbage", "")
-		
+
 		#Print the status of the process
 		print("Image processed: ", stitched_image)
 
-################################################################### End of the processing ##################################################################
+	################################################################### End of the processing ##################################################################
 
-#Finish the timer and get the total number of seconds spent
-ending_time = datetime.now()
-processing_time = (ending_time.getTime() - starting_time.getTime())/1000.00
+	#Finish the timer and get the total number of seconds spent
+	ending_time = datetime.now()
+	processing_time = (ending_time.getTime() - starting_time.getTime())/1000.00
 
-#Print a summary of the work done and time it required
-print("Stitched images processing time (min):", round(processing_time/60, 1))
+	#Print a summary of the work done and time it required
+	print("Stitched images processing time (min):", round(processing_time/60, 1))
+
+
+############################################################################################################################################################
+############################################################## RUN THE PARTS THAT ARE OUT OF DATE ##########################################################
+
+#Each part is a stage with the files it reads and saves, and it only runs when its images are missing or older than what it reads (like make does). The
+#settings of the menu used by each part are saved in "Pipeline settings" and count as one more input, so changing only the stitching parameters makes
+#the stitching and projection run again but not the merging. The quantification of the cells is done after this with PLA_quantification.py (the ROIs
+#of the cells are drawn on the processed images), which has its own option to resume.
+settings_directory = os.path.join(experiment_directory, "Pipeline settings")
+merged_FOVs = [os.path.join(hyperstack_saving_path, "FOV_"+str(FOV)+".tif") for FOV in sorted(set(image_info[1] for image_info in images_data))]
+stitched_images = [os.path.join(stitching_saving_path, name+".tif") for name in stitched_names]
+processed_images = [os.path.join(projections_saving_path, PROJECTION_PREFIXES[projection_method]+name+".tif") for name in stitched_names]
+pipeline_stages = [
+	{"name": "Part 1 (merge)", "run": merge_FOVs, "outputs": merged_FOVs,
+	 "inputs": [raw_image_directory, save_stage_settings(settings_directory, "Merge", {"colours": [ch0_color, ch1_color, ch2_color, ch3_color, ch4_color],
+																						 "name_key": name_key, "TIFF_compression": TIFF_compression})]},
+	{"name": "Part 2 (tile positions)", "run": place_FOVs, "outputs": [tile_configuration_path],
+	 "inputs": merged_FOVs + [save_stage_settings(settings_directory, "Tile positions", {"acquisition_columns": acquisition_columns,
+						  "acquisition_rows": acquisition_rows, "acquisition_order": acquisition_order, "grid_size_x": grid_size_x, "tile_overlap": tile_overlap})]},
+	{"name": "Part 3 (stitching)", "run": stitch_blocks, "outputs": stitched_images,
+	 "inputs": merged_FOVs + [tile_configuration_path, save_stage_settings(settings_directory, "Stitching", {"stitching_blocks": stitched_names,
+						  "TIFF_compression": TIFF_compression})]},
+	{"name": "Part 4 (projection and background)", "run": project_images, "outputs": processed_images,
+	 "inputs": stitched_images + [save_stage_settings(settings_directory, "Projection", {"projection_method": projection_method, "rolling": 50,
+																							 "TIFF_compression": TIFF_compression})]}]
+run_stages(pipeline_stages, rerun_all)
 
 
 ############################################################################################################################################################
@@ -494,7 +586,8 @@ print("Stitched images processing time (min):", round(processing_time/60, 1))
 whole_script_ending_time = datetime.now()
 whole_script_running_time = (whole_script_ending_time.getTime() - whole_script_starting_time.getTime())/1000.00
 
-#Print a summary of the work done and time it required
+#Print a summary of the work done and time it required (plus the time spent waiting for images, files and memory)
+print_wait_summary()
 print("Whole script running time for one channel/condition (hours):", round(whole_script_running_time/3600, 1))
 
 
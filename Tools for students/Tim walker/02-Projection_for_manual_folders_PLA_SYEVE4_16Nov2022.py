@@ -1,7 +1,7 @@
 ############################################################################################################################################################
 '''
 
-Full name of script: Image projection and background subtraction for manually acquired folders of PLA experiment in EV and E4 TMEM127 KO SH-SY5Y cells  [V 02]
+Full name of script: Image projection and background subtraction for manually acquired folders of PLA experiment in EV and E4 TMEM127 KO SH-SY5Y cells  [V 04]
 
 Script languague: Jython (Python wrapper for Java, run with ImageJ/Fiji app -not pyImageJ-)
 
@@ -14,12 +14,17 @@ Made by: Eduardo Reyes Alvarez
 
 Contact: eduardo_reyes09@hotmail.com
 
-Last update: November 18, 2022
+Last update: October 17, 2026
 
 Version History:
 V01 (November 18, 2022): First version of the script adapted as a standalone part (it required minor edits from the original script, mostly name of a missing
 						 variable and change variable names to refer to "merged" images instead of "stitched").
 V02 (November 18, 2022): Minor edit, now the user can provide the rolling radius for background subtraction in case the images are more or less noisy.
+V03 (October 17, 2026): The projections are saved by the shared TIFF_writer.py (in "Tools for EVOS-M7000 images"), with the option to compress them (LZW or
+						 Deflate). BigTIFF is not offered, the projections are opened by ImageJ in PLA_quantification.py.
+V04 (October 17, 2026): The Z-projection is made by the shared Z_projector.py, which reads one plane at a time from the file instead of opening the whole
+						 image, so only the projection is kept in memory and the waits to collect the garbage were removed. The projection (Max Intensity,
+						 Average Intensity or Sum Slices) can be selected in the menu.
 
 '''
 
@@ -28,13 +33,24 @@ V02 (November 18, 2022): Minor edit, now the user can provide the rolling radius
 ########################################## Import neccesary packages and make the interactive menu #########################################################
 
 import os
-import time
+import sys
 from datetime import datetime
-from ij import IJ, ImagePlus
-from ij import WindowManager
+from ij import IJ
+
+#The images are projected by Z_projector.py and saved by TIFF_writer.py (in the folder "Tools for EVOS-M7000 images" of the repository, or copied to
+#Fiji.app/jars/Lib)
+try:
+	from TIFF_writer import save_TIFF
+	from Z_projector import project_Z
+except ImportError:
+	sys.path.append(os.path.join(os.path.dirname(os.path.abspath(globals().get("__file__", ""))), "..", "..", "Tools for EVOS-M7000 images"))
+	from TIFF_writer import save_TIFF
+	from Z_projector import project_Z
 
 #@ File    (label = "Experiment folder", style = "directory") experiment_directory
 #@ Integer (label="Rolling radius (for background subtraction):", min=1, max=1000, description="Test this number beforehand", value=100) background_radius
+#@ String  (label="TIFF compression of the images saved", style = "listBox", choices = {"Uncompressed", "LZW", "Deflate"}) TIFF_compression
+#@ String  (label="Z-projection", style = "listBox", choices = {"Max Intensity", "Average Intensity", "Sum Slices"}) projection_method
 #@ String (visibility=MESSAGE, value="Script made by: Eduardo Reyes-Alvarez", required=false) msg6
 
 #Get full path of raw images and the cells folder from the menu
@@ -62,38 +78,20 @@ for folder, subfolder, merged_images in os.walk(merging_saving_path):
     #Iterate through the merged images
     for merged_image in merged_images:
     	
-        #Open a merged image 
-        original_image = IJ.openImage(os.path.join(folder, merged_image))
-        while original_image==None:
-            time.sleep(1)
-        original_image.show()
+        #Skip any file that is not an image (like the TileConfiguration files of the stitching or a partial file of a previous run)
+        if (not merged_image.lower().endswith((".tif", ".tiff"))) or merged_image.endswith(".part.tif"):
+            continue
         
-        #Make the Z-projection
-        IJ.run("Z Project...", "projection=[Max Intensity]")
-        
-        #Close the original -heavier- image and clear some memory
-        original_image.close()
-        time.sleep(1)
-        IJ.run("Collect Garbage", "")
-        time.sleep(1)
-        IJ.run("Collect Garbage", "")
+        #Make the Z-projection reading one plane at a time from the file (only the projection is kept in memory)
+        projected_image = project_Z(os.path.join(folder, merged_image), projection_method)
         
         #Subtract the background to clean the image and improve contrast
-        projected_image = IJ.getImage()
-        IJ.run("Subtract Background...", "rolling="+str(background_radius))
-        projected_image = IJ.getImage()
+        IJ.run(projected_image, "Subtract Background...", "rolling="+str(background_radius))
         
         #Save the projection
         projections_saving_name = os.path.join(projections_saving_path, projected_image.getTitle())
-        IJ.saveAs(projected_image, "Tiff", projections_saving_name)
-        time.sleep(2)
-        
-        #Close the image and clear the memory
+        save_TIFF(projected_image, projections_saving_name, TIFF_compression)
         projected_image.close()
-        time.sleep(1)
-        IJ.run("Collect Garbage", "")
-        time.sleep(1)
-        IJ.run("Collect Garbage", "")
         
         #Print the status of the process
         print("Image processed: ", merged_image)